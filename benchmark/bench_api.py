@@ -0,0 +1,192 @@
+"""
+Web API 的压力测试
+- 对比两种服务模式下/random接口的吞吐量和延迟:
+    - flask: 原来的Flask开发服务器(app.run)
+    - gevent: 生产环境服务模式(api_server.py), 多个工作进程运行gevent的WSGIServer
+- 服务进程使用内存中生成的代理IP(不需要MongoDB), 和真实部署一样通过内存索引提供代理IP
+- 压测客户端运行在独立的进程中, 每个进程使用多个协程, 每个协程保持一个长连接不停地请求/random
+- 报告内容: 每秒请求数(QPS), 延迟的p50/p99, 请求失败的数量
+- 服务进程和压测进程都通过 python -m benchmark.bench_api --role ... 启动, 互不影响gevent补丁
+用法:
+    python -m benchmark.bench_api --servers flask gevent --workers 4 --clients 2 --connections 50 --duration 10
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+# 压测请求的地址, 按顺序循环使用
+PATHS = ['/random', '/random?protocol=http', '/random?protocol=https&domain=jd.com', '/random?policy=top']
+
+
+class MemoryApiPool:
+    """只保存在内存中的代理池, 提供ProxyApi和ProxyIndex用到的数据库操作方法"""
+    def __init__(self, size, seed=0):
+        from model import Proxy
+        rand = random.Random(seed)
+        self.proxies = [Proxy(f'10.{i // 65536 % 256}.{i // 256 % 256}.{i % 256}', str(rand.randint(80, 65535)),
+                              protocol=rand.choice([0, 1, 2]), nick_type=0, speed=round(rand.uniform(0.1, 5), 2),
+                              score=rand.randint(40, 50)) for i in range(size)]
+
+    def find_updated_since(self, timestamp=None):
+        # 内存中的代理IP不会变化, 增量拉取时没有数据
+        if timestamp is not None:
+            return
+        for proxy in self.proxies:
+            yield proxy, None
+
+    def find_deleted_since(self, timestamp):
+        # 内存中的代理IP不会被删除
+        return iter(())
+
+    def find_disabled_since(self, timestamp=None):
+        # 每10个代理IP中禁用一个访问jd.com, 压测指定域名时的排除
+        if timestamp is not None:
+            return
+        for proxy in self.proxies[::10]:
+            yield 'jd.com', proxy.ip, None
+
+    def buffer_served(self, ip, count):
+        pass
+
+    def flush(self):
+        pass
+
+
+def run_server(args):
+    """服务进程: 按照指定的服务模式启动ProxyApi"""
+    from core import proxy_api
+    proxy_api.API_SERVER = args.server
+    proxy_api.API_WORKERS = args.workers
+    proxy_api.WEB_API_PORT = args.port
+
+    class BenchApi(proxy_api.ProxyApi):
+        def __init__(self):
+            super().__init__(mongo_pool=MemoryApiPool(args.proxies))
+
+    BenchApi.start()
+
+
+def run_client(args):
+    """压测进程: 使用多个协程保持长连接请求/random, 结束后把结果以一行json输出到标准输出"""
+    from gevent import monkey
+    monkey.patch_all()
+    import gevent
+    import http.client
+
+    latencies = []
+    errors = 0
+    deadline = time.time() + args.duration
+
+    def work(index):
+        nonlocal errors
+        connection = http.client.HTTPConnection('127.0.0.1', args.port, timeout=10)
+        count = index
+        while time.time() < deadline:
+            path = PATHS[count % len(PATHS)]
+            count += 1
+            start = time.perf_counter()
+            try:
+                connection.request('GET', path)
+                response = connection.getresponse()
+                response.read()
+                if response.status != 200:
+                    errors += 1
+                    continue
+                latencies.append(time.perf_counter() - start)
+            except Exception:
+                errors += 1
+                connection.close()
+
+    gevent.joinall([gevent.spawn(work, index) for index in range(args.connections)])
+    print(json.dumps({'latencies': latencies, 'errors': errors}), flush=True)
+
+
+def _percentile(values, percent):
+    """计算百分位数"""
+    if not values:
+        return 0
+    return values[min(len(values) - 1, int(len(values) * percent / 100))]
+
+
+def _wait_for_port(port, timeout=30):
+    """等待服务进程开始监听端口"""
+    import socket
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=1):
+                return
+        except OSError:
+            time.sleep(0.2)
+    raise SystemExit(f'服务没有在{timeout}秒内启动')
+
+
+def _unused_port():
+    import socket
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def benchmark(server, args):
+    """启动一种服务模式的服务进程, 运行压测进程, 返回报告"""
+    import subprocess
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    port = _unused_port()
+    common = ['--port', str(port), '--duration', str(args.duration), '--connections', str(args.connections),
+              '--workers', str(args.workers), '--proxies', str(args.proxies)]
+    server_process = subprocess.Popen([sys.executable, '-m', 'benchmark.bench_api', '--role', 'server',
+                                       '--server', server] + common,
+                                      cwd=root, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        _wait_for_port(port)
+        clients = [subprocess.Popen([sys.executable, '-m', 'benchmark.bench_api', '--role', 'client'] + common,
+                                    cwd=root, stdout=subprocess.PIPE, text=True) for _ in range(args.clients)]
+        results = [json.loads(client.communicate()[0]) for client in clients]
+    finally:
+        server_process.terminate()
+        server_process.wait()
+    latencies = sorted(latency for result in results for latency in result['latencies'])
+    return {
+        'server': server if server == 'flask' else f'{server}({args.workers} workers)',
+        'requests': len(latencies),
+        'errors': sum(result['errors'] for result in results),
+        'qps': round(len(latencies) / args.duration, 1),
+        'p50_ms': round(_percentile(latencies, 50) * 1000, 2),
+        'p99_ms': round(_percentile(latencies, 99) * 1000, 2),
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Web API 的压力测试')
+    parser.add_argument('--role', choices=['compare', 'server', 'client'], default='compare',
+                        help='compare: 依次压测每种服务模式并输出报告, server和client由compare在子进程中使用')
+    parser.add_argument('--servers', nargs='+', choices=['flask', 'gevent'], default=['flask', 'gevent'],
+                        help='要压测的服务模式')
+    parser.add_argument('--server', choices=['flask', 'gevent'], default='gevent', help='服务进程使用的服务模式')
+    parser.add_argument('--workers', type=int, default=4, help='gevent服务模式的工作进程数量')
+    parser.add_argument('--proxies', type=int, default=1000, help='服务进程中代理IP的数量')
+    parser.add_argument('--clients', type=int, default=2, help='压测进程的数量')
+    parser.add_argument('--connections', type=int, default=50, help='每个压测进程的长连接数量')
+    parser.add_argument('--duration', type=float, default=10, help='压测时间(秒)')
+    parser.add_argument('--port', type=int, default=0, help='服务端口, 由compare自动分配')
+    parser.add_argument('--json', action='store_true', help='以json格式输出报告')
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    if args.role == 'server':
+        run_server(args)
+    elif args.role == 'client':
+        run_client(args)
+    else:
+        reports = [benchmark(server, args) for server in args.servers]
+        if args.json:
+            print(json.dumps(reports))
+        else:
+            for report in reports:
+                print('  '.join(f'{key}={value}' for key, value in report.items()))
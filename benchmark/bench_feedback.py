@@ -0,0 +1,116 @@
+"""
+爬虫反馈接口的基准测试
+- 使用临时目录中的SQLite数据库和内存索引创建ProxyApi, 通过Flask的测试客户端调用接口, 不需要MongoDB和网络
+- 报告内容:
+    - feedback_items_per_second: POST /feedback每秒处理的反馈数量(每次提交--batch项)
+    - proxies_per_second / ranked_proxies_per_second: 没有反馈、以及--feedback-proxies个代理IP都有反馈时,
+      每秒获取排名靠前的代理IP的次数(绕过/proxies的响应缓存, 直接调用数据源, 和/random的top策略一致)
+    - drop_out_seconds: 排名靠前的代理IP开始连续失败(爬虫每隔--interval秒反馈一批)到不再出现在/proxies中的时间,
+      以及期间反馈的失败次数drop_out_failures
+    - flush_seconds: 把所有反馈的统计写入数据库的耗时
+用法:
+    python -m benchmark.bench_feedback --proxies 10000 --batch 500
+"""
+import argparse
+import json
+import os
+import random
+import tempfile
+import time
+from benchmark.bench_storage import make_proxies
+from settings import MAX_PROXIES_RANGE, FEEDBACK_RANK_SECONDS
+
+
+def create_api(args, directory):
+    """创建使用SQLite数据库和内存索引的ProxyApi, 写入args.proxies个代理IP"""
+    from core.db.sqlite_pool import SqlitePool
+    from core.proxy_api import ProxyApi
+    pool = SqlitePool(os.path.join(directory, 'bench.db'))
+    for proxy in make_proxies(args.proxies, args.seed):
+        proxy.nick_type = 0
+        pool.buffer_insert(proxy)
+    pool.flush()
+    api = ProxyApi(pool)
+    api.proxy_index.load_all()
+    return api
+
+
+def _rate(function, repeat):
+    """执行repeat次, 返回每秒执行的次数"""
+    start = time.perf_counter()
+    for i in range(repeat):
+        function(i)
+    return repeat / (time.perf_counter() - start)
+
+
+def benchmark(args, directory):
+    api = create_api(args, directory)
+    client = api.app.test_client()
+    rand = random.Random(args.seed)
+    ips = [proxy.ip for proxy in api.proxy_index.get_proxies(count=0)]
+    domains = [f'site{i}.com' for i in range(args.domains)]
+    report = {'proxies': args.proxies, 'batch': args.batch}
+
+    source = api.proxy_source
+    report['proxies_per_second'] = _rate(
+        lambda i: source.get_proxies(domain=domains[i % len(domains)], count=MAX_PROXIES_RANGE), args.repeat)
+
+    # 随机的代理IP收到随机的反馈, 大部分成功
+    fed = rand.sample(ips, min(args.feedback_proxies, len(ips)))
+    batches = [{'items': [[rand.choice(fed), rand.choice(domains), rand.random() < 0.9,
+                           round(rand.uniform(0.1, 3), 3)] for _ in range(args.batch)]} for _ in range(args.batches)]
+    start = time.perf_counter()
+    for batch in batches:
+        client.post('/feedback', json=batch)
+    report['feedback_items_per_second'] = args.batch * args.batches / (time.perf_counter() - start)
+
+    # 等待反馈生效后再测试排序的开销
+    time.sleep(FEEDBACK_RANK_SECONDS)
+    report['ranked_proxies_per_second'] = _rate(
+        lambda i: source.get_proxies(domain=domains[i % len(domains)], count=MAX_PROXIES_RANGE), args.repeat)
+
+    # 没有反馈的排名最靠前的代理IP开始连续失败, 统计它不再出现在/proxies中的时间
+    rankings = api.feedback.rankings()
+    target = next(proxy.ip for proxy in source.get_proxies(count=MAX_PROXIES_RANGE) if proxy.ip not in rankings)
+    start = time.perf_counter()
+    failures = 0
+    while True:
+        client.post('/feedback', json={'items': [[target, None, False, None]] * args.failures_per_interval})
+        failures += args.failures_per_interval
+        proxies = client.get(f'/proxies?count={MAX_PROXIES_RANGE}').get_json()
+        if target not in {proxy['ip'] for proxy in proxies}:
+            break
+        time.sleep(args.interval)
+    report['drop_out_seconds'] = time.perf_counter() - start
+    report['drop_out_failures'] = failures
+
+    start = time.perf_counter()
+    api.feedback.flush()
+    report['flush_seconds'] = time.perf_counter() - start
+    api.mongo_pool.close()
+    return {key: round(value, 3) if isinstance(value, float) else value for key, value in report.items()}
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='爬虫反馈接口的基准测试')
+    parser.add_argument('--proxies', type=int, default=10000, help='代理IP的数量')
+    parser.add_argument('--feedback-proxies', type=int, default=1000, help='收到反馈的代理IP的数量')
+    parser.add_argument('--domains', type=int, default=20, help='域名的数量')
+    parser.add_argument('--batch', type=int, default=500, help='每次POST /feedback提交的反馈数量')
+    parser.add_argument('--batches', type=int, default=200, help='提交的次数')
+    parser.add_argument('--repeat', type=int, default=1000, help='获取代理IP的次数')
+    parser.add_argument('--interval', type=float, default=0.1, help='爬虫反馈失败的间隔时间(秒)')
+    parser.add_argument('--failures-per-interval', type=int, default=1, help='爬虫每次反馈的失败次数')
+    parser.add_argument('--seed', type=int, default=0, help='生成代理IP的随机数种子')
+    parser.add_argument('--json', action='store_true', help='以json格式输出报告')
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    with tempfile.TemporaryDirectory() as directory:
+        report = benchmark(args, directory)
+    if args.json:
+        print(json.dumps(report))
+    else:
+        print('  '.join(f'{key}={value}' for key, value in report.items()))
@@ -0,0 +1,106 @@
+"""
+代理IP租约的基准测试
+- 模拟多个API工作进程共享同一个租约表(LeaseSlots), 每个工作进程不断地租用并归还代理IP, 报告每秒租用和归还的次数
+- 租约只修改共享内存, 不写入数据库, 代理IP由内存中的数据源提供, 不需要MongoDB
+- 同时统计在租约有效期间, 同一个域名的代理IP是否被重复租出(conflicts, 应该为0)
+用法:
+    python -m benchmark.bench_lease --proxies 1000 --workers 1 4 --seconds 3
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import time
+from benchmark.bench_storage import make_proxies
+from core.lease_table import LeaseSlots, LeaseTable
+
+
+class StaticSource:
+    """内存中的代理IP数据源, 提供LeaseTable需要的get_proxies方法和version属性"""
+    version = 0
+
+    def __init__(self, proxies):
+        self.proxies = sorted(proxies, key=lambda proxy: (-proxy.score, proxy.speed))
+
+    def get_proxies(self, protocol=None, domain=None, nick_type=0, count=0):
+        return self.proxies[:count] if count else list(self.proxies)
+
+
+def run_worker(slots, source, args, worker_id, results):
+    """工作进程: 依次在多个域名下租用代理IP, 每个域名保持args.held个租约, 超出时归还最早的租约"""
+    table = LeaseTable(source, slots)
+    domains = [f'site{i}.com' for i in range(args.domains)]
+    held = {domain: [] for domain in domains}
+    acquired = released = exhausted = 0
+    deadline = time.perf_counter() + args.seconds
+    i = worker_id
+    while time.perf_counter() < deadline:
+        domain = domains[i % len(domains)]
+        i += 1
+        result = table.acquire(domain=domain, ttl=60)
+        if result is None:
+            exhausted += 1
+        else:
+            acquired += 1
+            held[domain].append(result[1])
+        if len(held[domain]) > args.held:
+            released += table.release(held[domain].pop(0))
+    results.put({'acquired': acquired, 'released': released, 'exhausted': exhausted})
+
+
+def count_conflicts(slots):
+    """统计有效租约中重复的(域名, ip), 槽位以(域名, ip)的哈希值为键, 同一个键只能出现在一个有效的槽位中"""
+    now = time.time()
+    keys = [slots._slot(index)[0] for index in range(slots.size) if slots._slot(index)[2] > now]
+    return len(keys) - len(set(keys))
+
+
+def benchmark(workers, args):
+    slots = LeaseSlots(args.slots)
+    source = StaticSource(make_proxies(args.proxies, args.seed))
+    results = multiprocessing.Queue()
+    processes = [multiprocessing.Process(target=run_worker, args=(slots, source, args, i, results))
+                 for i in range(workers)]
+    start = time.perf_counter()
+    for process in processes:
+        process.start()
+    reports = [results.get() for _ in processes]
+    for process in processes:
+        process.join()
+    seconds = time.perf_counter() - start
+    acquired = sum(report['acquired'] for report in reports)
+    released = sum(report['released'] for report in reports)
+    return {
+        'workers': workers,
+        'proxies': args.proxies,
+        'domains': args.domains,
+        'acquire_per_second': round(acquired / seconds),
+        'release_per_second': round(released / seconds),
+        'exhausted': sum(report['exhausted'] for report in reports),
+        'conflicts': count_conflicts(slots),
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='代理IP租约的基准测试')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 4], help='工作进程的数量')
+    parser.add_argument('--proxies', type=int, default=1000, help='代理IP的数量')
+    parser.add_argument('--domains', type=int, default=20, help='域名的数量')
+    parser.add_argument('--held', type=int, default=20, help='每个工作进程在每个域名下同时持有的租约数量, 所有工作进程持有的总数超过LEASE_CANDIDATES时会租不到')
+    parser.add_argument('--slots', type=int, default=65536, help='租约表的槽位数量')
+    parser.add_argument('--seconds', type=float, default=3, help='每个工作进程运行的时间(秒)')
+    parser.add_argument('--seed', type=int, default=0, help='生成代理IP的随机数种子')
+    parser.add_argument('--json', action='store_true', help='以json格式输出报告')
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    # 租约表通过fork继承给工作进程
+    multiprocessing.set_start_method('fork')
+    reports = [benchmark(workers, args) for workers in args.workers]
+    if args.json:
+        print(json.dumps(reports))
+    else:
+        for report in reports:
+            print('  '.join(f'{key}={value}' for key, value in report.items()))
@@ -0,0 +1,138 @@
+"""
+代理对象数据模型的基准测试
+- 对比两种实现:
+    - legacy: 原来的实现, 每个对象有自己的__dict__, ip和port保存为字符串, 通过__dict__转换为数据库文档和json
+    - slots: 现在的实现(model.Proxy), 使用__slots__, IPv4地址和端口压缩为整数, 通过专门的编解码方法转换
+- 两种实现由同一批数据库文档创建, 编码得到的数据库文档和json必须完全一致, 否则报错退出
+- 报告内容: 保存所有代理IP占用的内存, 由数据库文档创建对象、编码为数据库文档、编码为json的速度
+用法:
+    python -m benchmark.bench_model --proxies 100000
+"""
+import argparse
+import gc
+import json
+import random
+import time
+import tracemalloc
+from model import Proxy, dumps_proxies
+from settings import MAX_SCORE
+
+
+class LegacyProxy:
+    """原来的Proxy实现"""
+    def __init__(self, ip, port, protocol=-1, nick_type=-1, speed=-1, area=None, score=MAX_SCORE, disable_domains=None):
+        self.ip = ip
+        self.port = port
+        self.protocol = protocol
+        self.nick_type = nick_type
+        self.speed = speed
+        self.area = area
+        self.score = score
+        self.disable_domains = disable_domains or []
+
+
+LEGACY_FIELDS = ('ip', 'port', 'protocol', 'nick_type', 'speed', 'area', 'score', 'disable_domains')
+
+
+def make_documents(count, seed=0):
+    """生成count个和数据库中格式相同的文档"""
+    rand = random.Random(seed)
+    areas = ['北京市', '上海市', '广东省深圳市', 'United States', 'Germany', None]
+    documents = []
+    for i in range(count):
+        ip = f'{rand.randint(1, 223)}.{rand.randint(0, 255)}.{rand.randint(0, 255)}.{rand.randint(1, 254)}'
+        documents.append({
+            '_id': ip, 'ip': ip, 'port': str(rand.randint(80, 65535)), 'protocol': rand.choice([0, 1, 2]),
+            'nick_type': rand.choice([0, 1, 2]), 'speed': round(rand.uniform(0.1, 5), 2),
+            'area': rand.choice(areas), 'score': rand.randint(1, MAX_SCORE),
+            'updated_at': time.time() + i, 'next_check': time.time() + i,
+        })
+    return documents
+
+
+IMPLS = {
+    'legacy': {
+        'decode': lambda documents: [LegacyProxy(**{key: value for key, value in item.items() if key in LEGACY_FIELDS})
+                                     for item in documents],
+        'to_document': lambda proxies: [dict(proxy.__dict__) for proxy in proxies],
+        'dumps': lambda proxies: json.dumps([proxy.__dict__ for proxy in proxies], ensure_ascii=False,
+                                            separators=(',', ':')).encode(),
+    },
+    'slots': {
+        'decode': lambda documents: list(Proxy.from_documents(documents)),
+        'to_document': lambda proxies: [proxy.to_document() for proxy in proxies],
+        'dumps': dumps_proxies,
+    },
+}
+
+
+def _measure_memory(decode, documents):
+    """返回由文档创建的所有对象常驻的内存
+    先复制一份文档, 保证每个字段都是新的对象(和从数据库读取时一样), 创建对象之后释放文档, 只统计对象引用的内存
+    """
+    text = json.dumps(documents)
+    gc.collect()
+    tracemalloc.start()
+    copied = json.loads(text)
+    proxies = decode(copied)
+    del copied
+    gc.collect()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return size, proxies
+
+
+def _measure_time(function, argument, repeat):
+    """重复执行repeat轮, 返回(最快一轮的耗时, 结果)"""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function(argument)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def benchmark(args):
+    documents = make_documents(args.proxies, args.seed)
+    reports = []
+    outputs = {}
+    for name, impl in IMPLS.items():
+        memory, proxies = _measure_memory(impl['decode'], documents)
+        decode_time, _ = _measure_time(impl['decode'], documents, args.repeat)
+        encode_time, encoded = _measure_time(impl['to_document'], proxies, args.repeat)
+        dumps_time, body = _measure_time(impl['dumps'], proxies, args.repeat)
+        # legacy的文档包含disable_domains, 现在不可用域名保存在单独的集合中, 比较时去掉
+        outputs[name] = ([{key: value for key, value in item.items() if key != 'disable_domains'} for item in encoded],
+                         json.loads(body))
+        reports.append({
+            'impl': name,
+            'proxies': len(proxies),
+            'memory_mb': round(memory / 1024 / 1024, 2),
+            'bytes_per_proxy': round(memory / len(proxies)),
+            'decode_per_second': round(len(proxies) / decode_time),
+            'to_document_per_second': round(len(proxies) / encode_time),
+            'dumps_per_second': round(len(proxies) / dumps_time),
+        })
+    if outputs['legacy'] != outputs['slots']:
+        raise SystemExit('两种实现编码得到的结果不一致')
+    return reports
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='代理对象数据模型的基准测试')
+    parser.add_argument('--proxies', type=int, default=100000, help='代理IP的数量')
+    parser.add_argument('--repeat', type=int, default=3, help='重复执行的轮数, 取最快的一轮')
+    parser.add_argument('--seed', type=int, default=0, help='生成数据库文档的随机数种子')
+    parser.add_argument('--json', action='store_true', help='以json格式输出报告')
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    reports = benchmark(args)
+    if args.json:
+        print(json.dumps(reports))
+    else:
+        for report in reports:
+            print('  '.join(f'{key}={value}' for key, value in report.items()))
@@ -0,0 +1,154 @@
+"""
+爬虫页面解析的基准测试
+- 对比每个爬虫解析同一批页面的两种实现:
+    - legacy: 原来的实现, 每一行都用XPATH字符串调用tr.xpath(...)重新编译; 快代理先解码整个页面, 再用正则表达式截取列表后json.loads
+    - compiled: 现在的实现(BaseSpider.extract_from_page), 使用编译好的etree.XPath对象; 快代理只解码列表开始之后的内容并直接解析
+- 两种实现提取到的(ip, port, area)必须完全一致, 否则报错退出
+- 默认使用按照各个网站页面结构生成的合成页面, 不需要访问外网
+    - 也可以通过--pages-dir指定保存的真实页面, 文件名以爬虫类名开头, 例如 KuaidailiSpider_1.html
+- 报告内容: 每种实现每秒解析的页面数和代理IP数
+用法:
+    python -m benchmark.bench_parser --rows 15 --pages 50 --repeat 5
+"""
+import argparse
+import json
+import os
+import random
+import re
+import time
+from lxml import etree
+from core.proxy_spider.proxy_spiders import Ip3366Spider, ProxyListPlusSpider, KuaidailiSpider
+
+
+def _random_rows(rand, rows):
+    """生成rows个随机的(ip, port, area)"""
+    areas = ['北京市', '上海市', '广东省深圳市', 'United States', 'Germany', '']
+    return [('.'.join(str(rand.randint(1, 254)) for _ in range(4)), str(rand.randint(80, 65535)),
+             rand.choice(areas)) for _ in range(rows)]
+
+
+def make_ip3366_page(rows):
+    """生成和ip3366列表页结构相同的页面"""
+    trs = ''.join(f'<tr><td>{ip}</td><td>{port}</td><td>高匿代理IP</td><td>HTTPS</td><td>{area}</td>'
+                  f'<td>1秒</td><td>2024/1/1 12:00:00</td></tr>' for ip, port, area in rows)
+    return (f'<html><head><title>ip3366</title></head><body><div id="container"><div id="list">'
+            f'<table class="table"><thead><tr><th>IP</th><th>PORT</th></tr></thead>'
+            f'<tbody>{trs}</tbody></table></div></div></body></html>').encode()
+
+
+def make_proxylistplus_page(rows):
+    """生成和ProxyListPlus列表页结构相同的页面, 表格的前两行是标题"""
+    trs = ''.join(f'<tr class="cells"><td>{index}</td><td>{ip}</td><td>{port}</td><td>elite</td>'
+                  f'<td>{area}</td><td>no</td><td>1 minute</td></tr>'
+                  for index, (ip, port, area) in enumerate(rows, start=1))
+    return (f'<html><body><div id="page"><table><tr><td>menu</td></tr></table>'
+            f'<table><tr><th colspan="7">Fresh HTTP Proxy List</th></tr>'
+            f'<tr><th>#</th><th>IP Address</th><th>Port</th></tr>{trs}</table></div></body></html>').encode()
+
+
+def make_kuaidaili_page(rows):
+    """生成和快代理列表页结构相同的页面, 代理IP列表写在JavaScript变量中"""
+    items = [{'ip': ip, 'port': port, 'location': area, 'last_check_time': '2024-01-01 12:00:00', 'speed': 1}
+             for ip, port, area in rows]
+    # 模拟页面中代理IP列表之前的大量标签和脚本
+    padding = ''.join(f'<li><a href="/doc/{i}/">doc {i}</a></li>' for i in range(300))
+    return (f'<html><head><script>var config = {{"a": [1, 2, 3]}};</script></head><body><ul>{padding}</ul>'
+            f'<script>const fpsList = {json.dumps(items, ensure_ascii=False)};\nrender(fpsList);</script>'
+            f'</body></html>').encode()
+
+
+GENERATORS = {
+    Ip3366Spider: make_ip3366_page,
+    ProxyListPlusSpider: make_proxylistplus_page,
+    KuaidailiSpider: make_kuaidaili_page,
+}
+
+
+def legacy_xpath_extract(spider, page):
+    """原来的解析实现: 每一行都用XPATH字符串重新编译"""
+    def first(lis):
+        return lis[0] if len(lis) != 0 else ''
+    html = etree.HTML(page)
+    for tr in html.xpath(spider.group_xpath):
+        yield (first(tr.xpath(spider.detail_xpath['ip'])), first(tr.xpath(spider.detail_xpath['port'])),
+               first(tr.xpath(spider.detail_xpath['area'])))
+
+
+def legacy_kuaidaili_extract(spider, page):
+    """原来的快代理解析实现: 解码整个页面, 用正则表达式截取列表后json.loads"""
+    html_str = page.decode()
+    ip_list_str = re.search(r'const fpsList = (\[.*?\]);', html_str, re.S).group(1)
+    for item in json.loads(ip_list_str):
+        yield item['ip'], item['port'], item['location']
+
+
+def load_pages(spider_cls, args, rand):
+    """加载保存的真实页面, 没有指定目录时生成合成页面"""
+    if args.pages_dir:
+        names = sorted(name for name in os.listdir(args.pages_dir) if name.startswith(spider_cls.__name__))
+        pages = []
+        for name in names:
+            with open(os.path.join(args.pages_dir, name), 'rb') as f:
+                pages.append(f.read())
+        return pages
+    return [GENERATORS[spider_cls](_random_rows(rand, args.rows)) for _ in range(args.pages)]
+
+
+def _measure(extract, spider, pages, repeat):
+    """重复解析repeat轮, 返回(最快一轮的耗时, 提取结果)"""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        results = [list(extract(spider, page)) for page in pages]
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, results
+
+
+def benchmark(args):
+    """对每个爬虫运行两种解析实现, 返回报告列表"""
+    rand = random.Random(args.seed)
+    reports = []
+    for spider_cls in GENERATORS:
+        spider = spider_cls()
+        pages = load_pages(spider_cls, args, rand)
+        if not pages:
+            continue
+        legacy = legacy_kuaidaili_extract if spider_cls is KuaidailiSpider else legacy_xpath_extract
+        legacy_time, legacy_results = _measure(legacy, spider, pages, args.repeat)
+        compiled_time, compiled_results = _measure(spider_cls.extract_from_page, spider, pages, args.repeat)
+        if legacy_results != compiled_results:
+            raise SystemExit(f'{spider_cls.__name__}: 两种实现提取到的结果不一致')
+        proxies = sum(len(result) for result in compiled_results)
+        for name, elapsed in (('legacy', legacy_time), ('compiled', compiled_time)):
+            reports.append({
+                'spider': spider_cls.__name__,
+                'impl': name,
+                'pages': len(pages),
+                'proxies': proxies,
+                'pages_per_second': round(len(pages) / elapsed, 1),
+                'proxies_per_second': round(proxies / elapsed, 1),
+                'speedup': round(legacy_time / elapsed, 2),
+            })
+    return reports
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='爬虫页面解析的基准测试')
+    parser.add_argument('--rows', type=int, default=15, help='每个合成页面中的代理IP数量')
+    parser.add_argument('--pages', type=int, default=50, help='每个爬虫的合成页面数量')
+    parser.add_argument('--repeat', type=int, default=5, help='重复解析的轮数, 取最快的一轮')
+    parser.add_argument('--pages-dir', default='', help='保存的真实页面所在的目录, 指定时不再生成合成页面')
+    parser.add_argument('--seed', type=int, default=0, help='生成合成页面的随机数种子')
+    parser.add_argument('--json', action='store_true', help='以json格式输出报告')
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    reports = benchmark(args)
+    if args.json:
+        print(json.dumps(reports))
+    else:
+        for report in reports:
+            print('  '.join(f'{key}={value}' for key, value in report.items()))
@@ -0,0 +1,140 @@
+"""
+代理池快照的基准测试
+- 对比API工作进程获取代理IP的两种数据源, 工作进程数量增加时内存占用和刷新开销的变化:
+    - index: 每个工作进程从数据库全量加载自己的内存索引(ProxyIndex)
+    - snapshot: 快照发布进程加载一次并写入快照文件, 每个工作进程以mmap映射同一个快照(SnapshotReader)
+- 工作进程从模拟的数据库游标中读取代理IP(每次读取时才创建Proxy对象), 不需要MongoDB
+- 所有工作进程都加载完成后, 同时统计各自的PSS(按照共享进程数分摊的内存), 共享的页缓存只计算一次
+- 报告内容: 所有工作进程的PSS之和, 加载(刷新)的总耗时(snapshot包括发布一次的耗时), 每个工作进程每秒随机获取代理IP的次数
+- 每个工作进程都通过 python -m benchmark.bench_snapshot --role worker ... 启动
+用法:
+    python -m benchmark.bench_snapshot --proxies 100000 --workers 1 4 8
+"""
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+
+class CursorPool:
+    """模拟数据库游标的代理池, 每次读取时才创建Proxy对象, 本身不占用内存"""
+    def __init__(self, size, seed=0):
+        self.size = size
+        self.seed = seed
+
+    def find_updated_since(self, timestamp=None):
+        from model import Proxy
+        if timestamp is not None:
+            return
+        rand = random.Random(self.seed)
+        for i in range(self.size):
+            yield Proxy(f'10.{i // 65536 % 256}.{i // 256 % 256}.{i % 256}', str(rand.randint(80, 65535)),
+                        protocol=rand.choice([0, 1, 2]), nick_type=rand.choice([0, 0, 1]),
+                        speed=round(rand.uniform(0.1, 5), 2), area='北京市', score=rand.randint(40, 50)), None
+
+    def find_disabled_since(self, timestamp=None):
+        # 每10个代理IP中禁用一个访问jd.com
+        if timestamp is not None:
+            return
+        for i in range(0, self.size, 10):
+            yield 'jd.com', f'10.{i // 65536 % 256}.{i // 256 % 256}.{i % 256}', None
+
+
+def _pss_kb():
+    """当前进程的PSS(KB)"""
+    with open('/proc/self/smaps_rollup') as f:
+        for line in f:
+            if line.startswith('Pss:'):
+                return int(line.split()[1])
+    return 0
+
+
+def run_worker(args):
+    """工作进程: 加载数据源, 等待所有工作进程加载完成后统计PSS和随机获取代理IP的速度, 以一行json输出"""
+    from core.proxy_index import ProxyIndex
+    from core.pool_snapshot import SnapshotReader
+    before = _pss_kb()
+    start = time.perf_counter()
+    if args.source == 'index':
+        source = ProxyIndex(CursorPool(args.proxies, args.seed))
+        source.load_all()
+    else:
+        source = SnapshotReader(args.path)
+        source.attach()
+    load_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    for i in range(args.lookups):
+        source.get_random_proxy(protocol=('http', 'https', None)[i % 3], domain='jd.com' if i % 2 else None)
+    lookups_per_second = args.lookups / (time.perf_counter() - start)
+    print('ready', flush=True)
+    sys.stdin.readline()
+    print(json.dumps({'pss_kb': _pss_kb() - before, 'load_seconds': load_seconds,
+                      'lookups_per_second': lookups_per_second}), flush=True)
+
+
+def publish(args):
+    """加载一次内存索引并发布快照, 返回耗时"""
+    from core.pool_snapshot import SnapshotPublisher
+    start = time.perf_counter()
+    publisher = SnapshotPublisher(CursorPool(args.proxies, args.seed), path=args.path)
+    publisher.proxy_index.load_all()
+    size = publisher.publish()
+    return time.perf_counter() - start, size
+
+
+def benchmark(source, workers, args):
+    """启动workers个工作进程, 返回报告"""
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    publish_seconds, size = publish(args) if source == 'snapshot' else (0, 0)
+    command = [sys.executable, '-m', 'benchmark.bench_snapshot', '--role', 'worker', '--source', source,
+               '--proxies', str(args.proxies), '--seed', str(args.seed), '--lookups', str(args.lookups),
+               '--path', args.path]
+    processes = [subprocess.Popen(command, cwd=root, stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True)
+                 for _ in range(workers)]
+    for process in processes:
+        process.stdout.readline()
+    results = [json.loads(process.communicate('measure\n')[0]) for process in processes]
+    return {
+        'source': source,
+        'workers': workers,
+        'proxies': args.proxies,
+        'snapshot_mb': round(size / 1024 / 1024, 2),
+        'total_pss_mb': round(sum(result['pss_kb'] for result in results) / 1024, 1),
+        'total_load_seconds': round(publish_seconds + sum(result['load_seconds'] for result in results), 3),
+        'lookups_per_second': round(sum(result['lookups_per_second'] for result in results) / workers),
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='代理池快照的基准测试')
+    parser.add_argument('--role', choices=['compare', 'worker'], default='compare',
+                        help='compare: 依次测试每种数据源和工作进程数量并输出报告, worker由compare在子进程中使用')
+    parser.add_argument('--sources', nargs='+', choices=['index', 'snapshot'], default=['index', 'snapshot'],
+                        help='要测试的数据源')
+    parser.add_argument('--source', choices=['index', 'snapshot'], default='snapshot', help='工作进程使用的数据源')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 4, 8], help='工作进程的数量')
+    parser.add_argument('--proxies', type=int, default=100000, help='代理IP的数量')
+    parser.add_argument('--lookups', type=int, default=10000, help='每个工作进程随机获取代理IP的次数')
+    parser.add_argument('--seed', type=int, default=0, help='生成代理IP的随机数种子')
+    parser.add_argument('--path', default='', help='快照文件的路径, 由compare自动生成')
+    parser.add_argument('--json', action='store_true', help='以json格式输出报告')
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    if args.role == 'worker':
+        run_worker(args)
+    else:
+        with tempfile.TemporaryDirectory() as directory:
+            args.path = os.path.join(directory, 'proxies.snapshot')
+            reports = [benchmark(source, workers, args) for source in args.sources for workers in args.workers]
+        if args.json:
+            print(json.dumps(reports))
+        else:
+            for report in reports:
+                print('  '.join(f'{key}={value}' for key, value in report.items()))
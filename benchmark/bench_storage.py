@@ -0,0 +1,105 @@
+"""
+存储后端的基准测试
+- 对存储后端执行爬虫、检测、API用到的热点操作, 报告每种操作每秒执行的次数:
+    - insert: 爬虫模块以buffer_insert批量插入代理IP
+    - get_proxies: /proxies接口不使用内存索引时, 按照协议查询排名靠前的count个代理IP
+    - get_proxies_domain: 同上, 同时排除在指定域名下被禁用的代理IP
+    - get_random_proxy: /random接口不使用内存索引时, 按照权重随机选择一个代理IP
+    - find_due: 检测模块查询到期的代理IP
+    - update: 检测模块以buffer_update批量写入检测结果
+    - find_updated_since: API的内存索引全量加载
+- sqlite后端使用临时目录中的数据库文件, 不需要任何外部服务; mongo后端需要MONGO_URL指向的MongoDB, 会清空其中的代理IP
+用法:
+    python -m benchmark.bench_storage --backends sqlite --proxies 10000
+"""
+import argparse
+import json
+import os
+import random
+import tempfile
+import time
+from model import Proxy
+from settings import MAX_SCORE, MAX_PROXIES_RANGE
+
+
+def make_proxies(count, seed=0):
+    """生成count个代理IP"""
+    rand = random.Random(seed)
+    return [Proxy(f'10.{i // 65536 % 256}.{i // 256 % 256}.{i % 256}', str(rand.randint(80, 65535)),
+                  protocol=rand.choice([0, 1, 2]), nick_type=rand.choice([0, 0, 1, 2]),
+                  speed=round(rand.uniform(0.1, 5), 2), area='北京市', score=rand.randint(40, MAX_SCORE))
+            for i in range(count)]
+
+
+def create_backend(name, directory):
+    """创建一个空的存储后端"""
+    if name == 'sqlite':
+        from core.db.sqlite_pool import SqlitePool
+        return SqlitePool(os.path.join(directory, 'bench.db'))
+    from core.db.mongo_pool import MongoPool
+    pool = MongoPool()
+    pool.proxies.delete_many({})
+    pool.disabled_domains.delete_many({})
+    return pool
+
+
+def _rate(function, repeat):
+    """执行repeat次, 返回每秒执行的次数"""
+    start = time.perf_counter()
+    for i in range(repeat):
+        function(i)
+    return repeat / (time.perf_counter() - start)
+
+
+def benchmark(name, args, directory):
+    pool = create_backend(name, directory)
+    proxies = make_proxies(args.proxies, args.seed)
+    protocols = [None, 'http', 'https']
+    pool.disable_domains([(proxy.ip, 'jd.com') for proxy in proxies[::10]])
+
+    def insert(i):
+        for proxy in proxies:
+            pool.buffer_insert(proxy)
+        pool.flush()
+
+    def update(i):
+        for proxy in proxies:
+            pool.buffer_update(proxy, {'speed': proxy.speed, 'next_check': time.time() + 60}, touch=False)
+        pool.flush()
+
+    report = {'backend': name, 'proxies': args.proxies}
+    report['insert_per_second'] = _rate(insert, 1) * len(proxies)
+    report['get_proxies_per_second'] = _rate(
+        lambda i: pool.get_proxies(protocols[i % 3], count=MAX_PROXIES_RANGE), args.repeat)
+    report['get_proxies_domain_per_second'] = _rate(
+        lambda i: pool.get_proxies(protocols[i % 3], domain='jd.com', count=MAX_PROXIES_RANGE), args.repeat)
+    report['get_random_proxy_per_second'] = _rate(
+        lambda i: pool.get_random_proxy(protocols[i % 3]), max(args.repeat // 100, 1))
+    report['find_due_per_second'] = _rate(
+        lambda i: list(pool.find_due(count=200, now=time.time() + 86400)), args.repeat)
+    report['update_per_second'] = _rate(update, 1) * len(proxies)
+    report['find_updated_since_per_second'] = _rate(lambda i: list(pool.find_updated_since()), 3)
+    pool.close()
+    return {key: round(value) if isinstance(value, float) else value for key, value in report.items()}
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='存储后端的基准测试')
+    parser.add_argument('--backends', nargs='+', choices=['sqlite', 'mongo'], default=['sqlite'],
+                        help='要测试的存储后端, mongo需要运行MongoDB')
+    parser.add_argument('--proxies', type=int, default=10000, help='代理IP的数量')
+    parser.add_argument('--repeat', type=int, default=1000, help='每种查询执行的次数')
+    parser.add_argument('--seed', type=int, default=0, help='生成代理IP的随机数种子')
+    parser.add_argument('--json', action='store_true', help='以json格式输出报告')
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    with tempfile.TemporaryDirectory() as directory:
+        reports = [benchmark(name, args, directory) for name in args.backends]
+    if args.json:
+        print(json.dumps(reports))
+    else:
+        for report in reports:
+            print('  '.join(f'{key}={value}' for key, value in report.items()))
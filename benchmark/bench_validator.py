@@ -0,0 +1,275 @@
+"""
+校验模块的离线基准测试
+- 在本地启动裁判服务和一批模拟代理(见fake_servers.py), 不需要访问外网和httpbin.org
+- 测试对象(--target):
+    - check_proxy: 使用gevent协程池并发调用httpbin_validator.check_proxy, 并发数由--concurrency指定
+    - check_many: 使用async_validator.check_proxies, 全局并发请求数由--concurrency指定(需要安装aiohttp)
+    - tester: 对内存中的代理池执行一次ProxyTester.run, 使用的引擎由--engine指定
+- 报告内容: 每秒校验的代理数, 单个代理校验耗时的p50/p99, 校验过程中和结束后打开的socket数量, 进程内存(RSS)
+- 自适应超时时间(--adaptive): on/off分别开启和关闭probe_timeout.py中的自适应超时时间,
+  compare依次测试关闭和开启, 报告开启后每一轮校验(--sweeps)节省的时间; 多轮校验共用每个代理IP的响应时间统计
+- 裁判服务只提供http, 因此https检查也指向http的裁判地址, 模拟代理不会进行TLS握手
+用法:
+    python -m benchmark.bench_validator --target check_proxy --proxies 500 --concurrency 100 --timeout 3
+    python -m benchmark.bench_validator --target tester --adaptive compare --sweeps 2 --timeout 10
+"""
+from gevent import monkey
+monkey.patch_all()  # 打补丁, 和爬虫模块、检测模块一样让gevent识别耗时操作
+
+import argparse
+import json
+import os
+import threading
+import time
+from gevent.pool import Pool
+from benchmark.fake_servers import FleetConfig, start_fleet
+from core import proxy_test
+from core.proxy_validate import engine, httpbin_validator
+from core.proxy_validate.probe_timeout import probe_timeouts
+from model import Proxy
+
+
+class MemoryPool:
+    """只保存在内存中的代理池, 提供ProxyTester用到的数据库操作方法, 用于在没有MongoDB的情况下测试检测模块"""
+    def __init__(self, proxies):
+        self.proxies = {proxy.ip: proxy for proxy in proxies}
+        self.updated = 0
+        self.deleted = 0
+
+    def find_all(self, batch_size=0):
+        for proxy in self.proxies.values():
+            yield proxy.copy()
+
+    def buffer_update(self, proxy, fields, inc=None, touch=True):
+        self.updated += 1
+
+    def buffer_delete(self, proxy):
+        self.deleted += 1
+
+    def flush(self):
+        pass
+
+
+class ResourceSampler:
+    """后台定期采样当前进程打开的socket数量和内存(RSS), 记录峰值"""
+    def __init__(self, interval=0.02):
+        self.interval = interval
+        self.peak_sockets = 0
+        self.peak_rss = 0
+        self._running = False
+
+    @staticmethod
+    def count_sockets():
+        """统计当前进程打开的socket数量"""
+        count = 0
+        for fd in os.listdir('/proc/self/fd'):
+            try:
+                if os.readlink(f'/proc/self/fd/{fd}').startswith('socket:'):
+                    count += 1
+            except OSError:
+                pass
+        return count
+
+    @staticmethod
+    def rss():
+        """当前进程的内存(RSS), 单位为字节"""
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+    def _sample_forever(self):
+        while self._running:
+            self.peak_sockets = max(self.peak_sockets, self.count_sockets())
+            self.peak_rss = max(self.peak_rss, self.rss())
+            time.sleep(self.interval)
+
+    def __enter__(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._sample_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._running = False
+        self._thread.join()
+
+
+def _percentile(values, percent):
+    """计算百分位数"""
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percent / 100))]
+
+
+def configure_validator(judge_url, timeout, adaptive=True, unseen_timeout=None):
+    """让校验模块使用本地裁判服务和指定的超时时间, 并清空每个代理IP的响应时间统计"""
+    probe_timeouts.clear()
+    probe_timeouts.enabled = adaptive
+    if unseen_timeout is not None:
+        probe_timeouts.unseen_timeout = unseen_timeout
+    modules = [httpbin_validator]
+    try:
+        from core.proxy_validate import async_validator
+        modules.append(async_validator)
+    except ImportError:
+        pass
+    for module in modules:
+        module.VALIDATE_HTTP_URL = judge_url
+        module.VALIDATE_HTTPS_URL = judge_url
+        module.TIMEOUT = timeout
+
+
+def _timed(func, durations):
+    """记录每次校验一个代理IP的耗时"""
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            durations.append(time.perf_counter() - start)
+    return wrapper
+
+
+def _timed_async(func, durations):
+    """记录每次校验一个代理IP的耗时(协程版本)"""
+    async def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await func(*args, **kwargs)
+        finally:
+            durations.append(time.perf_counter() - start)
+    return wrapper
+
+
+def run_check_proxy(proxies, concurrency, durations):
+    """使用gevent协程池并发调用check_proxy"""
+    check = _timed(httpbin_validator.check_proxy, durations)
+    return list(Pool(concurrency).imap_unordered(check, proxies))
+
+
+def run_check_many(proxies, concurrency, durations):
+    """使用asyncio引擎并发校验"""
+    from core.proxy_validate import async_validator
+    check_one = async_validator.check_one
+    async_validator.check_one = _timed_async(check_one, durations)
+    try:
+        return list(async_validator.check_proxies(proxies, concurrency=concurrency))
+    finally:
+        async_validator.check_one = check_one
+
+
+def run_tester(proxies, engine_name, durations):
+    """对内存中的代理池执行一次ProxyTester.run"""
+    proxy_test.VALIDATE_ENGINE = engine.VALIDATE_ENGINE = engine_name
+    if engine_name == 'asyncio':
+        from core.proxy_validate import async_validator
+        async_validator.check_one = _timed_async(async_validator.check_one, durations)
+    else:
+        proxy_test.check_proxy = _timed(proxy_test.check_proxy, durations)
+    pool = MemoryPool(proxies)
+    proxy_test.ProxyTester(mongo_pool=pool).run()
+    return pool
+
+
+def benchmark(args, adaptive=True):
+    """启动模拟代理, 运行指定的测试对象args.sweeps轮, 返回报告"""
+    config = FleetConfig(size=args.proxies, latency=(args.min_latency, args.max_latency),
+                         failure_rate=args.failure_rate, blackhole_rate=args.blackhole_rate,
+                         dead_rate=args.dead_rate, seed=args.seed)
+    process, judge_port, fleet = start_fleet(config)
+    try:
+        configure_validator(f'http://127.0.0.1:{judge_port}/get', args.timeout, adaptive, args.unseen_timeout)
+        proxies = [Proxy(ip, str(port)) for ip, port, _ in fleet]
+        durations = []
+        sweep_seconds = []
+        sockets_before = ResourceSampler.count_sockets()
+        rss_before = ResourceSampler.rss()
+        with ResourceSampler() as sampler:
+            for _ in range(args.sweeps):
+                start = time.perf_counter()
+                if args.target == 'check_proxy':
+                    results = run_check_proxy(proxies, args.concurrency, durations)
+                    valid = sum(1 for proxy in results if proxy.speed != -1)
+                elif args.target == 'check_many':
+                    results = run_check_many(proxies, args.concurrency, durations)
+                    valid = sum(1 for proxy in results if proxy.speed != -1)
+                else:
+                    run_tester(proxies, args.engine, durations)
+                    valid = None
+                sweep_seconds.append(time.perf_counter() - start)
+        elapsed = sum(sweep_seconds)
+        return {
+            'target': args.target if args.target != 'tester' else f'tester({args.engine})',
+            'adaptive': adaptive,
+            'proxies': len(proxies),
+            'alive_in_fleet': sum(1 for _, _, behaviour in fleet if behaviour['kind'] == 'alive'),
+            'valid': valid,
+            'elapsed_seconds': round(elapsed, 3),
+            'sweep_seconds': [round(seconds, 3) for seconds in sweep_seconds],
+            'proxies_per_second': round(len(proxies) * args.sweeps / elapsed, 1),
+            'p50_seconds': round(_percentile(durations, 50), 3),
+            'p99_seconds': round(_percentile(durations, 99), 3),
+            'peak_open_sockets': sampler.peak_sockets - sockets_before,
+            'open_sockets_after': ResourceSampler.count_sockets() - sockets_before,
+            'peak_rss_mb': round(sampler.peak_rss / 1024 / 1024, 1),
+            'rss_growth_mb': round((ResourceSampler.rss() - rss_before) / 1024 / 1024, 1),
+        }
+    finally:
+        process.terminate()
+
+
+def compare(args):
+    """依次测试关闭和开启自适应超时时间, 返回两份报告和每一轮节省的时间"""
+    off = benchmark(args, adaptive=False)
+    on = benchmark(args, adaptive=True)
+    saved = [round(before - after, 3) for before, after in zip(off['sweep_seconds'], on['sweep_seconds'])]
+    return {
+        'off': off,
+        'on': on,
+        'saved_seconds': saved,
+        'saved_percent': [round(100 * value / before, 1) if before else 0
+                          for value, before in zip(saved, off['sweep_seconds'])],
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='校验模块的离线基准测试')
+    parser.add_argument('--target', choices=['check_proxy', 'check_many', 'tester'], default='check_proxy')
+    parser.add_argument('--engine', choices=['gevent', 'asyncio'], default='gevent', help='tester使用的校验引擎')
+    parser.add_argument('--proxies', type=int, default=200, help='模拟代理的数量')
+    parser.add_argument('--concurrency', type=int, default=100, help='并发数')
+    parser.add_argument('--timeout', type=float, default=3, help='校验请求的超时时间(秒), 开启自适应超时时间时为最大值')
+    parser.add_argument('--adaptive', choices=['on', 'off', 'compare'], default='on',
+                        help='是否开启自适应超时时间, compare表示依次测试关闭和开启并比较每一轮的耗时')
+    parser.add_argument('--unseen-timeout', type=float, default=None,
+                        help='从来没有校验成功过的代理IP的超时时间(秒), 默认值为配置文件中的VALIDATE_TIMEOUT_UNSEEN')
+    parser.add_argument('--sweeps', type=int, default=1, help='校验的轮数, 后面几轮使用前面几轮记录的响应时间')
+    parser.add_argument('--min-latency', type=float, default=0.05, help='可用代理的最小延迟(秒)')
+    parser.add_argument('--max-latency', type=float, default=0.5, help='可用代理的最大延迟(秒)')
+    parser.add_argument('--failure-rate', type=float, default=0.1, help='可用代理每次请求返回502的概率')
+    parser.add_argument('--blackhole-rate', type=float, default=0.2, help='永远不响应的代理的比例')
+    parser.add_argument('--dead-rate', type=float, default=0.3, help='拒绝连接的代理的比例')
+    parser.add_argument('--seed', type=int, default=0, help='生成模拟代理的随机数种子')
+    parser.add_argument('--json', action='store_true', help='以json格式输出报告')
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    # 本地的模拟代理不能被环境变量中的代理配置绕过
+    for name in ('NO_PROXY', 'no_proxy', 'HTTP_PROXY', 'http_proxy', 'HTTPS_PROXY', 'https_proxy'):
+        os.environ.pop(name, None)
+    args = parse_args()
+    if args.adaptive == 'compare':
+        report = compare(args)
+    else:
+        report = benchmark(args, adaptive=args.adaptive == 'on')
+    if args.json:
+        print(json.dumps(report))
+    elif args.adaptive == 'compare':
+        for key in report['off']:
+            print(f'{key:>20}: {report["off"][key]}  ->  {report["on"][key]}')
+        print(f'{"saved_seconds":>20}: {report["saved_seconds"]}')
+        print(f'{"saved_percent":>20}: {report["saved_percent"]}')
+    else:
+        for key, value in report.items():
+            print(f'{key:>20}: {value}')
@@ -0,0 +1,196 @@
+"""
+基准测试使用的本地服务
+- 裁判服务(judge): 代替httpbin.org的/get接口, 返回请求的来源IP(origin)和请求头(headers), 格式和校验模块期望的一致
+- 模拟代理(fake proxy): 转发请求到裁判服务, 每个代理可以配置
+    - latency: 响应延迟(秒)
+    - failure_rate: 返回502的概率
+    - blackhole: 接受连接但是永远不响应, 模拟需要等待超时的失效代理
+    - anonymity: 匿名类型, elite(高匿), anonymous(匿名, 转发Proxy-Connection请求头), transparent(透明, 添加X-Forwarded-For请求头)
+- 另外还可以生成一些没有服务监听的端口, 模拟直接拒绝连接的失效代理
+- 所有服务在一个独立的子进程中运行(不受基准测试进程中gevent打补丁的影响), 启动后把端口信息以一行json输出到标准输出
+"""
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+from urllib.parse import urlsplit
+
+# 透明代理添加的X-Forwarded-For中的客户端IP
+CLIENT_IP = '10.0.0.1'
+
+
+class FleetConfig:
+    def __init__(self, size=200, latency=(0.05, 0.5), failure_rate=0.1, blackhole_rate=0.2, dead_rate=0.3,
+                 anonymity=(('elite', 0.6), ('anonymous', 0.2), ('transparent', 0.2)), seed=0):
+        """模拟代理的配置
+        :param size: 模拟代理的数量(包括拒绝连接的失效代理)
+        :param latency: 可用代理的响应延迟范围(秒), 在范围内均匀随机
+        :param failure_rate: 可用代理每次请求返回502的概率
+        :param blackhole_rate: 永远不响应的代理的比例
+        :param dead_rate: 直接拒绝连接的代理的比例
+        :param anonymity: 匿名类型和对应的比例
+        :param seed: 随机数种子, 保证每次生成的代理相同
+        """
+        self.size = size
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.blackhole_rate = blackhole_rate
+        self.dead_rate = dead_rate
+        self.anonymity = anonymity
+        self.seed = seed
+
+    def to_json(self):
+        return json.dumps(self.__dict__)
+
+    @classmethod
+    def from_json(cls, text):
+        return cls(**json.loads(text))
+
+    def behaviours(self):
+        """按照配置生成每个模拟代理的行为"""
+        rand = random.Random(self.seed)
+        names, weights = zip(*self.anonymity)
+        behaviours = []
+        for _ in range(self.size):
+            value = rand.random()
+            if value < self.dead_rate:
+                kind = 'dead'
+            elif value < self.dead_rate + self.blackhole_rate:
+                kind = 'blackhole'
+            else:
+                kind = 'alive'
+            behaviours.append({
+                'kind': kind,
+                'latency': rand.uniform(*self.latency),
+                'failure_rate': self.failure_rate,
+                'anonymity': rand.choices(names, weights)[0],
+            })
+        return behaviours
+
+
+async def _read_head(reader):
+    """读取请求行和请求头, 返回(请求行, 请求头列表)"""
+    head = await reader.readuntil(b'\r\n\r\n')
+    request_line, *header_lines = head.decode('latin-1').split('\r\n')
+    return request_line, [line for line in header_lines if line]
+
+
+async def _handle_judge(reader, writer):
+    """裁判服务: 返回请求的来源IP和请求头"""
+    try:
+        _, header_lines = await _read_head(reader)
+        headers = dict(line.split(': ', 1) for line in header_lines)
+        origin = writer.get_extra_info('peername')[0]
+        # 经过透明代理时, 和httpbin一样把X-Forwarded-For中的IP加到origin中
+        if 'X-Forwarded-For' in headers:
+            origin = f"{headers['X-Forwarded-For']}, {origin}"
+        body = json.dumps({'origin': origin, 'headers': headers}).encode()
+        writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: application/json\r\nConnection: close\r\n'
+                     b'Content-Length: %d\r\n\r\n' % len(body) + body)
+        await writer.drain()
+    except (asyncio.IncompleteReadError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+async def _relay(reader, writer):
+    """把reader读到的数据原样写入writer, 直到对端关闭连接"""
+    try:
+        while data := await reader.read(65536):
+            writer.write(data)
+            await writer.drain()
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+
+def _make_proxy_handler(behaviour):
+    """根据行为配置, 创建一个模拟代理的连接处理函数"""
+    async def handle(reader, writer):
+        try:
+            request_line, header_lines = await _read_head(reader)
+            # 永远不响应, 直到客户端超时关闭连接
+            if behaviour['kind'] == 'blackhole':
+                await reader.read()
+                return
+            await asyncio.sleep(behaviour['latency'])
+            if random.random() < behaviour['failure_rate']:
+                writer.write(b'HTTP/1.1 502 Bad Gateway\r\nContent-Length: 0\r\nConnection: close\r\n\r\n')
+                await writer.drain()
+                return
+            method, target, _ = request_line.split(' ')
+            # https请求: 建立到目标地址的隧道
+            if method == 'CONNECT':
+                host, port = target.rsplit(':', 1)
+                upstream_reader, upstream_writer = await asyncio.open_connection(host, int(port))
+                writer.write(b'HTTP/1.1 200 Connection Established\r\n\r\n')
+                await asyncio.gather(_relay(reader, upstream_writer), _relay(upstream_reader, writer))
+                return
+            # http请求: 根据匿名类型修改请求头后转发到目标地址
+            url = urlsplit(target)
+            headers = [line for line in header_lines
+                       if not line.lower().startswith(('proxy-connection:', 'connection:'))]
+            if behaviour['anonymity'] == 'transparent':
+                headers.append(f'X-Forwarded-For: {CLIENT_IP}')
+            elif behaviour['anonymity'] == 'anonymous':
+                headers.append('Proxy-Connection: keep-alive')
+            headers.append('Connection: close')
+            upstream_reader, upstream_writer = await asyncio.open_connection(url.hostname, url.port or 80)
+            path = url.path + (f'?{url.query}' if url.query else '')
+            request = f'{method} {path} HTTP/1.1\r\n' + ''.join(f'{line}\r\n' for line in headers) + '\r\n'
+            upstream_writer.write(request.encode('latin-1'))
+            await upstream_writer.drain()
+            await _relay(upstream_reader, writer)
+            upstream_writer.close()
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+    return handle
+
+
+def _proxy_ip(index):
+    """第index个模拟代理的IP, 每个模拟代理监听127.0.0.0/8中不同的地址, 和真实的代理池一样以IP区分代理"""
+    return f'127.1.{index // 250}.{index % 250 + 1}'
+
+
+def _unused_port(ip):
+    """获取一个当前没有服务监听的端口, 用于模拟拒绝连接的代理"""
+    with socket.socket() as sock:
+        sock.bind((ip, 0))
+        return sock.getsockname()[1]
+
+
+async def _serve(config):
+    """启动裁判服务和所有模拟代理, 把端口信息输出到标准输出, 然后一直运行"""
+    judge = await asyncio.start_server(_handle_judge, '127.0.0.1', 0, backlog=1024)
+    proxies = []
+    for index, behaviour in enumerate(config.behaviours()):
+        ip = _proxy_ip(index)
+        if behaviour['kind'] == 'dead':
+            proxies.append((ip, _unused_port(ip), behaviour))
+            continue
+        server = await asyncio.start_server(_make_proxy_handler(behaviour), ip, 0, backlog=1024)
+        proxies.append((ip, server.sockets[0].getsockname()[1], behaviour))
+    print(json.dumps({'judge_port': judge.sockets[0].getsockname()[1], 'proxies': proxies}), flush=True)
+    await asyncio.Event().wait()
+
+
+def start_fleet(config):
+    """在独立的子进程中启动裁判服务和模拟代理
+    :return: (子进程对象, 裁判服务端口, [(代理IP, 代理端口, 行为配置), ...]), 使用完毕后调用子进程对象的terminate方法结束
+    """
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    process = subprocess.Popen([sys.executable, '-m', 'benchmark.fake_servers', config.to_json()],
+                               cwd=root, stdout=subprocess.PIPE, text=True)
+    info = json.loads(process.stdout.readline())
+    return process, info['judge_port'], info['proxies']
+
+
+if __name__ == '__main__':
+    asyncio.run(_serve(FleetConfig.from_json(sys.argv[1])))
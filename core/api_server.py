@@ -0,0 +1,103 @@
+"""
+Web API 的生产环境服务模式
+- 作用: 代替Flask自带的开发服务器, 使用gevent的WSGIServer提供服务, 每个连接由一个协程处理
+- 实现:
+  1. 主进程创建监听socket(backlog由API_BACKLOG指定), 然后fork出API_WORKERS个工作进程共享这个socket
+  2. 每个工作进程在fork之后创建自己的ProxyApi对象(数据库连接、内存索引), 运行WSGIServer
+  3. 支持HTTP/1.1长连接, 连接空闲超过API_KEEPALIVE_SECONDS秒后关闭, 设置为0时每个连接只处理一个请求
+  4. 主进程监控工作进程, 工作进程意外退出时重新fork一个; 主进程收到SIGTERM/SIGINT时结束所有工作进程
+"""
+import os
+import signal
+import socket
+from gevent.pywsgi import WSGIServer, WSGIHandler
+from settings import API_KEEPALIVE_SECONDS, API_BACKLOG
+from utils.log import logger
+
+
+class KeepAliveHandler(WSGIHandler):
+    """限制长连接空闲时间的请求处理类"""
+    # 连接上一个请求处理完之后, 等待下一个请求的最长时间(秒), 0表示不保持长连接
+    keepalive = API_KEEPALIVE_SECONDS
+
+    def read_requestline(self):
+        # 连接上的第一个请求不限制等待时间, 之后的请求限制空闲时间
+        # 超时引发的socket.timeout由handle_one_request处理, 连接会被关闭
+        if getattr(self, '_handled_requests', 0):
+            if self.keepalive <= 0:
+                return ''
+            self.socket.settimeout(self.keepalive)
+        self._handled_requests = getattr(self, '_handled_requests', 0) + 1
+        line = super().read_requestline()
+        self.socket.settimeout(None)
+        return line
+
+
+def create_listener(host, port, backlog=API_BACKLOG):
+    """创建监听socket, 在fork工作进程之前调用, 所有工作进程共享这个socket"""
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind((host, port))
+    listener.listen(backlog)
+    return listener
+
+
+def serve_forever(listener, app, keepalive=API_KEEPALIVE_SECONDS):
+    """在当前进程中使用WSGIServer提供服务, 不记录访问日志, 错误仍然输出到标准错误"""
+    handler_class = type('KeepAliveHandler', (KeepAliveHandler,), {'keepalive': keepalive})
+    server = WSGIServer(listener, app, handler_class=handler_class, log=None)
+    server.serve_forever()
+
+
+def run_workers(worker, workers):
+    """fork出workers个工作进程运行worker函数, 并一直监控它们
+    :param worker: 工作进程中执行的函数, 通常是创建ProxyApi对象并调用serve_forever
+    :param workers: 工作进程的数量
+    """
+    children = set()
+    stopping = False
+
+    def spawn():
+        pid = os.fork()
+        if pid == 0:
+            # 工作进程: 恢复默认的信号处理, 运行结束或出错时直接退出, 不执行主进程的清理逻辑
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            code = 0
+            try:
+                worker()
+            except Exception as e:
+                logger.exception(e)
+                code = 1
+            finally:
+                os._exit(code)
+        children.add(pid)
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for _ in range(workers):
+        spawn()
+    while children:
+        try:
+            pid, _ = os.waitpid(-1, 0)
+        except ChildProcessError:
+            break
+        except InterruptedError:
+            continue
+        # gevent的子进程监控可能重复返回同一个已经退出的进程
+        if pid not in children:
+            continue
+        children.remove(pid)
+        # 工作进程意外退出时, 重新fork一个
+        if not stopping:
+            logger.warning(f'API工作进程{pid}退出, 重新启动')
+            spawn()
@@ -0,0 +1,29 @@
+"""
+代理IP的检测调度策略
+- 每个代理IP在数据库中保存上次检测时间(last_checked)和下次检测时间(next_check)
+- 检测模块持续按照next_check从早到晚检测到期的代理IP, 检测后根据结果计算新的next_check
+- 检测间隔:
+  1. 满分且没有被API提供过的代理IP, 间隔为CHECK_INTERVAL_SECONDS
+  2. 连续失败的次数越多(分数越低), 间隔越短, 尽快确认它是否已经失效
+  3. 自上次检测以来被API提供的次数越多, 间隔越短, 保证常用的代理IP更新鲜
+  4. 限制在CHECK_INTERVAL_MIN_SECONDS和CHECK_INTERVAL_MAX_SECONDS之间
+"""
+import time
+from settings import MAX_SCORE, CHECK_INTERVAL_SECONDS, CHECK_INTERVAL_MIN_SECONDS, CHECK_INTERVAL_MAX_SECONDS
+from settings import CHECK_SERVED_HALF
+
+
+def get_check_interval(score, served=0):
+    """计算代理IP的检测间隔(秒)
+    :param score: 代理IP当前的分数, 满分减去分数即为连续失败的次数
+    :param served: 自上次检测以来被API提供的次数
+    """
+    failures = max(MAX_SCORE - score, 0)
+    interval = CHECK_INTERVAL_SECONDS / (1 + failures) / (1 + served / CHECK_SERVED_HALF)
+    return min(max(interval, CHECK_INTERVAL_MIN_SECONDS), CHECK_INTERVAL_MAX_SECONDS)
+
+
+def get_schedule_fields(score, served=0, now=None):
+    """返回检测后需要写入数据库的调度字段: 上次检测时间和下次检测时间"""
+    now = time.time() if now is None else now
+    return {'last_checked': now, 'next_check': now + get_check_interval(score, served)}
@@ -0,0 +1,88 @@
+"""
+批量写入模块
+- 作用: 缓冲对集合的写操作, 以一次无序的bulk_write批量写入数据库, 减少数据库的往返次数
+- 触发写入的时机:
+  1. 缓冲区中的操作数量达到BULK_WRITE_BATCH_SIZE
+  2. 距离上次写入超过BULK_WRITE_FLUSH_SECONDS秒(由后台线程定期检查)
+  3. 调用方主动调用flush方法, 例如一轮爬取或检测结束时
+- 写入时间: 操作在缓冲区中最多等待约1.5 * BULK_WRITE_FLUSH_SECONDS秒, 远远超过API内存索引增量拉取的重叠时间,
+  因此updated_at等时间戳不能在放入缓冲区时生成; 需要时间戳的操作以接收写入时间的函数放入缓冲区, 在写入时才生成
+"""
+import threading
+import time
+from pymongo.errors import BulkWriteError
+from settings import BULK_WRITE_BATCH_SIZE, BULK_WRITE_FLUSH_SECONDS
+from utils.log import logger
+from utils import metrics
+
+
+class BulkWriter:
+    def __init__(self, collection, batch_size=BULK_WRITE_BATCH_SIZE, flush_seconds=BULK_WRITE_FLUSH_SECONDS):
+        """初始化方法
+        :param collection: 要写入的集合
+        :param batch_size: 缓冲区中的操作达到这个数量就立即写入
+        :param flush_seconds: 缓冲区中的操作最多等待的时间(秒)
+        """
+        self.collection = collection
+        self.batch_size = batch_size
+        self.flush_seconds = flush_seconds
+        # 缓冲区, 保存待写入的操作
+        self._operations = []
+        # 保护缓冲区的锁, 多个协程可能同时写入
+        self._lock = threading.Lock()
+        # 上一次写入的时间
+        self._last_flush = time.time()
+        # 定时写入的后台线程, 第一次添加操作时才启动
+        self._flush_thread = None
+        # 已经执行的批量写入次数, 用于判断集合中的数据是否可能发生了变化
+        self.flushes = 0
+
+    def add(self, operation):
+        """把一个写操作(pymongo.UpdateOne、DeleteOne等)放入缓冲区, 数量达到batch_size时立即写入
+        :param operation: 写操作, 或者接收写入时间的时间戳、返回写操作的函数
+        """
+        with self._lock:
+            self._operations.append(operation)
+            full = len(self._operations) >= self.batch_size
+            if self._flush_thread is None:
+                self._flush_thread = threading.Thread(target=self._flush_forever, daemon=True)
+                self._flush_thread.start()
+        if full:
+            self.flush()
+
+    def flush(self):
+        """把缓冲区中的所有操作以一次无序的bulk_write写入数据库
+        :return: 返回BulkWriteResult, 缓冲区为空或写入出错时返回None
+        """
+        with self._lock:
+            operations, self._operations = self._operations, []
+            self._last_flush = time.time()
+        if not operations:
+            return None
+        # 需要时间戳的操作在写入时才生成, 使updated_at不早于写入数据库的时间
+        now = time.time()
+        operations = [operation(now) if callable(operation) else operation for operation in operations]
+        metrics.inc('mongo_bulk_write_operations_total', len(operations), collection=self.collection.name)
+        try:
+            # 无序写入: 单个操作失败不影响其他操作, 数据库也可以并行执行
+            with metrics.timer('mongo_bulk_write_seconds', collection=self.collection.name):
+                return self.collection.bulk_write(operations, ordered=False)
+        except BulkWriteError as e:
+            logger.error(f'bulk write error: {e.details.get("writeErrors")}')
+            return None
+        finally:
+            # 部分操作失败时, 其他操作仍然可能已经写入
+            self.flushes += 1
+
+    def _flush_forever(self):
+        """后台线程: 距离上次写入超过flush_seconds时, 写入缓冲区中的操作"""
+        while True:
+            time.sleep(self.flush_seconds / 2)
+            if self._operations and time.time() - self._last_flush >= self.flush_seconds:
+                try:
+                    self.flush()
+                except Exception as e:
+                    logger.exception(e)
+
+    def __len__(self):
+        return len(self._operations)
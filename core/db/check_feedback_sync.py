@@ -0,0 +1,69 @@
+"""
+检查多个工作进程同步爬虫反馈之后的统计是否完全相同
+- 两个ProxyFeedback对象模拟两个API工作进程, 共用同一个数据库: 工作进程A收到一批失败的反馈, 工作进程B收到一批成功的反馈,
+  然后按照A、B、A的顺序交错写入和拉取, 最后比较两个工作进程中这个(域名, 代理IP)的统计和排序依据
+- 反馈的次数要超过FEEDBACK_MIN_SAMPLES, 统计才会参与排序
+- 默认使用临时目录中的SQLite数据库; 指定--backend时使用配置的存储后端, 只写入TEST-NET地址(192.0.2.0/24)的反馈,
+  反馈计数在FEEDBACK_EXPIRE_SECONDS秒后自动到期
+- 检查不通过时以非0状态码退出, 可以在部署或CI中运行: python -m core.db.check_feedback_sync
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+from core.proxy_feedback import ProxyFeedback
+from settings import FEEDBACK_MIN_SAMPLES, FEEDBACK_RANK_SECONDS
+
+# 检查使用的代理IP, 不会和真实的代理IP重复
+TEST_IP = '192.0.2.2'
+# 检查反馈使用的域名
+TEST_DOMAIN = 'check-feedback-sync.example'
+
+
+def _stats(feedback):
+    """返回工作进程中检查使用的(域名, 代理IP)的统计(成功率, 延迟, 反馈次数)和排序依据"""
+    stat = feedback._stats.get(TEST_DOMAIN, {}).get(TEST_IP)
+    stat = None if stat is None else tuple(stat[:3])
+    return stat, feedback.rankings(TEST_DOMAIN).get(TEST_IP)
+
+
+def check_feedback_sync(mongo_pool, samples=FEEDBACK_MIN_SAMPLES * 3):
+    """两个工作进程收到相反的反馈, 交错同步之后比较统计, 返回检查不通过的项目名称列表"""
+    worker_a, worker_b = ProxyFeedback(mongo_pool), ProxyFeedback(mongo_pool)
+    worker_a.record([(TEST_IP, TEST_DOMAIN, False, None)] * samples)
+    worker_b.record([(TEST_IP, TEST_DOMAIN, True, 0.5)] * samples)
+    for worker in (worker_a, worker_b, worker_a):
+        worker.flush()
+    # 等待数据版本增大, 让排序依据重新计算
+    time.sleep(FEEDBACK_RANK_SECONDS)
+    stats_a, stats_b = _stats(worker_a), _stats(worker_b)
+    print(f'worker A: {stats_a}')
+    print(f'worker B: {stats_b}')
+    checks = [
+        ('samples', None not in (stats_a[0], stats_b[0]) and stats_a[0][2] == stats_b[0][2] == samples * 2),
+        ('identical', stats_a == stats_b),
+    ]
+    failed = []
+    for name, ok in checks:
+        print(f"{'OK  ' if ok else 'FAIL'} {name}")
+        if not ok:
+            failed.append(name)
+    return failed
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='检查多个工作进程同步爬虫反馈之后的统计是否完全相同')
+    parser.add_argument('--backend', choices=['sqlite', 'mongo'], default=None,
+                        help='使用配置的存储后端, 默认使用临时目录中的SQLite数据库')
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    if args.backend:
+        from core.db.storage import create_pool
+        sys.exit(1 if check_feedback_sync(create_pool(args.backend)) else 0)
+    from core.db.sqlite_pool import SqlitePool
+    with tempfile.TemporaryDirectory() as directory:
+        sys.exit(1 if check_feedback_sync(SqlitePool(os.path.join(directory, 'check.db'))) else 0)
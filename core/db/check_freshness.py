@@ -0,0 +1,84 @@
+"""
+检查批量写入的修改能否被API的内存索引增量拉取到
+- 放入缓冲区的操作要等待一段时间才写入数据库, 这里模拟最坏的情况: 放入缓冲区之后, 先经过超过重叠时间的一次增量拉取,
+  然后才写入数据库, 再检查下一次增量拉取(ProxyIndex.refresh)是否拉取到了这个修改
+- 默认使用临时目录中的SQLite数据库; 指定--backend时使用配置的存储后端, 只读写TEST-NET地址(192.0.2.0/24)的代理IP,
+  检查结束后删除
+- 检查不通过时以非0状态码退出, 可以在部署或CI中运行: python -m core.db.check_freshness
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+from core.proxy_index import ProxyIndex
+from model import Proxy
+from settings import PROXY_INDEX_OVERLAP_SECONDS
+
+# 检查使用的代理IP, 不会和真实的代理IP重复
+TEST_IP = '192.0.2.1'
+# 检查禁用记录使用的域名
+TEST_DOMAIN = 'check-freshness.example'
+
+
+def _indexed(proxy_index):
+    """返回内存索引中检查使用的代理IP, 不存在时返回None"""
+    return next((proxy for proxy in proxy_index.get_proxies() if proxy.ip == TEST_IP), None)
+
+
+def _disabled(proxy_index):
+    """检查使用的代理IP是否在检查使用的域名下被禁用"""
+    return all(proxy.ip != TEST_IP for proxy in proxy_index.get_proxies(domain=TEST_DOMAIN))
+
+
+def _delayed_write(mongo_pool, proxy_index, buffer):
+    """把操作放入缓冲区, 经过重叠时间之后增量拉取一次, 然后写入数据库, 再增量拉取一次"""
+    buffer()
+    time.sleep(PROXY_INDEX_OVERLAP_SECONDS + 1)
+    proxy_index.refresh()
+    mongo_pool.flush()
+    proxy_index.refresh()
+
+
+def check_freshness(mongo_pool):
+    """依次检查缓冲区中的修改, 返回检查不通过的项目名称列表"""
+    proxy = Proxy(TEST_IP, '8080', protocol=2, nick_type=0, speed=1.0, score=30)
+    proxy_index = ProxyIndex(mongo_pool)
+    proxy_index.load_all()
+
+    checks = [
+        ('buffer_insert', lambda: mongo_pool.buffer_insert(proxy), lambda: _indexed(proxy_index) is not None),
+        ('buffer_update', lambda: mongo_pool.buffer_update(proxy, {'speed': 0.5}),
+         lambda: getattr(_indexed(proxy_index), 'speed', None) == 0.5),
+        ('buffer_disable_domain', lambda: mongo_pool.buffer_disable_domain(TEST_IP, TEST_DOMAIN, expire_hours=1),
+         lambda: _disabled(proxy_index)),
+        ('buffer_delete', lambda: mongo_pool.buffer_delete(proxy), lambda: _indexed(proxy_index) is None),
+    ]
+    failed = []
+    try:
+        for name, buffer, check in checks:
+            _delayed_write(mongo_pool, proxy_index, buffer)
+            ok = check()
+            print(f"{'OK  ' if ok else 'FAIL'} {name}")
+            if not ok:
+                failed.append(name)
+    finally:
+        mongo_pool.delete_one(proxy)
+    return failed
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='检查批量写入的修改能否被API的内存索引增量拉取到')
+    parser.add_argument('--backend', choices=['sqlite', 'mongo'], default=None,
+                        help='使用配置的存储后端, 默认使用临时目录中的SQLite数据库')
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    if args.backend:
+        from core.db.storage import create_pool
+        sys.exit(1 if check_freshness(create_pool(args.backend)) else 0)
+    from core.db.sqlite_pool import SqlitePool
+    with tempfile.TemporaryDirectory() as directory:
+        sys.exit(1 if check_freshness(SqlitePool(os.path.join(directory, 'check.db'))) else 0)
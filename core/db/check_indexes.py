@@ -0,0 +1,27 @@
+"""
+检查热点查询的执行计划
+- 使用存储后端的explain_hot_queries()获取/random和/proxies使用的查询的执行计划
+- 所有查询都必须使用索引并由索引完成排序, 不指定域名的get_random_proxy查询还必须被索引覆盖
+- 检查不通过时以非0状态码退出, 可以在部署或CI中运行: python -m core.db.check_indexes
+"""
+import sys
+from core.db.storage import create_pool
+from settings import MAX_PROXIES_RANGE
+
+
+def check_indexes(mongo_pool):
+    """检查热点查询的执行计划, 返回检查不通过的查询名称列表"""
+    failed = []
+    for result in mongo_pool.explain_hot_queries(count=MAX_PROXIES_RANGE):
+        ok = result['indexed'] and result['sorted']
+        # 不指定域名时, 随机获取代理IP的查询只需要索引中的字段
+        if result['name'].startswith('get_random_proxy'):
+            ok = ok and result['covered']
+        print(f"{'OK  ' if ok else 'FAIL'} {result['name']}: {' <- '.join(result['stages'])} {result['indexes']}")
+        if not ok:
+            failed.append(result['name'])
+    return failed
+
+
+if __name__ == '__main__':
+    sys.exit(1 if check_indexes(create_pool()) else 0)
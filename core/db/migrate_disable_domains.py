@@ -0,0 +1,13 @@
+"""
+迁移旧数据中的不可用域名
+- 旧版本把不可用域名保存在每个代理IP文档的disable_domains列表中, 现在保存在disabled_domains集合中
+- 把所有disable_domains列表迁移到disabled_domains集合, 然后从代理IP文档中删除这个列表, 重复运行没有副作用
+- 迁移后的禁用记录和新的禁用记录一样, 在DISABLE_DOMAIN_EXPIRE_HOURS小时后到期
+- 升级后运行一次: python -m core.db.migrate_disable_domains
+"""
+from core.db.mongo_pool import MongoPool
+
+
+if __name__ == '__main__':
+    mongo_pool = MongoPool()
+    print(f'migrated {mongo_pool.migrate_disable_domains()} disabled domains')
@@ -1,4 +1,3 @@
-import random
 """
 代理池数据库模块 
 - 作用: 用于对proxies集合进行数据库的相关操作
@@ -13,21 +12,118 @@ import random
   7. 实现删除功能: 根据代理的IP删除代理
   8. 实现根据协议类型 和 要访问网站的域名, 获取代理IP列表
   9. 实现根据协议类型 和 要访问完整的域名, 随机获取一个代理IP
+  10. 每次写入时记录updated_at, 实现根据updated_at增量查询变化的代理IP, 供API的内存索引使用
+  11. 初始化时自动创建热点查询需要的索引, 并提供基于explain()的检查, 确认热点查询都使用了索引
+  12. 实现批量插入功能: 先放入缓冲区, 再以一次无序的bulk_write批量upsert
+  13. 实现批量修改和批量删除功能: 修改时只写入发生变化的字段
+  14. 实现按照下次检测时间(next_check)查询到期的代理IP, 供检测模块持续检测
+  15. 不可用域名保存在单独的disabled_domains集合中(域名 -> 被禁用的代理IP), 到期后由TTL索引自动删除,
+      指定域名查询时先取出该域名禁用的代理IP集合, 再从查询结果中排除
+  16. 实现批量禁用功能: 多个(ip, 域名)以一次无序的bulk_write写入, 也可以先放入缓冲区延后写入
+  17. 统计每种数据库操作的耗时(utils/metrics.py), 返回生成器的操作只统计读取数据库和转换的时间
+  18. 实现core/db/storage.py中的存储接口, 随机选择代理IP等和存储后端无关的逻辑由Storage类实现
+  19. 爬虫反馈的计数保存在单独的proxy_feedback集合中, 以(域名, ip)为键批量upsert并累加计数, 到期后由TTL索引自动删除
+  20. 删除代理IP时在deleted_proxies集合中写入删除记录, 供API的内存索引增量清除, 到期后由TTL索引自动删除
 """
+import datetime
+import time
 import pymongo
+from pymongo.errors import BulkWriteError
+from core.db.bulk_writer import BulkWriter
+from core.check_schedule import get_schedule_fields
+from core.db.storage import Storage, get_protocols, RANDOM_PROXY_PROJECTION, WEIGHTED_PROXY_PROJECTION
 from model import Proxy
 from settings import MONGO_URL, DATABASE, COLLECTION
+from settings import DISABLED_DOMAINS_COLLECTION, DISABLE_DOMAIN_EXPIRE_HOURS
+from settings import FEEDBACK_COLLECTION, FEEDBACK_EXPIRE_SECONDS
+from settings import DELETED_PROXIES_COLLECTION, DELETED_PROXY_EXPIRE_SECONDS
 from utils.log import logger
+from utils import metrics
 
-class MongoPool:
+# 与get_proxies的查询条件和排序一致的复合索引: 等值条件nick_type、protocol在前, 排序字段score、speed在后
+# 末尾附带ip和port, 使只返回ip、port、protocol的查询不需要回表读取文档
+PROXIES_QUERY_INDEX = [
+    ('nick_type', pymongo.ASCENDING),
+    ('protocol', pymongo.ASCENDING),
+    ('score', pymongo.DESCENDING),
+    ('speed', pymongo.ASCENDING),
+    ('ip', pymongo.ASCENDING),
+    ('port', pymongo.ASCENDING),
+]
+
+
+def _to_datetime(timestamp):
+    """时间戳转换为UTC时间, TTL索引只对日期类型的字段生效, None表示永不过期"""
+    if timestamp is None:
+        return None
+    return datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc)
+
+
+def _to_timestamp(value):
+    """数据库中的UTC时间转换为时间戳, pymongo默认返回不带时区的UTC时间"""
+    if value is None:
+        return None
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=datetime.timezone.utc)
+    return value.timestamp()
+
+
+class MongoPool(Storage):
     def __init__(self):
         """初始化"""
         # 建立数据库连接
         self.client = pymongo.MongoClient(MONGO_URL)
         # 获取要操作的集合
         self.proxies = self.client[DATABASE][COLLECTION]
-        
+        # 按域名保存被禁用的代理IP的集合
+        self.disabled_domains = self.client[DATABASE][DISABLED_DOMAINS_COLLECTION]
+        # 保存爬虫反馈的统计的集合
+        self.proxy_feedback = self.client[DATABASE][FEEDBACK_COLLECTION]
+        # 保存删除记录的集合
+        self.deleted_proxies = self.client[DATABASE][DELETED_PROXIES_COLLECTION]
+        # 确保热点查询需要的索引存在
+        self.ensure_indexes()
+        # 批量写入的缓冲区
+        self.bulk_writer = BulkWriter(self.proxies)
+        # 禁用记录批量写入的缓冲区
+        self.disabled_writer = BulkWriter(self.disabled_domains)
+        # 反馈统计批量写入的缓冲区
+        self.feedback_writer = BulkWriter(self.proxy_feedback)
+        # 删除记录批量写入的缓冲区
+        self.deleted_writer = BulkWriter(self.deleted_proxies)
+        # 通过这个对象直接写入数据库的次数, 和批量写入的次数一起组成数据版本
+        self._writes = 0
+
+    @property
+    def version(self):
+        """数据版本, 通过这个对象写入数据库后会增大, 用于让API的响应缓存失效
+        其他进程的写入不会改变这个值, 由响应缓存的有效时间兜底
+        """
+        return self._writes + self.bulk_writer.flushes + self.disabled_writer.flushes
+
+    def ensure_indexes(self):
+        """创建热点查询需要的索引, 索引已经存在时create_index不会重复创建"""
+        # get_proxies的过滤和排序
+        self.proxies.create_index(PROXIES_QUERY_INDEX, name='nick_type_protocol_score_speed')
+        # 内存索引根据updated_at增量拉取
+        self.proxies.create_index('updated_at', name='updated_at')
+        # 检测模块按照next_check查询到期的代理IP
+        self.proxies.create_index('next_check', name='next_check')
+        # 查询一个域名禁用的代理IP, 索引包含ip和expire_at, 查询可以被索引覆盖
+        self.disabled_domains.create_index([('domain', pymongo.ASCENDING), ('ip', pymongo.ASCENDING),
+                                            ('expire_at', pymongo.ASCENDING)], name='domain_ip_expire_at')
+        # 内存索引根据updated_at增量拉取禁用记录
+        self.disabled_domains.create_index('updated_at', name='updated_at')
+        # 到期的禁用记录由MongoDB自动删除
+        self.disabled_domains.create_index('expire_at', name='expire_at_ttl', expireAfterSeconds=0)
+        # 到期的反馈计数由MongoDB自动删除, API工作进程根据updated_at增量拉取其他工作进程写入的计数
+        self.proxy_feedback.create_index('expire_at', name='expire_at_ttl', expireAfterSeconds=0)
+        self.proxy_feedback.create_index('updated_at', name='updated_at')
+        # 内存索引根据updated_at增量拉取删除记录, 到期的删除记录由MongoDB自动删除
+        self.deleted_proxies.create_index('updated_at', name='updated_at')
+        self.deleted_proxies.create_index('expire_at', name='expire_at_ttl', expireAfterSeconds=0)
 
+    @metrics.timed('mongo_operation_seconds', operation='insert_one')
     def insert_one(self, proxy):
         """保存代理IP到数据库中"""
 
@@ -35,105 +131,375 @@ class MongoPool:
         count = self.proxies.count_documents({'_id': proxy.ip})
         # 如果代理IP不存在, 则插入
         if count == 0:
-            dic = proxy.__dict__
+            dic = proxy.to_document()
             dic['_id'] = proxy.ip
+            dic['updated_at'] = time.time()
+            dic.update(get_schedule_fields(proxy.score))
             self.proxies.insert_one(dic)
+            self._writes += 1
             logger.info(f'insert success: {proxy}')
         # 如果代理IP存在, 则打印代理IP已经存在
         else:
             logger.warning(f'Proxy already existed: {proxy}')
 
+    def buffer_insert(self, proxy):
+        """把代理IP放入批量写入的缓冲区, 缓冲区满或超时后以upsert批量写入
+        代理IP不存在时插入, 已经存在时不做修改, 和insert_one的行为一致
+        不需要先查询代理IP是否存在, 多个协程同时插入同一个代理IP也不会出错
+        """
+        dic = proxy.to_document()
+        dic.update(get_schedule_fields(proxy.score))
+        # updated_at在写入时生成, 新的代理IP在API的内存索引下一次增量拉取时就能被拉取到
+        self.bulk_writer.add(lambda now: pymongo.UpdateOne(
+            {'_id': proxy.ip}, {'$setOnInsert': {**dic, 'updated_at': now}}, upsert=True))
+
+    def buffer_update(self, proxy, fields, inc=None, touch=True):
+        """把代理IP的修改放入批量写入的缓冲区, 只写入发生变化的字段
+        :param proxy: 要修改的代理IP
+        :param fields: 发生变化的字段和新的值组成的字典
+        :param inc: 要增加的字段和增加的值组成的字典, 默认值为None, 表示没有要增加的字段
+        :param touch: 是否更新updated_at, 只修改调度相关的字段时不需要让API的内存索引重新拉取
+        """
+        update = {'$set': dict(fields)}
+        if inc:
+            update['$inc'] = inc
+        if not touch:
+            self.bulk_writer.add(pymongo.UpdateOne({'_id': proxy.ip}, update))
+            return
+        # updated_at在写入时生成, 保证API的内存索引下一次增量拉取时能拉取到
+        self.bulk_writer.add(lambda now: pymongo.UpdateOne(
+            {'_id': proxy.ip}, {**update, '$set': {**update['$set'], 'updated_at': now}}))
+
+    def buffer_served(self, ip, count):
+        """把代理IP被API提供的次数放入批量写入的缓冲区, 累加到served字段
+        不修改updated_at, 避免API的内存索引重复拉取没有变化的代理IP
+        """
+        self.bulk_writer.add(pymongo.UpdateOne({'_id': ip}, {'$inc': {'served': count}}))
+
+    def buffer_delete(self, proxy):
+        """把代理IP的删除放入批量写入的缓冲区, 同时写入删除记录, 让API的内存索引下一次增量拉取时清除这个代理IP"""
+        self.bulk_writer.add(pymongo.DeleteOne({'_id': proxy.ip}))
+        self.deleted_writer.add(lambda now: self._deleted_operation(proxy.ip, now))
+
+    @staticmethod
+    def _deleted_operation(ip, now):
+        """生成写入删除记录的upsert操作, 每个ip只有一条记录"""
+        return pymongo.UpdateOne(
+            {'_id': ip},
+            {'$set': {'updated_at': now, 'expire_at': _to_datetime(now + DELETED_PROXY_EXPIRE_SECONDS)}},
+            upsert=True
+        )
+
+    def flush(self):
+        """立即写入缓冲区中的所有操作"""
+        self.disabled_writer.flush()
+        self.feedback_writer.flush()
+        result = self.bulk_writer.flush()
+        # 删除记录在删除代理IP之后写入
+        self.deleted_writer.flush()
+        if result is not None:
+            logger.info(f'bulk write success: upserted {result.upserted_count}, matched {result.matched_count}, '
+                        f'modified {result.modified_count}, deleted {result.deleted_count}')
+        return result
+
+    @metrics.timed('mongo_operation_seconds', operation='update_one')
     def update_one(self, proxy):
         """更新代理IP"""
-        self.proxies.update_one({'_id': proxy.ip}, {'$set': proxy.__dict__})
+        self.proxies.update_one({'_id': proxy.ip}, {'$set': {**proxy.to_document(), 'updated_at': time.time()}})
+        self._writes += 1
 
+    @metrics.timed('mongo_operation_seconds', operation='delete_one')
     def delete_one(self, proxy):
         """删除代理IP"""
         self.proxies.delete_one({'_id': proxy.ip})
+        self.deleted_proxies.bulk_write([self._deleted_operation(proxy.ip, time.time())])
+        self._writes += 1
+
+    @metrics.timed('mongo_operation_seconds', operation='find_all')
+    def find_all(self, batch_size=0):
+        """查询所有代理IP
+        :param batch_size: 游标每批从数据库读取的数量, 默认值为0, 表示使用数据库的默认值
+        """
+        cursor = self.proxies.find(batch_size=batch_size)
+        yield from Proxy.from_documents(cursor)
+
+    @metrics.timed('mongo_operation_seconds', operation='iter_keys')
+    def iter_keys(self):
+        """查询所有代理IP的ip和port, 只读取这两个字段
+        :return: 返回(ip, port)的生成器
+        """
+        for item in self.proxies.find({}, {'_id': 0, 'ip': 1, 'port': 1}):
+            yield item['ip'], item['port']
 
-    def find_all(self):
-        """查询所有代理IP"""
-        cursor = self.proxies.find()
+    @metrics.timed('mongo_operation_seconds', operation='find_updated_since')
+    def find_updated_since(self, timestamp=None):
+        """查询updated_at不早于指定时间的代理IP
+        :param timestamp: 时间戳, 默认值为None, 表示查询所有代理IP
+        :return: 返回(Proxy对象, updated_at)的生成器, 旧数据没有updated_at时为None
+        """
+        conditions = {} if timestamp is None else {'updated_at': {'$gte': timestamp}}
+        cursor = self.proxies.find(conditions)
         for item in cursor:
-            item.pop('_id')
-            yield Proxy(**item)
+            yield self._to_proxy(item), item.get('updated_at')
 
-    def find(self, conditions={}, count=0):
+    @metrics.timed('mongo_operation_seconds', operation='find_due')
+    def find_due(self, count=0, now=None):
+        """按照下次检测时间从早到晚, 查询已经到期的代理IP, 没有下次检测时间的旧数据视为已经到期
+        :param count: 查询数量, 默认值为0, 表示不指定数量
+        :param now: 当前时间, 默认值为None, 表示使用当前时间
+        :return: 返回(Proxy对象, 自上次检测以来被API提供的次数)的生成器
+        """
+        now = time.time() if now is None else now
+        # next_check为None时也能匹配到没有这个字段的文档
+        conditions = {'$or': [{'next_check': {'$lte': now}}, {'next_check': None}]}
+        cursor = self.proxies.find(conditions, limit=count).sort('next_check', pymongo.ASCENDING)
+        for item in cursor:
+            yield self._to_proxy(item), item.get('served', 0)
+
+    @metrics.timed('mongo_operation_seconds', operation='get_next_check')
+    def get_next_check(self):
+        """获取最早的下次检测时间, 没有下次检测时间的旧数据视为0, 数据库中没有代理IP时返回None"""
+        item = self.proxies.find_one({}, {'next_check': 1}, sort=[('next_check', pymongo.ASCENDING)])
+        return item.get('next_check', 0) if item else None
+
+    def _find_cursor(self, conditions, count=0, projection=None):
+        """根据条件返回查询游标, 按照分数降序, 然后速度升序"""
+        return self.proxies.find(conditions, projection, limit=count).sort([
+            ('score', pymongo.DESCENDING), ('speed', pymongo.ASCENDING)
+        ])
+
+    @metrics.timed('mongo_operation_seconds', operation='find')
+    def find(self, conditions={}, count=0, projection=None):
         """根据条件查询代理IP,可以指定查询数量,按照分数降序,然后速度升序,保证优质的代理IP在上面
         :param conditions: 查询条件
         :param count: 查询数量
+        :param projection: 要返回的字段, 默认值为None, 表示返回所有字段
         :return: 返回满足条件的代理IP列表
         """
         # 根据条件查询代理IP
-        cursor = self.proxies.find(conditions, limit=count).sort([
-            ('score', pymongo.DESCENDING), ('speed', pymongo.ASCENDING)
-        ])
+        cursor = self._find_cursor(conditions, count=count, projection=projection)
 
         # 将查询结果转换为列表
-        proxy_list = list()
-        for item in cursor:
-            item.pop('_id')
-            proxy_list.append(Proxy(**item))
-        
-        return proxy_list
+        return list(Proxy.from_documents(cursor))
+
+    @staticmethod
+    def _get_conditions(protocol=None, nick_type=0):
+        """根据协议类型和匿名程度, 生成get_proxies的查询条件, 域名的禁用记录不在查询条件中, 由get_proxies单独排除"""
+        protocols = get_protocols(protocol)
+        return {'nick_type': nick_type, 'protocol': protocols[0] if len(protocols) == 1 else {'$in': protocols}}
 
-    def get_proxies(self, protocol=None, domain=None, nick_type=0, count=0):
+    @metrics.timed('mongo_operation_seconds', operation='get_proxies')
+    def get_proxies(self, protocol=None, domain=None, nick_type=0, count=0, projection=None):
         """
         根据协议类型、要访问网站的域名和匿名程度, 获取代理IP列表，可以指定要获取的代理IP的个数
         :param protocol: 协议类型(http, https), 默认值为None, 表示http和https都支持
         :param domain: 要访问网站的域名, 默认值为None, 表示不指定域名
         :param count: 查询数量, 默认值为0, 表示不指定数量
         :param nick_type: 匿名程度(高匿:0, 匿名:1, 透明:2), 默认值为0, 表示高匿
+        :param projection: 要返回的字段, 默认值为None, 表示返回所有字段
         :return: 返回满足条件的代理IP列表
         """
-        # 初始化查询条件
-        conditions = {'nick_type': nick_type}
-
-        # 根据协议类型设置查询条件
-        # 如果协议类型为None, 则表示查询http和https都支持的代理IP, protocol的值为2
-        if protocol is None:
-            conditions['protocol'] = 2
-        # 如果协议类型为http, 则表示查询支持http的代理IP, protocol的值为0或2
-        elif protocol.lower() == 'http':
-            conditions['protocol'] = {'$in': [0, 2]}
-        # 如果协议类型为https, 则表示查询支持https的代理IP, protocol的值为1或2
-        else:
-            conditions['protocol'] = {'$in': [1, 2]}
+        # 生成查询条件
+        conditions = self._get_conditions(protocol=protocol, nick_type=nick_type)
+        # 如果域名为None或者该域名没有禁用任何代理IP, 则直接调用find方法查询代理IP
+        disabled = self.get_disabled_ips(domain) if domain else None
+        if not disabled:
+            return self.find(conditions=conditions, count=count, projection=projection)
+        # 否则按照排序依次读取, 跳过被禁用的代理IP, 直到取够数量
+        proxy_list = list()
+        for item in self._find_cursor(conditions, projection=projection):
+            if item['ip'] in disabled:
+                continue
+            proxy_list.append(self._to_proxy(item))
+            if count and len(proxy_list) >= count:
+                break
+        return proxy_list
+    
+    @metrics.timed('mongo_operation_seconds', operation='disable_domains')
+    def disable_domains(self, pairs, expire_hours=DISABLE_DOMAIN_EXPIRE_HOURS):
+        """以一次无序的bulk_write批量禁用多个代理IP访问对应的域名
+        :param pairs: (ip, 域名)列表, 不能有重复
+        :param expire_hours: 经过多少小时自动解除禁用, 0表示永久禁用
+        :return: 返回(到期时间的时间戳, 写入失败的pairs下标集合), 永久禁用时到期时间为None
+        """
+        now = time.time()
+        expire_at = now + expire_hours * 3600 if expire_hours else None
+        operations = [self._disable_domain_operation(ip, domain, expire_at, now) for ip, domain in pairs]
+        if not operations:
+            return expire_at, set()
+        failed = set()
+        try:
+            self.disabled_domains.bulk_write(operations, ordered=False)
+        except BulkWriteError as e:
+            # 无序写入时其他操作仍然会执行, 只有writeErrors中的操作失败
+            failed = {error['index'] for error in e.details.get('writeErrors', [])}
+            logger.error(f'disable domains error: {e.details.get("writeErrors")}')
+        finally:
+            self._writes += 1
+        return expire_at, failed
 
-        # 如果域名为None, 则表示不指定域名
-        # 否则根据域名设置查询条件
-        if domain:
-            conditions['disable_domains'] = {'$nin': [domain]}
+    def buffer_disable_domain(self, ip, domain, expire_hours=DISABLE_DOMAIN_EXPIRE_HOURS):
+        """把禁用操作放入缓冲区, 缓冲区满或超时后批量写入
+        :return: 返回到期时间的时间戳, 永久禁用时返回None
+        """
+        expire_at = time.time() + expire_hours * 3600 if expire_hours else None
+        # updated_at在写入时生成, 其他工作进程的内存索引下一次增量拉取时就能拉取到这条禁用记录
+        self.disabled_writer.add(lambda now: self._disable_domain_operation(ip, domain, expire_at, now))
+        return expire_at
 
-        # 调用find方法查询代理IP
-        return self.find(conditions=conditions, count=count)
-    
-    def get_random_proxy(self, protocol=None, domain=None, nick_type=0, count=0):
-        """根据协议类型、要访问网站的域名和匿名程度,随机获取一个代理IP
-        :param protocol: 协议类型(http, https), 默认值为None, 表示http和https都支持
-        :param domain: 要访问网站的域名, 默认值为None, 表示不指定域名
-        :param nick_type: 匿名程度(高匿:0, 匿名:1, 透明:2), 默认值为0, 表示高匿
-        :param count: 获取随机代理IP的范围, 默认值为0, 表示在所有满足条件的代理IP中随机获取一个
-        :return: 返回一个满足条件的代理IP
-        """
-        # 调用get_proxies方法获取满足条件的代理IP列表
-        proxy_list = self.get_proxies(protocol=protocol, domain=domain, nick_type=nick_type, count=count)
-        # 如果代理IP列表不为空, 则随机返回一个代理IP
-        if proxy_list:
-            return random.choice(proxy_list)
-        # 如果代理IP列表为空, 则返回None
-        else:
-            return None
+    @staticmethod
+    def _disable_domain_operation(ip, domain, expire_at, now):
+        """生成禁用代理IP访问域名的upsert操作, 每个(域名, ip)只有一条记录"""
+        return pymongo.UpdateOne(
+            {'_id': f'{domain}|{ip}'},
+            {'$set': {'domain': domain, 'ip': ip, 'expire_at': _to_datetime(expire_at), 'updated_at': now}},
+            upsert=True
+        )
+
+    @metrics.timed('mongo_operation_seconds', operation='find_existing_ips')
+    def find_existing_ips(self, ips):
+        """查询数据库中存在的代理IP
+        :param ips: 要查询的ip列表
+        :return: 返回其中存在的ip集合
+        """
+        return {item['_id'] for item in self.proxies.find({'_id': {'$in': list(ips)}}, {'_id': 1})}
 
-    def disable_domain(self, ip, domain):
-        """将指定域名添加到指定代理IP的不可用域名列表中"""
-        # 检查指定代理IP的不可用域名列表中是否已经存在指定域名
-        # 如果不存在，则添加进去
-        if self.proxies.count_documents({'_id': ip, 'disable_domains': domain}) == 0:
-            self.proxies.update_one({'_id': ip}, {'$push': {'disable_domains': domain}})
+    def _disabled_ips_cursor(self, domain, now=None):
+        """查询指定域名下还没有到期的禁用记录的游标, 只返回ip字段"""
+        now = time.time() if now is None else now
+        # TTL索引大约每分钟删除一次到期的记录, 因此查询时还要排除已经到期但没有删除的记录
+        conditions = {'domain': domain, '$or': [{'expire_at': {'$gt': _to_datetime(now)}}, {'expire_at': None}]}
+        return self.disabled_domains.find(conditions, {'_id': 0, 'ip': 1})
+
+    @metrics.timed('mongo_operation_seconds', operation='get_disabled_ips')
+    def get_disabled_ips(self, domain):
+        """获取在指定域名下被禁用的代理IP集合"""
+        return {item['ip'] for item in self._disabled_ips_cursor(domain)}
+
+    @metrics.timed('mongo_operation_seconds', operation='find_disabled_since')
+    def find_disabled_since(self, timestamp=None):
+        """查询updated_at不早于指定时间的禁用记录
+        :param timestamp: 时间戳, 默认值为None, 表示查询所有禁用记录
+        :return: 返回(域名, ip, 到期时间的时间戳)的生成器, 永久禁用时到期时间为None
+        """
+        conditions = {} if timestamp is None else {'updated_at': {'$gte': timestamp}}
+        for item in self.disabled_domains.find(conditions, {'_id': 0, 'domain': 1, 'ip': 1, 'expire_at': 1}):
+            yield item['domain'], item['ip'], _to_timestamp(item.get('expire_at'))
+
+    @metrics.timed('mongo_operation_seconds', operation='find_deleted_since')
+    def find_deleted_since(self, timestamp):
+        """查询删除时间不早于指定时间的删除记录
+        :return: 返回(ip, 删除时间)的生成器
+        """
+        for item in self.deleted_proxies.find({'updated_at': {'$gte': timestamp}}, {'updated_at': 1}):
+            yield item['_id'], item['updated_at']
+
+    def migrate_disable_domains(self, expire_hours=DISABLE_DOMAIN_EXPIRE_HOURS):
+        """把旧数据中代理IP文档里的disable_domains列表迁移到disabled_domains集合中, 然后删除这个列表
+        :param expire_hours: 迁移后的禁用记录经过多少小时到期, 0表示永久禁用
+        :return: 返回迁移的禁用记录数量
+        """
+        now = time.time()
+        expire_at = _to_datetime(now + expire_hours * 3600 if expire_hours else None)
+        operations = []
+        for item in self.proxies.find({'disable_domains.0': {'$exists': True}}, {'disable_domains': 1}):
+            for domain in item['disable_domains']:
+                operations.append(pymongo.UpdateOne(
+                    {'_id': f'{domain}|{item["_id"]}'},
+                    {'$setOnInsert': {'domain': domain, 'ip': item['_id'], 'expire_at': expire_at, 'updated_at': now}},
+                    upsert=True
+                ))
+        if operations:
+            self.disabled_domains.bulk_write(operations, ordered=False)
+        self.proxies.update_many({'disable_domains': {'$exists': True}}, {'$unset': {'disable_domains': ''}})
+        self._writes += 1
+        return len(operations)
+
+    def buffer_feedback(self, ip, domain, successes, samples, latency_sum, latency_samples):
+        """把爬虫反馈的计数放入批量写入的缓冲区, 以(域名, ip)为键upsert, 计数以$inc累加
+        多个工作进程各自累加自己收到的反馈, 不会互相覆盖; updated_at在写入时生成, 供其他工作进程增量拉取
+        """
+        self.feedback_writer.add(lambda now: pymongo.UpdateOne(
+            {'_id': f'{domain}|{ip}'},
+            {'$set': {'domain': domain, 'ip': ip, 'updated_at': now,
+                      'expire_at': _to_datetime(now + FEEDBACK_EXPIRE_SECONDS)},
+             '$inc': {'successes': successes, 'samples': samples, 'latency_sum': latency_sum,
+                      'latency_samples': latency_samples}},
+            upsert=True
+        ))
+
+    @metrics.timed('mongo_operation_seconds', operation='find_feedback')
+    def find_feedback(self, timestamp=None):
+        """查询还没有到期、updated_at不早于指定时间的反馈计数
+        :param timestamp: 时间戳, 默认值为None, 表示查询所有还没有到期的计数
+        :return: 返回(ip, 域名, 成功次数, 反馈次数, 延迟之和, 有延迟的成功反馈次数, 更新时间)的生成器
+        """
+        # TTL索引大约每分钟删除一次到期的记录, 因此查询时还要排除已经到期但没有删除的记录
+        # 旧版本保存的是EWMA, 没有计数, 不再使用
+        conditions = {'expire_at': {'$gt': _to_datetime(time.time())}, 'successes': {'$exists': True}}
+        if timestamp is not None:
+            conditions['updated_at'] = {'$gte': timestamp}
+        for item in self.proxy_feedback.find(conditions, {'_id': 0, 'expire_at': 0}):
+            yield (item['ip'], item['domain'], item.get('successes', 0), item.get('samples', 0),
+                   item.get('latency_sum', 0.0), item.get('latency_samples', 0), item['updated_at'])
+
+    def explain_hot_queries(self, count=0):
+        """使用explain()检查热点查询的执行计划
+        :param count: 查询数量, 和API中使用的查询数量保持一致
+        :return: 返回每个热点查询的检查结果列表, 每一项包含:
+            - name: 查询名称
+            - stages: 执行计划中的所有阶段
+            - indexes: 使用到的索引
+            - indexed: 是否使用了索引(执行计划中没有COLLSCAN)
+            - sorted: 是否由索引完成排序(执行计划中没有内存排序SORT)
+            - covered: 是否被索引覆盖(执行计划中没有回表读取文档FETCH)
+        """
+        queries = []
+        for protocol in (None, 'http', 'https'):
+            conditions = self._get_conditions(protocol=protocol)
+            queries.append((f'get_proxies(protocol={protocol})', self._find_cursor(conditions, count=count)))
+            queries.append((f'get_random_proxy(protocol={protocol})',
+                            self._find_cursor(conditions, count=count, projection=RANDOM_PROXY_PROJECTION)))
+            # 按照权重选择时查询所有满足条件的代理IP
+            queries.append((f'get_random_proxy(protocol={protocol}, weighted)',
+                            self._find_cursor(conditions, projection=WEIGHTED_PROXY_PROJECTION)))
+        # 指定域名时, 先查询这个域名禁用的代理IP
+        queries.append(('get_disabled_ips(domain)', self._disabled_ips_cursor('example.com')))
+
+        results = []
+        for name, cursor in queries:
+            plan = cursor.explain()
+            winning_plan = plan['queryPlanner']['winningPlan']
+            # 使用SBE执行引擎时, 执行计划在queryPlan字段中
+            stages = list(self._iter_plan_stages(winning_plan.get('queryPlan', winning_plan)))
+            names = [stage['stage'] for stage in stages]
+            results.append({
+                'name': name,
+                'stages': names,
+                'indexes': sorted({stage['indexName'] for stage in stages if 'indexName' in stage}),
+                'indexed': 'COLLSCAN' not in names,
+                'sorted': 'SORT' not in names,
+                'covered': 'FETCH' not in names,
+            })
+        return results
+
+    @classmethod
+    def _iter_plan_stages(cls, plan):
+        """递归遍历执行计划中的所有阶段"""
+        yield plan
+        if 'inputStage' in plan:
+            yield from cls._iter_plan_stages(plan['inputStage'])
+        for stage in plan.get('inputStages', []):
+            yield from cls._iter_plan_stages(stage)
+
+    @staticmethod
+    def _to_proxy(item):
+        """把数据库文档转换为Proxy对象, 去掉_id、updated_at等只在数据库中使用的字段"""
+        return Proxy.from_document(item)
 
     def close(self):
-        """关闭数据库连接"""
+        """写入缓冲区中剩余的操作, 然后关闭数据库连接"""
+        self.flush()
         self.client.close()
 
     def __del__(self):
@@ -154,3 +520,4 @@ if __name__ == '__main__':
     proxy4 = Proxy('124.89.97.45', '80', protocol=0, score=22, nick_type=1, speed=0.31, disable_domains=['jd.com'])
 
     mongo.disable_domain(proxy1.ip, 'baidu.com')
+    print(mongo.get_disabled_ips('baidu.com'))
@@ -0,0 +1,533 @@
+"""
+基于SQLite的代理池数据库模块
+- 作用: 实现core/db/storage.py中的存储接口, 代理IP保存在本地的数据库文件中, 不需要运行MongoDB
+- 实现:
+  1. 使用WAL模式, 爬虫、检测、API等多个进程可以同时读取, 写入时不阻塞读取
+  2. proxies表以ip为主键, 字段和MongoDB中的文档一致; disabled_domains表以(域名, ip)为主键保存禁用记录
+     speed字段不声明类型, 整数(-1)和浮点数按原样保存, 编码为json的结果和MongoDB一致
+  3. 创建和MongoDB相同的热点查询索引: (nick_type, protocol, score, speed, ip, port)的复合索引、updated_at、next_check
+  4. 查询支持多种协议的代理IP时, 每种协议各自按照索引的顺序读取, 再以UNION ALL归并排序, 不需要额外的排序
+  5. 指定域名时, 在同一条查询中用子查询排除被禁用的代理IP
+  6. 批量写入复用BulkWriter的缓冲区, 缓冲区中的所有操作在一个事务中写入
+  7. 到期的禁用记录在查询时排除, 并在全量拉取禁用记录时删除
+  8. 爬虫反馈的计数保存在proxy_feedback表中, 以(域名, ip)为主键upsert并累加计数, 到期的记录在加载时排除并删除
+  9. 删除代理IP时在同一个事务中写入deleted_proxies表, 供API的内存索引增量清除, 到期的记录在写入缓冲区时删除
+- 每个进程有各自的数据库连接, 同一个进程中的协程通过锁共享一个连接
+"""
+import contextlib
+import itertools
+import re
+import sqlite3
+import threading
+import time
+from core.db.bulk_writer import BulkWriter
+from core.check_schedule import get_schedule_fields
+from core.db.storage import Storage, get_protocols, RANDOM_PROXY_PROJECTION, WEIGHTED_PROXY_PROJECTION
+from model import Proxy
+from settings import SQLITE_PATH, SQLITE_BUSY_TIMEOUT_SECONDS, DISABLE_DOMAIN_EXPIRE_HOURS, FEEDBACK_EXPIRE_SECONDS
+from settings import DELETED_PROXY_EXPIRE_SECONDS
+from utils.log import logger
+from utils import metrics
+
+# Proxy对象对应的字段
+PROXY_COLUMNS = ('ip', 'port', 'protocol', 'nick_type', 'speed', 'area', 'score')
+# 只在数据库中使用的字段, 包括调度字段
+EXTRA_COLUMNS = ('updated_at', 'last_checked', 'next_check', 'served')
+# 查询结果按照分数降序, 然后速度升序, 使用UNION ALL时排序字段必须出现在返回的字段中
+ORDER_COLUMNS = ('score', 'speed')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS proxies (
+    ip TEXT PRIMARY KEY,
+    port TEXT,
+    protocol INTEGER,
+    nick_type INTEGER,
+    speed,
+    area TEXT,
+    score INTEGER,
+    updated_at REAL,
+    last_checked REAL,
+    next_check REAL NOT NULL DEFAULT 0,
+    served INTEGER NOT NULL DEFAULT 0
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS nick_type_protocol_score_speed ON proxies (nick_type, protocol, score DESC, speed, ip, port);
+CREATE INDEX IF NOT EXISTS updated_at ON proxies (updated_at);
+CREATE INDEX IF NOT EXISTS next_check ON proxies (next_check);
+CREATE TABLE IF NOT EXISTS disabled_domains (
+    domain TEXT NOT NULL,
+    ip TEXT NOT NULL,
+    expire_at REAL,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (domain, ip)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS disabled_domains_updated_at ON disabled_domains (updated_at);
+CREATE INDEX IF NOT EXISTS disabled_domains_expire_at ON disabled_domains (expire_at);
+CREATE TABLE IF NOT EXISTS proxy_feedback (
+    domain TEXT NOT NULL,
+    ip TEXT NOT NULL,
+    successes INTEGER NOT NULL DEFAULT 0,
+    samples INTEGER NOT NULL DEFAULT 0,
+    latency_sum REAL NOT NULL DEFAULT 0,
+    latency_samples INTEGER NOT NULL DEFAULT 0,
+    updated_at REAL NOT NULL,
+    expire_at REAL NOT NULL,
+    PRIMARY KEY (domain, ip)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS proxy_feedback_updated_at ON proxy_feedback (updated_at);
+CREATE TABLE IF NOT EXISTS deleted_proxies (
+    ip TEXT PRIMARY KEY,
+    updated_at REAL NOT NULL
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS deleted_proxies_updated_at ON deleted_proxies (updated_at);
+"""
+
+INSERT_PROXY_SQL = (f'INSERT OR IGNORE INTO proxies ({", ".join(PROXY_COLUMNS + EXTRA_COLUMNS)}) '
+                    f'VALUES ({", ".join("?" * len(PROXY_COLUMNS + EXTRA_COLUMNS))})')
+DISABLE_DOMAIN_SQL = 'INSERT OR REPLACE INTO disabled_domains (domain, ip, expire_at, updated_at) VALUES (?, ?, ?, ?)'
+# 反馈计数的upsert, 计数累加, 多个工作进程同时写入时不会互相覆盖
+FEEDBACK_SQL = ('INSERT INTO proxy_feedback (domain, ip, successes, samples, latency_sum, latency_samples, '
+                'updated_at, expire_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT (domain, ip) DO UPDATE SET '
+                'successes = successes + excluded.successes, samples = samples + excluded.samples, '
+                'latency_sum = latency_sum + excluded.latency_sum, '
+                'latency_samples = latency_samples + excluded.latency_samples, '
+                'updated_at = excluded.updated_at, expire_at = excluded.expire_at')
+DELETE_PROXY_SQL = 'DELETE FROM proxies WHERE ip = ?'
+DELETED_PROXY_SQL = 'INSERT OR REPLACE INTO deleted_proxies (ip, updated_at) VALUES (?, ?)'
+# 还没有到期的禁用记录, 参数为当前时间
+NOT_EXPIRED = '(expire_at IS NULL OR expire_at > ?)'
+
+
+class _Table:
+    """BulkWriter写入的目标, 把缓冲区中的(sql, 参数)操作在一个事务中写入"""
+    def __init__(self, pool, name):
+        self.pool = pool
+        self.name = name
+
+    def bulk_write(self, operations, ordered=False):
+        """连续的相同sql语句合并为一次executemany, 返回写入的操作数量"""
+        with self.pool.transaction() as connection:
+            for sql, group in itertools.groupby(operations, key=lambda operation: operation[0]):
+                connection.executemany(sql, [params for _, params in group])
+        return len(operations)
+
+
+class SqlitePool(Storage):
+    def __init__(self, path=SQLITE_PATH):
+        """初始化
+        :param path: 数据库文件的路径, ':memory:'表示只保存在内存中(只用于测试)
+        """
+        # 建立数据库连接, 自动提交, 批量写入时显式开启事务
+        self.connection = sqlite3.connect(path, timeout=SQLITE_BUSY_TIMEOUT_SECONDS, isolation_level=None,
+                                          check_same_thread=False)
+        # 多个读取方不阻塞写入方; WAL模式下synchronous=NORMAL不会损坏数据库, 只在断电时可能丢失最后的事务
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        # 同一个进程中的协程和线程共享这个连接
+        self._lock = threading.RLock()
+        # 旧版本的proxy_feedback表保存的是EWMA, 反馈统计只保存FEEDBACK_EXPIRE_SECONDS秒, 直接重建
+        columns = {row[1] for row in self.connection.execute('PRAGMA table_info(proxy_feedback)')}
+        if columns and 'successes' not in columns:
+            self.connection.execute('DROP TABLE proxy_feedback')
+        # 确保表和热点查询需要的索引存在
+        self.connection.executescript(SCHEMA)
+        # 批量写入的缓冲区
+        self.bulk_writer = BulkWriter(_Table(self, 'proxies'))
+        # 禁用记录批量写入的缓冲区
+        self.disabled_writer = BulkWriter(_Table(self, 'disabled_domains'))
+        # 反馈统计批量写入的缓冲区
+        self.feedback_writer = BulkWriter(_Table(self, 'proxy_feedback'))
+        # 通过这个对象直接写入数据库的次数, 和批量写入的次数一起组成数据版本
+        self._writes = 0
+
+    @property
+    def version(self):
+        """数据版本, 通过这个对象写入数据库后会增大, 其他进程的写入不会改变这个值"""
+        return self._writes + self.bulk_writer.flushes + self.disabled_writer.flushes
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """写事务的上下文管理器, 持有连接的锁, 退出时提交, 出错时回滚"""
+        with self._lock:
+            # 立即获取写锁, 其他进程正在写入时最多等待SQLITE_BUSY_TIMEOUT_SECONDS秒
+            self.connection.execute('BEGIN IMMEDIATE')
+            try:
+                yield self.connection
+            except BaseException:
+                self.connection.execute('ROLLBACK')
+                raise
+            self.connection.execute('COMMIT')
+
+    def _execute(self, sql, params=()):
+        """执行一条写入语句, 返回影响的行数"""
+        with self._lock:
+            rowcount = self.connection.execute(sql, params).rowcount
+        self._writes += 1
+        return rowcount
+
+    def _query(self, sql, params=()):
+        """执行一条查询语句, 返回字段名到值的字典列表"""
+        with self._lock:
+            cursor = self.connection.execute(sql, params)
+            rows = cursor.fetchall()
+        names = [column[0] for column in cursor.description]
+        return [dict(zip(names, row)) for row in rows]
+
+    def _iter_query(self, sql, params=(), batch_size=0):
+        """执行一条查询语句, 每次读取batch_size行, 返回字段名到值的字典的生成器
+        只在读取时持有锁, 调用方在遍历过程中可以写入数据库
+        """
+        with self._lock:
+            cursor = self.connection.execute(sql, params)
+        names = [column[0] for column in cursor.description]
+        batch_size = batch_size or 1000
+        while True:
+            with self._lock:
+                rows = cursor.fetchmany(batch_size)
+            if not rows:
+                return
+            for row in rows:
+                yield dict(zip(names, row))
+
+    @staticmethod
+    def _to_row(proxy, now):
+        """把代理IP转换为插入proxies表的参数"""
+        document = proxy.to_document()
+        schedule = get_schedule_fields(proxy.score, now=now)
+        return (tuple(document[column] for column in PROXY_COLUMNS)
+                + (now, schedule['last_checked'], schedule['next_check'], 0))
+
+    @metrics.timed('sqlite_operation_seconds', operation='insert_one')
+    def insert_one(self, proxy):
+        """保存代理IP到数据库中, 已经存在时不做修改"""
+        if self._execute(INSERT_PROXY_SQL, self._to_row(proxy, time.time())):
+            logger.info(f'insert success: {proxy}')
+        else:
+            logger.warning(f'Proxy already existed: {proxy}')
+
+    def buffer_insert(self, proxy):
+        """把代理IP放入批量写入的缓冲区, 代理IP不存在时插入, 已经存在时不做修改"""
+        # updated_at在写入时生成, 新的代理IP在API的内存索引下一次增量拉取时就能被拉取到
+        self.bulk_writer.add(lambda now: (INSERT_PROXY_SQL, self._to_row(proxy, now)))
+
+    def buffer_update(self, proxy, fields, inc=None, touch=True):
+        """把代理IP的修改放入批量写入的缓冲区, 只写入发生变化的字段
+        :param proxy: 要修改的代理IP
+        :param fields: 发生变化的字段和新的值组成的字典
+        :param inc: 要增加的字段和增加的值组成的字典, 默认值为None, 表示没有要增加的字段
+        :param touch: 是否更新updated_at, 只修改调度相关的字段时不需要让API的内存索引重新拉取
+        """
+        fields = {**fields, 'updated_at': None} if touch else dict(fields)
+        inc = inc or {}
+        self._check_columns(list(fields) + list(inc))
+        assignments = [f'{column} = ?' for column in fields] + [f'{column} = {column} + ?' for column in inc]
+        sql = f'UPDATE proxies SET {", ".join(assignments)} WHERE ip = ?'
+        if not touch:
+            self.bulk_writer.add((sql, (*fields.values(), *inc.values(), proxy.ip)))
+            return
+        # updated_at在写入时生成, 保证API的内存索引下一次增量拉取时能拉取到
+        values = list(fields.values())
+        self.bulk_writer.add(lambda now: (sql, (*values[:-1], now, *inc.values(), proxy.ip)))
+
+    def buffer_served(self, ip, count):
+        """把代理IP被API提供的次数放入批量写入的缓冲区, 累加到served字段, 不修改updated_at"""
+        self.bulk_writer.add(('UPDATE proxies SET served = served + ? WHERE ip = ?', (count, ip)))
+
+    def buffer_delete(self, proxy):
+        """把代理IP的删除放入批量写入的缓冲区, 同时写入删除记录, 让API的内存索引下一次增量拉取时清除这个代理IP"""
+        self.bulk_writer.add((DELETE_PROXY_SQL, (proxy.ip,)))
+        self.bulk_writer.add(lambda now: (DELETED_PROXY_SQL, (proxy.ip, now)))
+
+    def flush(self):
+        """立即写入缓冲区中的所有操作, 并删除到期的删除记录"""
+        self.disabled_writer.flush()
+        self.feedback_writer.flush()
+        result = self.bulk_writer.flush()
+        if result is not None:
+            logger.info(f'bulk write success: {result} operations')
+            with self._lock:
+                self.connection.execute('DELETE FROM deleted_proxies WHERE updated_at < ?',
+                                        (time.time() - DELETED_PROXY_EXPIRE_SECONDS,))
+        return result
+
+    @metrics.timed('sqlite_operation_seconds', operation='update_one')
+    def update_one(self, proxy):
+        """更新代理IP"""
+        document = proxy.to_document()
+        columns = PROXY_COLUMNS[1:]
+        sql = f'UPDATE proxies SET {", ".join(f"{column} = ?" for column in columns)}, updated_at = ? WHERE ip = ?'
+        self._execute(sql, (*(document[column] for column in columns), time.time(), proxy.ip))
+
+    @metrics.timed('sqlite_operation_seconds', operation='delete_one')
+    def delete_one(self, proxy):
+        """删除代理IP, 同时写入删除记录"""
+        with self.transaction() as connection:
+            connection.execute(DELETE_PROXY_SQL, (proxy.ip,))
+            connection.execute(DELETED_PROXY_SQL, (proxy.ip, time.time()))
+        self._writes += 1
+
+    @metrics.timed('sqlite_operation_seconds', operation='find_all')
+    def find_all(self, batch_size=0):
+        """查询所有代理IP
+        :param batch_size: 每批从数据库读取的数量, 默认值为0, 表示使用默认值
+        """
+        yield from Proxy.from_documents(self._iter_query('SELECT * FROM proxies', batch_size=batch_size))
+
+    @metrics.timed('sqlite_operation_seconds', operation='iter_keys')
+    def iter_keys(self):
+        """查询所有代理IP的ip和port, 只读取这两个字段
+        :return: 返回(ip, port)的生成器
+        """
+        for item in self._iter_query('SELECT ip, port FROM proxies'):
+            yield item['ip'], item['port']
+
+    @metrics.timed('sqlite_operation_seconds', operation='find_updated_since')
+    def find_updated_since(self, timestamp=None):
+        """查询updated_at不早于指定时间的代理IP
+        :param timestamp: 时间戳, 默认值为None, 表示查询所有代理IP
+        :return: 返回(Proxy对象, updated_at)的生成器
+        """
+        if timestamp is None:
+            items = self._query('SELECT * FROM proxies')
+        else:
+            items = self._query('SELECT * FROM proxies WHERE updated_at >= ?', (timestamp,))
+        for item in items:
+            yield Proxy.from_document(item), item['updated_at']
+
+    @metrics.timed('sqlite_operation_seconds', operation='find_due')
+    def find_due(self, count=0, now=None):
+        """按照下次检测时间从早到晚, 查询已经到期的代理IP
+        :param count: 查询数量, 默认值为0, 表示不指定数量
+        :param now: 当前时间, 默认值为None, 表示使用当前时间
+        :return: 返回(Proxy对象, 自上次检测以来被API提供的次数)的生成器
+        """
+        now = time.time() if now is None else now
+        items = self._query('SELECT * FROM proxies WHERE next_check <= ? ORDER BY next_check LIMIT ?',
+                            (now, count or -1))
+        for item in items:
+            yield Proxy.from_document(item), item['served']
+
+    @metrics.timed('sqlite_operation_seconds', operation='get_next_check')
+    def get_next_check(self):
+        """获取最早的下次检测时间, 数据库中没有代理IP时返回None"""
+        return self._query('SELECT MIN(next_check) AS next_check FROM proxies')[0]['next_check']
+
+    @staticmethod
+    def _check_columns(columns):
+        """字段名会拼接到sql语句中, 只允许proxies表中的字段"""
+        unknown = set(columns) - set(PROXY_COLUMNS + EXTRA_COLUMNS)
+        if unknown:
+            raise ValueError(f'unknown proxy fields: {sorted(unknown)}')
+
+    @staticmethod
+    def _select_columns(projection=None):
+        """根据要返回的字段生成查询的字段列表, _id对应ip字段"""
+        if projection is None:
+            return PROXY_COLUMNS
+        columns = [column for column, value in projection.items() if value and column != '_id']
+        return tuple(columns) + tuple(column for column in ORDER_COLUMNS if column not in columns)
+
+    @classmethod
+    def _where(cls, conditions):
+        """把等值和$in条件转换为sql的where子句和参数, 不支持其他的MongoDB查询运算符"""
+        clauses, params = [], []
+        for column, value in conditions.items():
+            column = 'ip' if column == '_id' else column
+            cls._check_columns([column])
+            if isinstance(value, dict):
+                if list(value) != ['$in']:
+                    raise ValueError(f'unsupported condition: {column} {value}')
+                clauses.append(f'{column} IN ({", ".join("?" * len(value["$in"]))})')
+                params.extend(value['$in'])
+            else:
+                clauses.append(f'{column} = ?')
+                params.append(value)
+        return ' AND '.join(clauses) or '1', params
+
+    @metrics.timed('sqlite_operation_seconds', operation='find')
+    def find(self, conditions={}, count=0, projection=None):
+        """根据条件查询代理IP,可以指定查询数量,按照分数降序,然后速度升序,保证优质的代理IP在上面
+        :param conditions: 查询条件, 只支持字段的等值条件和$in条件
+        :param count: 查询数量
+        :param projection: 要返回的字段, 默认值为None, 表示返回所有字段
+        :return: 返回满足条件的代理IP列表
+        """
+        where, params = self._where(conditions)
+        sql = (f'SELECT {", ".join(self._select_columns(projection))} FROM proxies WHERE {where} '
+               f'ORDER BY score DESC, speed LIMIT ?')
+        return list(Proxy.from_documents(self._query(sql, (*params, count or -1))))
+
+    def _proxies_query(self, protocol=None, domain=None, nick_type=0, count=0, projection=None, now=None):
+        """生成get_proxies的sql语句和参数
+        每种协议的查询都可以按照复合索引的顺序读取, 多种协议时以UNION ALL归并, 指定域名时用子查询排除被禁用的代理IP
+        """
+        columns = ', '.join(self._select_columns(projection))
+        select = f'SELECT {columns} FROM proxies WHERE nick_type = ? AND protocol = ?'
+        if domain:
+            select += f' AND ip NOT IN (SELECT ip FROM disabled_domains WHERE domain = ? AND {NOT_EXPIRED})'
+        now = time.time() if now is None else now
+        selects, params = [], []
+        for value in get_protocols(protocol):
+            selects.append(select)
+            params.extend((nick_type, value, domain, now) if domain else (nick_type, value))
+        sql = f'{" UNION ALL ".join(selects)} ORDER BY score DESC, speed LIMIT ?'
+        return sql, (*params, count or -1)
+
+    @metrics.timed('sqlite_operation_seconds', operation='get_proxies')
+    def get_proxies(self, protocol=None, domain=None, nick_type=0, count=0, projection=None):
+        """
+        根据协议类型、要访问网站的域名和匿名程度, 获取代理IP列表，可以指定要获取的代理IP的个数
+        :param protocol: 协议类型(http, https), 默认值为None, 表示http和https都支持
+        :param domain: 要访问网站的域名, 默认值为None, 表示不指定域名
+        :param count: 查询数量, 默认值为0, 表示不指定数量
+        :param nick_type: 匿名程度(高匿:0, 匿名:1, 透明:2), 默认值为0, 表示高匿
+        :param projection: 要返回的字段, 默认值为None, 表示返回所有字段(排序用到的score和speed总是返回)
+        :return: 返回满足条件的代理IP列表
+        """
+        sql, params = self._proxies_query(protocol, domain, nick_type, count, projection)
+        return list(Proxy.from_documents(self._query(sql, params)))
+
+    @metrics.timed('sqlite_operation_seconds', operation='disable_domains')
+    def disable_domains(self, pairs, expire_hours=DISABLE_DOMAIN_EXPIRE_HOURS):
+        """在一个事务中批量禁用多个代理IP访问对应的域名
+        :param pairs: (ip, 域名)列表
+        :param expire_hours: 经过多少小时自动解除禁用, 0表示永久禁用
+        :return: 返回(到期时间的时间戳, 写入失败的pairs下标集合), 事务要么全部成功, 要么全部失败
+        """
+        now = time.time()
+        expire_at = now + expire_hours * 3600 if expire_hours else None
+        if not pairs:
+            return expire_at, set()
+        try:
+            with self.transaction() as connection:
+                connection.executemany(DISABLE_DOMAIN_SQL, [(domain, ip, expire_at, now) for ip, domain in pairs])
+        except sqlite3.Error as e:
+            logger.error(f'disable domains error: {e}')
+            return expire_at, set(range(len(pairs)))
+        finally:
+            self._writes += 1
+        return expire_at, set()
+
+    def buffer_disable_domain(self, ip, domain, expire_hours=DISABLE_DOMAIN_EXPIRE_HOURS):
+        """把禁用操作放入缓冲区, 缓冲区满或超时后批量写入
+        :return: 返回到期时间的时间戳, 永久禁用时返回None
+        """
+        expire_at = time.time() + expire_hours * 3600 if expire_hours else None
+        # updated_at在写入时生成, 其他工作进程的内存索引下一次增量拉取时就能拉取到这条禁用记录
+        self.disabled_writer.add(lambda now: (DISABLE_DOMAIN_SQL, (domain, ip, expire_at, now)))
+        return expire_at
+
+    @metrics.timed('sqlite_operation_seconds', operation='find_existing_ips')
+    def find_existing_ips(self, ips):
+        """查询数据库中存在的代理IP
+        :param ips: 要查询的ip列表
+        :return: 返回其中存在的ip集合
+        """
+        existing = set()
+        ips = list(ips)
+        # 每条语句的参数数量有上限, 分批查询
+        for start in range(0, len(ips), 500):
+            batch = ips[start:start + 500]
+            sql = f'SELECT ip FROM proxies WHERE ip IN ({", ".join("?" * len(batch))})'
+            existing.update(item['ip'] for item in self._query(sql, batch))
+        return existing
+
+    @metrics.timed('sqlite_operation_seconds', operation='get_disabled_ips')
+    def get_disabled_ips(self, domain):
+        """获取在指定域名下被禁用的代理IP集合"""
+        sql = f'SELECT ip FROM disabled_domains WHERE domain = ? AND {NOT_EXPIRED}'
+        return {item['ip'] for item in self._query(sql, (domain, time.time()))}
+
+    @metrics.timed('sqlite_operation_seconds', operation='find_disabled_since')
+    def find_disabled_since(self, timestamp=None):
+        """查询updated_at不早于指定时间的禁用记录
+        :param timestamp: 时间戳, 默认值为None, 表示查询所有禁用记录, 同时删除已经到期的记录
+        :return: 返回(域名, ip, 到期时间的时间戳)的生成器, 永久禁用时到期时间为None
+        """
+        if timestamp is None:
+            self._execute('DELETE FROM disabled_domains WHERE expire_at <= ?', (time.time(),))
+            items = self._query('SELECT domain, ip, expire_at FROM disabled_domains')
+        else:
+            items = self._query('SELECT domain, ip, expire_at FROM disabled_domains WHERE updated_at >= ?',
+                                (timestamp,))
+        for item in items:
+            yield item['domain'], item['ip'], item['expire_at']
+
+    @metrics.timed('sqlite_operation_seconds', operation='find_deleted_since')
+    def find_deleted_since(self, timestamp):
+        """查询删除时间不早于指定时间的删除记录
+        :return: 返回(ip, 删除时间)的生成器
+        """
+        for item in self._query('SELECT ip, updated_at FROM deleted_proxies WHERE updated_at >= ?', (timestamp,)):
+            yield item['ip'], item['updated_at']
+
+    def migrate_disable_domains(self, expire_hours=DISABLE_DOMAIN_EXPIRE_HOURS):
+        """SQLite中的禁用记录从一开始就保存在disabled_domains表中, 不需要迁移"""
+        return 0
+
+    def buffer_feedback(self, ip, domain, successes, samples, latency_sum, latency_samples):
+        """把爬虫反馈的计数放入批量写入的缓冲区, 以(域名, ip)为主键upsert并累加计数, updated_at在写入时生成"""
+        self.feedback_writer.add(lambda now: (FEEDBACK_SQL, (domain, ip, successes, samples, latency_sum,
+                                                             latency_samples, now, now + FEEDBACK_EXPIRE_SECONDS)))
+
+    @metrics.timed('sqlite_operation_seconds', operation='find_feedback')
+    def find_feedback(self, timestamp=None):
+        """查询还没有到期、updated_at不早于指定时间的反馈计数, 查询所有计数时同时删除已经到期的记录
+        :param timestamp: 时间戳, 默认值为None, 表示查询所有还没有到期的计数
+        :return: 返回(ip, 域名, 成功次数, 反馈次数, 延迟之和, 有延迟的成功反馈次数, 更新时间)的生成器
+        """
+        now = time.time()
+        sql = ('SELECT ip, domain, successes, samples, latency_sum, latency_samples, updated_at FROM proxy_feedback '
+               'WHERE expire_at > ?')
+        if timestamp is None:
+            self._execute('DELETE FROM proxy_feedback WHERE expire_at <= ?', (now,))
+            items = self._query(sql, (now,))
+        else:
+            items = self._query(f'{sql} AND updated_at >= ?', (now, timestamp))
+        for item in items:
+            yield (item['ip'], item['domain'], item['successes'], item['samples'], item['latency_sum'],
+                   item['latency_samples'], item['updated_at'])
+
+    def explain_hot_queries(self, count=0):
+        """使用EXPLAIN QUERY PLAN检查热点查询的执行计划, 返回结果的格式和MongoPool.explain_hot_queries一致
+        - indexed: 没有全表扫描(SCAN proxies)
+        - sorted: 没有使用临时B树排序(USE TEMP B-TREE FOR ORDER BY)
+        - covered: 读取proxies表时都使用了覆盖索引(COVERING INDEX)
+        """
+        queries = []
+        for protocol in (None, 'http', 'https'):
+            queries.append((f'get_proxies(protocol={protocol})', self._proxies_query(protocol, count=count)))
+            queries.append((f'get_random_proxy(protocol={protocol})',
+                            self._proxies_query(protocol, count=count, projection=RANDOM_PROXY_PROJECTION)))
+            queries.append((f'get_random_proxy(protocol={protocol}, weighted)',
+                            self._proxies_query(protocol, projection=WEIGHTED_PROXY_PROJECTION)))
+            queries.append((f'get_proxies(protocol={protocol}, domain)',
+                            self._proxies_query(protocol, domain='example.com', count=count)))
+
+        results = []
+        for name, (sql, params) in queries:
+            with self._lock:
+                stages = [row[3] for row in self.connection.execute(f'EXPLAIN QUERY PLAN {sql}', params)]
+            reads = [stage for stage in stages if re.match(r'(SCAN|SEARCH) proxies\b', stage)]
+            results.append({
+                'name': name,
+                'stages': stages,
+                'indexes': sorted({match for stage in stages for match in re.findall(r'INDEX (\w+)', stage)}),
+                'indexed': not any(re.fullmatch(r'SCAN proxies', stage) for stage in stages),
+                'sorted': not any('TEMP B-TREE' in stage for stage in stages),
+                'covered': all('COVERING INDEX' in stage for stage in reads),
+            })
+        return results
+
+    def close(self):
+        """写入缓冲区中剩余的操作, 然后关闭数据库连接"""
+        self.flush()
+        with self._lock:
+            self.connection.close()
+
+    def __del__(self):
+        """关闭数据库连接"""
+        try:
+            self.close()
+        except Exception as e:
+            logger.error(f'Error closing SQLite connection: {e}')
+
@@ -0,0 +1,235 @@
+"""
+代理池的存储接口
+- 作用: 定义检测模块、爬虫模块和Web API使用的数据库操作方法, 具体的存储后端实现这些方法
+- 存储后端由配置项STORAGE_BACKEND选择:
+  1. mongo: MongoDB(core/db/mongo_pool.py), 多台机器共享同一个代理池
+  2. sqlite: 本地的SQLite数据库文件(core/db/sqlite_pool.py), 不需要外部服务, 适合单机部署、开发和压测
+- 和存储后端无关的逻辑(随机选择代理IP、禁用单个代理IP)在这里实现, 存储后端只需要实现基础的查询和写入
+"""
+import importlib
+import random
+from abc import ABC, abstractmethod
+from core.weighted_selector import WEIGHT_POLICIES
+from settings import STORAGE_BACKEND, RANDOM_PROXY_POLICY, DISABLE_DOMAIN_EXPIRE_HOURS
+
+# 随机获取一个代理IP时只需要返回的字段, 这些字段都包含在复合索引中, 因此不指定域名时查询可以被索引覆盖
+RANDOM_PROXY_PROJECTION = {'_id': 0, 'ip': 1, 'port': 1, 'protocol': 1}
+# 按照权重随机获取一个代理IP时还需要计算权重的字段, 同样包含在复合索引中
+WEIGHTED_PROXY_PROJECTION = {**RANDOM_PROXY_PROJECTION, 'score': 1, 'speed': 1}
+
+# 存储后端的名称和实现类
+STORAGE_BACKENDS = {
+    'mongo': 'core.db.mongo_pool.MongoPool',
+    'sqlite': 'core.db.sqlite_pool.SqlitePool',
+}
+
+
+def get_protocols(protocol=None):
+    """根据要求的协议类型, 返回满足条件的protocol字段的取值
+    :param protocol: 协议类型(http, https), 默认值为None, 表示http和https都支持
+    """
+    # 如果协议类型为None, 则表示查询http和https都支持的代理IP, protocol的值为2
+    if protocol is None:
+        return [2]
+    # 如果协议类型为http, 则表示查询支持http的代理IP, protocol的值为0或2
+    if protocol.lower() == 'http':
+        return [0, 2]
+    # 如果协议类型为https, 则表示查询支持https的代理IP, protocol的值为1或2
+    return [1, 2]
+
+
+class Storage(ABC):
+    """存储接口, 存储后端继承这个类并实现下面的抽象方法, 缺少任何一个抽象方法的存储后端在创建对象时就会报错"""
+
+    @property
+    @abstractmethod
+    def version(self):
+        """数据版本, 通过这个对象写入数据库后会增大, 用于让API的响应缓存失效"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def insert_one(self, proxy):
+        """保存代理IP到数据库中, 已经存在时不做修改"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def update_one(self, proxy):
+        """更新代理IP"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def delete_one(self, proxy):
+        """删除代理IP"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def buffer_insert(self, proxy):
+        """把代理IP放入批量写入的缓冲区, 代理IP不存在时插入, 已经存在时不做修改"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def buffer_update(self, proxy, fields, inc=None, touch=True):
+        """把代理IP的修改放入批量写入的缓冲区, 只写入发生变化的字段"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def buffer_served(self, ip, count):
+        """把代理IP被API提供的次数放入批量写入的缓冲区, 累加到served字段"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def buffer_delete(self, proxy):
+        """把代理IP的删除放入批量写入的缓冲区"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def flush(self):
+        """立即写入缓冲区中的所有操作"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def find_all(self, batch_size=0):
+        """查询所有代理IP, 返回Proxy对象的生成器"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def iter_keys(self):
+        """查询所有代理IP的ip和port, 返回(ip, port)的生成器"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def find_updated_since(self, timestamp=None):
+        """查询updated_at不早于指定时间的代理IP, 返回(Proxy对象, updated_at)的生成器"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def find_due(self, count=0, now=None):
+        """按照下次检测时间从早到晚, 查询已经到期的代理IP, 返回(Proxy对象, 自上次检测以来被API提供的次数)的生成器"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_next_check(self):
+        """获取最早的下次检测时间, 数据库中没有代理IP时返回None"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def find(self, conditions={}, count=0, projection=None):
+        """根据条件查询代理IP, 按照分数降序, 然后速度升序, 返回代理IP列表"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_proxies(self, protocol=None, domain=None, nick_type=0, count=0, projection=None):
+        """根据协议类型、要访问网站的域名和匿名程度, 获取代理IP列表, 排除在这个域名下被禁用的代理IP"""
+        raise NotImplementedError
+
+    def get_random_proxy(self, protocol=None, domain=None, nick_type=0, count=0, policy=RANDOM_PROXY_POLICY):
+        """根据协议类型、要访问网站的域名和匿名程度,随机获取一个代理IP
+        :param protocol: 协议类型(http, https), 默认值为None, 表示http和https都支持
+        :param domain: 要访问网站的域名, 默认值为None, 表示不指定域名
+        :param nick_type: 匿名程度(高匿:0, 匿名:1, 透明:2), 默认值为0, 表示高匿
+        :param count: 获取随机代理IP的范围, 默认值为0, 表示在所有满足条件的代理IP中随机获取一个, 只用于top策略
+        :param policy: 选择策略, top表示在排名靠前的count个代理IP中等概率选择, 其他策略见WEIGHT_POLICIES,
+                       在所有满足条件的代理IP中按照权重选择
+        :return: 返回一个满足条件的代理IP, 只包含ip、port和protocol字段(按照权重选择时还包含score和speed字段)
+        """
+        if policy == 'top':
+            # 调用get_proxies方法获取满足条件的代理IP列表, 只查询ip、port和protocol字段
+            proxy_list = self.get_proxies(
+                protocol=protocol, domain=domain, nick_type=nick_type, count=count, projection=RANDOM_PROXY_PROJECTION
+            )
+            weights = None
+        else:
+            # 查询所有满足条件的代理IP, 还需要计算权重的score和speed字段
+            proxy_list = self.get_proxies(
+                protocol=protocol, domain=domain, nick_type=nick_type, projection=WEIGHTED_PROXY_PROJECTION
+            )
+            weights = [WEIGHT_POLICIES[policy](proxy) for proxy in proxy_list]
+            if sum(weights) <= 0:
+                return None
+        # 如果代理IP列表不为空, 则随机返回一个代理IP
+        if proxy_list:
+            return random.choices(proxy_list, weights=weights)[0]
+        # 如果代理IP列表为空, 则返回None
+        else:
+            return None
+
+    def disable_domain(self, ip, domain, expire_hours=DISABLE_DOMAIN_EXPIRE_HOURS):
+        """禁用指定代理IP访问指定域名, 已经禁用时重新计算到期时间
+        :param expire_hours: 经过多少小时自动解除禁用, 0表示永久禁用
+        :return: 返回到期时间的时间戳, 永久禁用时返回None
+        """
+        expire_at, _ = self.disable_domains([(ip, domain)], expire_hours=expire_hours)
+        return expire_at
+
+    @abstractmethod
+    def disable_domains(self, pairs, expire_hours=DISABLE_DOMAIN_EXPIRE_HOURS):
+        """批量禁用多个代理IP访问对应的域名, 返回(到期时间的时间戳, 写入失败的pairs下标集合)"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def buffer_disable_domain(self, ip, domain, expire_hours=DISABLE_DOMAIN_EXPIRE_HOURS):
+        """把禁用操作放入缓冲区, 缓冲区满或超时后批量写入, 返回到期时间的时间戳"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def find_existing_ips(self, ips):
+        """查询数据库中存在的代理IP, 返回其中存在的ip集合"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_disabled_ips(self, domain):
+        """获取在指定域名下被禁用的代理IP集合"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def find_disabled_since(self, timestamp=None):
+        """查询updated_at不早于指定时间的禁用记录, 返回(域名, ip, 到期时间的时间戳)的生成器"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def find_deleted_since(self, timestamp):
+        """查询删除时间不早于指定时间的删除记录, 删除记录保存DELETED_PROXY_EXPIRE_SECONDS秒
+        :return: 返回(ip, 删除时间)的生成器
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def buffer_feedback(self, ip, domain, successes, samples, latency_sum, latency_samples):
+        """把爬虫反馈的计数放入批量写入的缓冲区, 每个(域名, ip)只保存一条记录, 计数以累加的方式写入,
+        多个工作进程同时写入时不会互相覆盖, FEEDBACK_EXPIRE_SECONDS秒没有更新后到期
+        :param domain: 域名, 空字符串表示这个代理IP在所有域名下的统计
+        :param successes: 自上次写入以来新增的成功次数
+        :param samples: 自上次写入以来新增的反馈次数
+        :param latency_sum: 自上次写入以来新增的成功反馈的延迟之和(秒)
+        :param latency_samples: 自上次写入以来新增的有延迟的成功反馈次数
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def find_feedback(self, timestamp=None):
+        """查询还没有到期、updated_at不早于指定时间的反馈计数
+        :param timestamp: 时间戳, 默认值为None, 表示查询所有还没有到期的计数
+        :return: 返回(ip, 域名, 成功次数, 反馈次数, 延迟之和, 有延迟的成功反馈次数, 更新时间)的生成器
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def explain_hot_queries(self, count=0):
+        """检查热点查询的执行计划, 返回每个热点查询的检查结果列表, 格式见MongoPool.explain_hot_queries"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def close(self):
+        """写入缓冲区中剩余的操作, 然后关闭数据库连接"""
+        raise NotImplementedError
+
+
+def create_pool(backend=None):
+    """按照配置创建存储后端的数据库操作对象, 只导入用到的后端, 使用sqlite时不需要连接MongoDB
+    :param backend: 存储后端的名称, 默认值为None, 表示使用STORAGE_BACKEND
+    """
+    backend = backend or STORAGE_BACKEND
+    if backend not in STORAGE_BACKENDS:
+        raise ValueError(f'unknown storage backend: {backend}, choose from {list(STORAGE_BACKENDS)}')
+    module_name, class_name = STORAGE_BACKENDS[backend].rsplit('.', 1)
+    return getattr(importlib.import_module(module_name), class_name)()
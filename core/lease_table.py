@@ -0,0 +1,199 @@
+"""
+代理IP租约模块
+- 作用: 爬虫通过租约独占使用一个代理IP访问某个域名, 租约到期或者归还之前, 同一个域名不会再把这个代理IP租给别人,
+  避免大量爬虫同时拿到同一个排名靠前的代理IP访问同一个网站, 导致它很快被封禁
+- 实现:
+  1. 租约保存在共享内存中的定长哈希表(LeaseSlots), 在fork工作进程之前创建, 所有API工作进程看到同一份租约,
+     任何一个工作进程都可以归还或续期租约; 租用和归还只修改内存, 不写入数据库
+  2. 每个槽位以 (域名, ip) 的哈希值为键, 保存租约的序号和到期时间, 到期的槽位可以直接复用, 不需要清理
+  3. 租约编号由槽位下标和序号组成, 槽位被复用后旧的租约编号自动失效
+  4. 工作进程是gevent的协程服务器, 等待跨进程的锁时不能阻塞整个进程的事件循环: 先不阻塞地尝试获取锁,
+     失败时先gevent.sleep(0)让出给其他协程, 再逐渐延长等待时间后重试; 持有锁期间只读写共享内存, 不会切换协程, 临界区很短
+  5. 每个工作进程为每个 (域名, 协议类型, 匿名程度) 维护一个轮换队列(LeaseTable), 保存排名靠前的LEASE_CANDIDATES个代理IP,
+     按照最近一次租出的时间从早到晚排列, 每次租出队列中最久没有租出、并且当前没有被租用的代理IP, 然后把它移到队尾
+  6. 数据源(内存索引、代理池快照或数据库)发生变化或者超过LEASE_ROTATION_REFRESH_SECONDS秒后重新获取候选代理IP,
+     新出现的代理IP排在队首, 已有的代理IP保持原来的顺序
+"""
+import hashlib
+import mmap
+import multiprocessing
+import struct
+import threading
+import time
+from collections import OrderedDict
+import gevent
+from settings import LEASE_TABLE_SLOTS, LEASE_MAX_PROBES, LEASE_CANDIDATES, LEASE_ROTATION_REFRESH_SECONDS
+from settings import LEASE_TTL_SECONDS
+from utils import metrics
+
+# 文件头: 下一个租约序号
+HEADER = struct.Struct('<Q')
+# 槽位: (域名, ip)的哈希值(0表示从未使用), 租约序号, 到期时间
+SLOT = struct.Struct('<QQd')
+# 等待其他工作进程释放锁的最长时间(秒), 超时说明持有锁的进程异常退出
+LOCK_TIMEOUT_SECONDS = 1
+# 获取锁失败后重试的等待时间(秒), 每次重试翻倍, 最长LOCK_RETRY_MAX_SECONDS
+LOCK_RETRY_SECONDS = 0.00005
+LOCK_RETRY_MAX_SECONDS = 0.001
+
+
+def lease_key(domain, ip):
+    """(域名, ip)的64位哈希值, 所有进程计算的结果相同, 0保留表示空槽位"""
+    digest = hashlib.blake2b(f'{domain}|{ip}'.encode(), digest_size=8).digest()
+    return int.from_bytes(digest, 'little') or 1
+
+
+class LeaseSlots:
+    """共享内存中的租约哈希表, 采用线性探测, 最多探测LEASE_MAX_PROBES个槽位"""
+    def __init__(self, size=LEASE_TABLE_SLOTS):
+        """初始化方法, 必须在fork工作进程之前创建, 工作进程通过继承的匿名共享内存和锁访问同一份租约
+        :param size: 槽位数量, 需要大于同时有效的租约数量
+        """
+        self.size = size
+        self._mmap = mmap.mmap(-1, HEADER.size + SLOT.size * size)
+        # 跨进程的锁, 保证检查和写入槽位是原子的
+        self._lock = multiprocessing.Lock()
+
+    def _acquire_lock(self):
+        """获取跨进程的锁, 锁被其他工作进程持有时让出给本进程的其他协程, 然后重试, 不阻塞事件循环"""
+        deadline = time.monotonic() + LOCK_TIMEOUT_SECONDS
+        wait = 0
+        while not self._lock.acquire(block=False):
+            if time.monotonic() >= deadline:
+                raise TimeoutError('lease table lock timeout')
+            # 第一次只让出给其他协程, 之后逐渐延长等待时间, 让出CPU给持有锁的进程, 避免空转
+            gevent.sleep(wait)
+            wait = min(wait * 2 or LOCK_RETRY_SECONDS, LOCK_RETRY_MAX_SECONDS)
+
+    def _slot(self, index):
+        return SLOT.unpack_from(self._mmap, HEADER.size + SLOT.size * index)
+
+    def _find(self, key, now):
+        """查找键所在的槽位, 返回(槽位下标, 槽位的值), 不存在时返回(可以使用的槽位下标, None), 没有可用的槽位时下标为None"""
+        free = None
+        for probe in range(LEASE_MAX_PROBES):
+            index = (key + probe) % self.size
+            slot = self._slot(index)
+            if slot[0] == key:
+                return index, slot
+            if slot[0] == 0:
+                # 空槽位之后不会再有这个键
+                return (index if free is None else free), None
+            if free is None and slot[2] <= now:
+                # 到期的槽位可以被其他键复用
+                free = index
+        return free, None
+
+    def acquire(self, candidates, ttl, now=None):
+        """在候选中按照顺序租出第一个当前没有被租用的
+        :param candidates: (键, 候选对象)的可迭代对象
+        :param ttl: 租约的有效时间(秒)
+        :return: 返回(候选对象, 租约编号, 到期时间), 所有候选都已经被租用时返回None
+        """
+        now = time.time() if now is None else now
+        self._acquire_lock()
+        try:
+            for key, item in candidates:
+                index, slot = self._find(key, now)
+                if index is None or (slot is not None and slot[2] > now):
+                    continue
+                seq, = HEADER.unpack_from(self._mmap, 0)
+                seq += 1
+                HEADER.pack_into(self._mmap, 0, seq)
+                SLOT.pack_into(self._mmap, HEADER.size + SLOT.size * index, key, seq, now + ttl)
+                return item, f'{index:x}-{seq:x}', now + ttl
+            return None
+        finally:
+            self._lock.release()
+
+    def _update(self, lease_id, expires_at, now):
+        """修改有效租约的到期时间, 返回是否修改成功"""
+        try:
+            index, seq = (int(part, 16) for part in lease_id.split('-'))
+        except (AttributeError, ValueError):
+            return False
+        if not 0 <= index < self.size:
+            return False
+        self._acquire_lock()
+        try:
+            key, slot_seq, slot_expires_at = self._slot(index)
+            if slot_seq != seq or slot_expires_at <= now:
+                return False
+            SLOT.pack_into(self._mmap, HEADER.size + SLOT.size * index, key, seq, expires_at)
+            return True
+        finally:
+            self._lock.release()
+
+    def release(self, lease_id, now=None):
+        """归还租约, 租约不存在或者已经到期时返回False"""
+        now = time.time() if now is None else now
+        return self._update(lease_id, now, now)
+
+    def renew(self, lease_id, ttl, now=None):
+        """续期租约, 返回新的到期时间, 租约不存在或者已经到期时返回None"""
+        now = time.time() if now is None else now
+        return now + ttl if self._update(lease_id, now + ttl, now) else None
+
+
+class LeaseTable:
+    def __init__(self, proxy_source, slots=None):
+        """初始化方法
+        :param proxy_source: 获取候选代理IP的数据源, 需要提供get_proxies方法和version属性
+        :param slots: 共享的LeaseSlots, 默认值为None, 表示创建只在本进程中使用的租约表
+        """
+        self.proxy_source = proxy_source
+        self.slots = slots if slots is not None else LeaseSlots()
+        # (域名, 协议类型, 匿名程度) -> (数据源的版本, 获取的时间, OrderedDict(ip -> (键, Proxy对象)))
+        self._rotations = {}
+        self._lock = threading.Lock()
+
+    def _rotation(self, domain, protocol, nick_type, now):
+        """返回轮换队列, 数据源发生变化或者超过刷新间隔时重新获取候选代理IP"""
+        rotation_key = (domain, protocol, nick_type)
+        version = self.proxy_source.version
+        cached = self._rotations.get(rotation_key)
+        if cached is not None and cached[0] == version and now - cached[1] < LEASE_ROTATION_REFRESH_SECONDS:
+            return cached[2]
+        proxies = self.proxy_source.get_proxies(protocol=protocol, domain=domain, nick_type=nick_type,
+                                                count=LEASE_CANDIDATES)
+        candidates = {proxy.ip: proxy for proxy in proxies}
+        old = cached[2] if cached is not None else OrderedDict()
+        # 新出现的代理IP从来没有租出过, 按照排名排在队首; 已有的代理IP保持原来的顺序
+        rotation = OrderedDict((ip, (lease_key(domain, ip), proxy)) for ip, proxy in candidates.items()
+                               if ip not in old)
+        for ip in old:
+            if ip in candidates:
+                rotation[ip] = (old[ip][0], candidates[ip])
+        self._rotations[rotation_key] = (version, now, rotation)
+        return rotation
+
+    def acquire(self, domain=None, protocol=None, nick_type=0, ttl=LEASE_TTL_SECONDS):
+        """租用一个代理IP访问指定域名
+        :param domain: 要访问网站的域名, 默认值为None, 表示不区分域名
+        :param ttl: 租约的有效时间(秒), 默认值为LEASE_TTL_SECONDS
+        :return: 返回(Proxy对象, 租约编号, 到期时间), 没有可以租用的代理IP时返回None
+        """
+        now = time.time()
+        with self._lock:
+            rotation = self._rotation(domain or '', protocol, nick_type, now)
+            result = self.slots.acquire(rotation.values(), ttl, now)
+            if result is None:
+                metrics.inc('lease_acquire_total', result='exhausted')
+                return None
+            proxy = result[0]
+            # 刚租出的代理IP移到队尾, 队首总是最久没有租出的
+            rotation.move_to_end(proxy.ip)
+        metrics.inc('lease_acquire_total', result='ok')
+        return result
+
+    def release(self, lease_id):
+        """归还租约, 返回是否归还成功"""
+        released = self.slots.release(lease_id)
+        metrics.inc('lease_release_total', result='ok' if released else 'not_found')
+        return released
+
+    def renew(self, lease_id, ttl):
+        """续期租约, 返回新的到期时间, 租约不存在或者已经到期时返回None"""
+        expires_at = self.slots.renew(lease_id, ttl)
+        metrics.inc('lease_renew_total', result='ok' if expires_at is not None else 'not_found')
+        return expires_at
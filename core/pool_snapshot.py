@@ -0,0 +1,485 @@
+"""
+代理池快照模块
+- 作用: Web API的多个工作进程共享同一份只读的代理池快照, 不再各自加载和刷新内存索引,
+  内存占用和刷新数据库的开销不随工作进程的数量增长
+- 实现:
+  1. 快照发布进程(SnapshotPublisher)维护一份ProxyIndex, 定期增量拉取、全量重建, 发生变化后把代理池写入快照文件
+  2. 快照是紧凑的二进制格式, 先写入临时文件, 再通过os.replace原子替换, 读取方不会看到写了一半的快照
+  3. 工作进程(SnapshotReader)以mmap只读映射快照文件, 所有工作进程共享操作系统的页缓存, 读取时不复制数据;
+     定期检查文件是否被替换, 映射新的文件后整体切换, 正在处理的请求仍然读取旧的映射
+  4. 快照中代理IP按照 (协议类型, 匿名程度) 分桶, 桶内按照分数降序、速度升序排列, 和ProxyIndex一致;
+     每个桶为每种权重策略保存权重的前缀和, 按照权重选择时二分查找, 耗时为O(log n)
+  5. 禁用记录按照域名保存排好序的代理IP序号和到期时间, 判断是否被禁用时二分查找;
+     工作进程自己写入的禁用记录先保存在本地, 直到新的快照中确实包含这条禁用记录才删除;
+     禁用记录是批量写入的, 发布进程生成快照时可能还没有写入数据库, 因此不能只根据快照的生成时间删除
+- 快照文件的格式(小端字节序):
+  - 文件头: 魔数、格式版本、数据版本、生成时间, 以及每个数据段的(偏移, 长度)
+  - buckets: 每个桶的协议类型、匿名程度、第一个代理IP的序号、代理IP的数量
+  - records: 每个代理IP一条定长记录, 见RECORD
+  - weights: 每个桶每种权重策略的权重前缀和(float64)
+  - ipv4: 所有IPv4地址(uint32)排好序, 用于判断代理IP是否存在; string_ips: 不是IPv4地址的ip在字符串表中的序号
+  - strings: 字符串表, 保存地区名称、域名以及不是IPv4地址的ip和端口
+  - domains: 每个域名在字符串表中的序号, 以及它的禁用记录在disabled和expires中的起始位置和数量
+  - disabled: 被禁用的代理IP的序号(uint32), 按照域名分段, 段内排好序; expires: 对应的到期时间, NaN表示永久禁用
+"""
+import bisect
+import heapq
+import itertools
+import math
+import mmap
+import os
+import random
+import socket
+import struct
+import threading
+import time
+from core.proxy_index import ProxyIndex
+from core.weighted_selector import WEIGHT_POLICIES
+from model import Proxy
+from settings import PROXY_SNAPSHOT_PATH, PROXY_SNAPSHOT_POLL_SECONDS, PROXY_INDEX_REFRESH_SECONDS
+from settings import PROXY_INDEX_OVERLAP_SECONDS, RANDOM_PROXY_POLICY, RANDOM_PROXY_MAX_TRIES
+from settings import BULK_WRITE_FLUSH_SECONDS
+from utils.log import logger
+from utils import metrics
+
+MAGIC = b'IPPS'
+# 快照格式的版本, 格式发生不兼容的变化时加1
+FORMAT_VERSION = 1
+SECTIONS = ('buckets', 'records', 'weights', 'ipv4', 'string_ips', 'strings', 'domains', 'disabled', 'expires')
+# 魔数, 格式版本, 保留, 数据版本, 生成时间, 然后是每个数据段的(偏移, 长度)
+HEADER = struct.Struct('<4sHHQd' + 'II' * len(SECTIONS))
+# 协议类型, 匿名程度, 第一个代理IP的序号, 代理IP的数量
+BUCKET = struct.Struct('<bbxxII')
+# ip, port, speed, score, 地区在字符串表中的序号, 协议类型, 匿名程度, 标记
+RECORD = struct.Struct('<IIdiIbbBx')
+# 域名在字符串表中的序号, 禁用记录的起始位置, 禁用记录的数量
+DOMAIN = struct.Struct('<III')
+# 记录的标记: ip、port保存在字符串表中, speed是整数
+IP_STRING, PORT_STRING, SPEED_INT = 1, 2, 4
+# 没有字符串(地区为None)
+NO_STRING = 0xFFFFFFFF
+POLICIES = tuple(WEIGHT_POLICIES)
+
+_NAN = float('nan')
+
+
+def _get_protocols(protocol):
+    """根据请求的协议类型, 返回满足条件的protocol取值, 和ProxyIndex一致"""
+    if protocol is None:
+        return (2,)
+    elif protocol.lower() == 'http':
+        return (0, 2)
+    else:
+        return (1, 2)
+
+
+def _align(data):
+    """数据段按照8字节对齐"""
+    data.extend(b'\0' * (-len(data) % 8))
+
+
+def build_snapshot(buckets, disabled, version, generated_at, now=None):
+    """把ProxyIndex导出的分桶和禁用记录编码为快照
+    :param buckets: (protocol, nick_type) -> 按排序键排好序的 (-score, speed, ip, proxy) 列表
+    :param disabled: 域名 -> {ip: 到期时间的时间戳}
+    :param version: 数据版本, 每次发布都要增大
+    :param generated_at: 生成快照的数据从数据库拉取的时间
+    :return: 快照的字节串
+    """
+    now = time.time() if now is None else now
+    strings, string_ids = [], {}
+
+    def string_id(value):
+        if value not in string_ids:
+            string_ids[value] = len(strings)
+            strings.append(value)
+        return string_ids[value]
+
+    sections = {name: bytearray() for name in SECTIONS}
+    positions = {}
+    ipv4, string_ips = [], []
+    for bucket_key in sorted(buckets, key=lambda key: (key[0], key[1])):
+        bucket = buckets[bucket_key]
+        start = len(positions)
+        sections['buckets'] += BUCKET.pack(bucket_key[0], bucket_key[1], start, len(bucket))
+        proxies = [entry[3] for entry in bucket]
+        for proxy in proxies:
+            ip, port, protocol, nick_type, speed, area, score = proxy.to_packed()
+            flags = 0
+            if type(ip) is int:
+                ipv4.append(ip)
+            else:
+                ip = string_id(ip)
+                string_ips.append(ip)
+                flags |= IP_STRING
+            if type(port) is not int:
+                port = string_id(port)
+                flags |= PORT_STRING
+            if type(speed) is int:
+                flags |= SPEED_INT
+            positions[proxy.ip] = len(positions)
+            sections['records'] += RECORD.pack(ip, port, speed, int(score),
+                                               NO_STRING if area is None else string_id(area),
+                                               protocol, nick_type, flags)
+        for policy in POLICIES:
+            weight = WEIGHT_POLICIES[policy]
+            sections['weights'] += struct.pack(f'<{len(proxies)}d',
+                                               *itertools.accumulate(weight(proxy) for proxy in proxies))
+    sections['ipv4'] += struct.pack(f'<{len(ipv4)}I', *sorted(ipv4))
+    sections['string_ips'] += struct.pack(f'<{len(string_ips)}I', *string_ips)
+
+    # 只保存代理池中存在并且没有到期的禁用记录
+    for domain in sorted(disabled):
+        entries = sorted((positions[ip], _NAN if expire_at is None else expire_at)
+                         for ip, expire_at in disabled[domain].items()
+                         if ip in positions and (expire_at is None or expire_at > now))
+        if not entries:
+            continue
+        sections['domains'] += DOMAIN.pack(string_id(domain), len(sections['disabled']) // 4, len(entries))
+        sections['disabled'] += struct.pack(f'<{len(entries)}I', *(entry[0] for entry in entries))
+        sections['expires'] += struct.pack(f'<{len(entries)}d', *(entry[1] for entry in entries))
+
+    encoded = [value.encode('utf-8') for value in strings]
+    offsets = list(itertools.accumulate((len(value) for value in encoded), initial=0))
+    sections['strings'] += struct.pack(f'<I{len(offsets)}I', len(encoded), *offsets) + b''.join(encoded)
+
+    data = bytearray(HEADER.size)
+    _align(data)
+    layout = []
+    for name in SECTIONS:
+        layout.extend((len(data), len(sections[name])))
+        data += sections[name]
+        _align(data)
+    HEADER.pack_into(data, 0, MAGIC, FORMAT_VERSION, 0, version, generated_at, *layout)
+    return bytes(data)
+
+
+def write_snapshot(data, path=PROXY_SNAPSHOT_PATH):
+    """先写入同一目录下的临时文件, 再原子替换快照文件, 已经映射旧文件的读取方不受影响"""
+    temp_path = f'{path}.{os.getpid()}.tmp'
+    with open(temp_path, 'wb') as f:
+        f.write(data)
+    os.replace(temp_path, path)
+
+
+class PoolSnapshot:
+    """映射到内存中的一个快照文件, 只读, 所有数据段都是mmap上的memoryview, 不复制数据"""
+    def __init__(self, path=PROXY_SNAPSHOT_PATH):
+        with open(path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(self._mmap)
+        magic, format_version, _, self.version, self.generated_at, *layout = HEADER.unpack_from(view, 0)
+        if magic != MAGIC or format_version != FORMAT_VERSION:
+            raise ValueError(f'unsupported proxy snapshot: {path}')
+        sections = {name: view[layout[2 * i]:layout[2 * i] + layout[2 * i + 1]] for i, name in enumerate(SECTIONS)}
+        self._records = sections['records']
+        self._weights = sections['weights'].cast('d')
+        self._ipv4 = sections['ipv4'].cast('I')
+        self._disabled = sections['disabled'].cast('I')
+        self._expires = sections['expires'].cast('d')
+        # 字符串表只有地区名称、域名等少量不同的值, 映射时解码一次
+        strings = sections['strings']
+        count, = struct.unpack_from('<I', strings, 0)
+        offsets = struct.unpack_from(f'<{count + 1}I', strings, 4)
+        base = 4 * (count + 2)
+        self._strings = [str(strings[base + offsets[i]:base + offsets[i + 1]], 'utf-8') for i in range(count)]
+        self._string_ips = {self._strings[i] for i in sections['string_ips'].cast('I')}
+        # (protocol, nick_type) -> (第一个代理IP的序号, 数量)
+        self._buckets = {(protocol, nick_type): (start, size)
+                         for protocol, nick_type, start, size in BUCKET.iter_unpack(sections['buckets'])}
+        # 域名 -> (禁用记录的起始位置, 数量)
+        self._domains = {self._strings[string]: (start, size)
+                         for string, start, size in DOMAIN.iter_unpack(sections['domains'])}
+        self.size = len(self._records) // RECORD.size
+
+    def __len__(self):
+        return self.size
+
+    def __contains__(self, ip):
+        try:
+            packed = int.from_bytes(socket.inet_pton(socket.AF_INET, ip), 'big')
+        except (OSError, TypeError):
+            return ip in self._string_ips
+        index = bisect.bisect_left(self._ipv4, packed)
+        return index < len(self._ipv4) and self._ipv4[index] == packed
+
+    def iter_bucket(self, bucket_key):
+        """按照排序遍历一个桶, 返回(序号, 记录)的生成器"""
+        start, size = self._buckets.get(bucket_key, (0, 0))
+        records = self._records[start * RECORD.size:(start + size) * RECORD.size]
+        return zip(range(start, start + size), RECORD.iter_unpack(records))
+
+    def is_disabled(self, domain, index, now):
+        """判断序号为index的代理IP是否在指定域名下被禁用, 到期的禁用记录视为已经解除"""
+        entry = self._domains.get(domain)
+        if entry is None:
+            return False
+        start, size = entry
+        position = bisect.bisect_left(self._disabled, index, start, start + size)
+        if position == start + size or self._disabled[position] != index:
+            return False
+        expire_at = self._expires[position]
+        return math.isnan(expire_at) or expire_at > now
+
+    def has_disabled(self, domain):
+        return domain in self._domains
+
+    def get_disabled(self, domain):
+        """返回指定域名的禁用记录: ip -> 到期时间的时间戳, 永久禁用时为None"""
+        start, size = self._domains.get(domain, (0, 0))
+        disabled = {}
+        for position in range(start, start + size):
+            record = RECORD.unpack_from(self._records, self._disabled[position] * RECORD.size)
+            expire_at = self._expires[position]
+            disabled[self.to_proxy(record).ip] = None if math.isnan(expire_at) else expire_at
+        return disabled
+
+    def choice(self, bucket_key, policy):
+        """在一个桶内按照权重随机选择, 返回(序号, 记录), 桶为空或者权重之和为0时返回None"""
+        start, size = self._buckets.get(bucket_key, (0, 0))
+        total = self.total(bucket_key, policy)
+        if total <= 0:
+            return None
+        offset = len(POLICIES) * start + POLICIES.index(policy) * size
+        weights = self._weights[offset:offset + size]
+        position = min(bisect.bisect_right(weights, random.random() * total), size - 1)
+        index = start + position
+        return index, RECORD.unpack_from(self._records, index * RECORD.size)
+
+    def total(self, bucket_key, policy):
+        """一个桶内所有代理IP在指定权重策略下的权重之和"""
+        start, size = self._buckets.get(bucket_key, (0, 0))
+        if not size:
+            return 0.0
+        return self._weights[len(POLICIES) * start + (POLICIES.index(policy) + 1) * size - 1]
+
+    def to_proxy(self, record):
+        """把一条记录转换为Proxy对象"""
+        ip, port, speed, score, area, protocol, nick_type, flags = record
+        strings = self._strings
+        return Proxy.from_packed(strings[ip] if flags & IP_STRING else ip,
+                                 strings[port] if flags & PORT_STRING else port,
+                                 protocol, nick_type, int(speed) if flags & SPEED_INT else speed,
+                                 None if area == NO_STRING else strings[area], score)
+
+
+def _sort_key(item):
+    """归并多个桶时的排序键: 分数降序, 然后速度升序"""
+    record = item[1]
+    return -record[3], record[2]
+
+
+class SnapshotReader:
+    """Web API工作进程中的代理IP数据源, 接口和ProxyIndex一致, 从共享的快照中获取代理IP"""
+    def __init__(self, path=PROXY_SNAPSHOT_PATH):
+        """初始化方法
+        :param path: 快照文件的路径
+        """
+        self.path = path
+        # 当前映射的快照, 切换时整体替换, 处理请求的线程每次只读取一次这个引用
+        self._snapshot = None
+        # 快照文件的标识(inode, 修改时间, 大小), 用于判断文件是否被替换
+        self._file_key = None
+        # 本进程写入但还没有出现在快照中的禁用记录: 域名 -> {ip: (到期时间的时间戳, 写入时间)}
+        self._local_disabled = {}
+        self._lock = threading.Lock()
+        # 本进程写入禁用记录的次数, 和快照的数据版本一起组成数据版本
+        self._local_writes = 0
+
+    @property
+    def version(self):
+        """数据版本, 切换到新的快照或者本进程写入禁用记录后发生变化, 用于让API的响应缓存失效"""
+        snapshot = self._snapshot
+        return (snapshot.version if snapshot is not None else 0) + self._local_writes
+
+    def start(self):
+        """映射当前的快照文件, 然后启动后台线程检查文件是否被替换"""
+        if not self.attach():
+            logger.warning(f'proxy snapshot {self.path} not found, waiting for the snapshot publisher')
+        threading.Thread(target=self._poll_forever, daemon=True).start()
+
+    def attach(self):
+        """快照文件被替换时映射新的文件并切换, 返回当前是否有可用的快照"""
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return self._snapshot is not None
+        file_key = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        if file_key == self._file_key:
+            return True
+        snapshot = PoolSnapshot(self.path)
+        with self._lock:
+            self._local_disabled = {domain: kept for domain, ips in self._local_disabled.items()
+                                    if (kept := self._pending_disabled(snapshot, domain, ips))}
+            self._snapshot = snapshot
+            self._file_key = file_key
+        metrics.inc('snapshot_attach_total')
+        logger.info(f'proxy snapshot attached: version {snapshot.version}, {len(snapshot)} proxies')
+        return True
+
+    @staticmethod
+    def _pending_disabled(snapshot, domain, ips, now=None):
+        """返回一个域名下还需要在本地保留的禁用记录
+        - 到期的禁用记录不再保留
+        - 快照中已经包含的禁用记录(到期时间不早于本地的)不再保留
+        - 快照中没有的代理IP无法被获取, 禁用记录写入数据库的最长等待时间(约1.5 * BULK_WRITE_FLUSH_SECONDS)
+          加上重叠时间之后, 发布进程一定已经拉取到这条禁用记录, 不再保留, 避免本地的禁用记录无限增长
+        """
+        now = time.time() if now is None else now
+        since = snapshot.generated_at - PROXY_INDEX_OVERLAP_SECONDS - 1.5 * BULK_WRITE_FLUSH_SECONDS
+        published = snapshot.get_disabled(domain)
+        kept = {}
+        for ip, (expire_at, written_at) in ips.items():
+            if expire_at is not None and expire_at <= now:
+                continue
+            if ip in published:
+                if published[ip] is None or (expire_at is not None and published[ip] >= expire_at):
+                    continue
+            elif ip not in snapshot and written_at < since:
+                continue
+            kept[ip] = (expire_at, written_at)
+        return kept
+
+    def _poll_forever(self):
+        """后台线程: 定期检查快照文件是否被替换"""
+        while True:
+            time.sleep(PROXY_SNAPSHOT_POLL_SECONDS)
+            try:
+                self.attach()
+            except Exception as e:
+                logger.exception(e)
+
+    def disable_domains(self, pairs, expire_at=None):
+        """在本进程中立即禁用多个代理IP访问对应的域名, 发布进程拉取到之后由快照覆盖
+        :param pairs: (ip, 域名)列表
+        :param expire_at: 到期时间的时间戳, 默认值为None, 表示永久禁用
+        """
+        now = time.time()
+        with self._lock:
+            for ip, domain in pairs:
+                self._local_disabled.setdefault(domain, {})[ip] = (expire_at, now)
+            self._local_writes += 1
+
+    def disable_domain(self, ip, domain, expire_at=None):
+        self.disable_domains([(ip, domain)], expire_at)
+
+    def _is_disabled(self, snapshot, domain, index, record, local, now):
+        """判断代理IP是否在指定域名下被禁用, 同时检查快照和本地的禁用记录"""
+        if snapshot.is_disabled(domain, index, now):
+            return True
+        if local:
+            entry = local.get(snapshot.to_proxy(record).ip)
+            return entry is not None and (entry[0] is None or entry[0] > now)
+        return False
+
+    def __len__(self):
+        snapshot = self._snapshot
+        return len(snapshot) if snapshot is not None else 0
+
+    def __contains__(self, ip):
+        snapshot = self._snapshot
+        return snapshot is not None and ip in snapshot
+
+    def get_proxies(self, protocol=None, domain=None, nick_type=0, count=0):
+        """根据协议类型、要访问网站的域名和匿名程度, 从快照中获取代理IP列表, 参数和返回值与ProxyIndex.get_proxies一致"""
+        snapshot = self._snapshot
+        if snapshot is None:
+            return []
+        iterators = [snapshot.iter_bucket((p, nick_type)) for p in _get_protocols(protocol)]
+        # 多个桶各自有序, 归并之后整体仍然按照分数降序、速度升序排列
+        items = heapq.merge(*iterators, key=_sort_key) if len(iterators) > 1 else iterators[0]
+        local = self._local_disabled.get(domain) if domain else None
+        check = domain and (local or snapshot.has_disabled(domain))
+        now = time.time()
+        proxy_list = list()
+        for index, record in items:
+            if check and self._is_disabled(snapshot, domain, index, record, local, now):
+                continue
+            proxy_list.append(snapshot.to_proxy(record))
+            if count and len(proxy_list) >= count:
+                break
+        return proxy_list
+
+    def get_random_proxy(self, protocol=None, domain=None, nick_type=0, count=0, policy=RANDOM_PROXY_POLICY):
+        """根据协议类型、要访问网站的域名和匿名程度, 从快照中随机获取一个代理IP, 参数和返回值与ProxyIndex.get_random_proxy一致"""
+        if policy == 'top':
+            proxy_list = self.get_proxies(protocol=protocol, domain=domain, nick_type=nick_type, count=count)
+            return random.choice(proxy_list) if proxy_list else None
+        snapshot = self._snapshot
+        if snapshot is None:
+            return None
+        bucket_keys = [(p, nick_type) for p in _get_protocols(protocol)]
+        totals = [snapshot.total(bucket_key, policy) for bucket_key in bucket_keys]
+        if sum(totals) <= 0:
+            return None
+        local = self._local_disabled.get(domain) if domain else None
+        check = domain and (local or snapshot.has_disabled(domain))
+        now = time.time()
+        # 先按照每个桶的权重之和选择桶, 再在桶内选择; 多次都选中禁用的代理IP时, 改为逐个过滤
+        for _ in range(RANDOM_PROXY_MAX_TRIES):
+            bucket_key = random.choices(bucket_keys, weights=totals)[0]
+            index, record = snapshot.choice(bucket_key, policy)
+            if not check or not self._is_disabled(snapshot, domain, index, record, local, now):
+                return snapshot.to_proxy(record)
+        candidates = self.get_proxies(protocol=protocol, domain=domain, nick_type=nick_type)
+        weights = [WEIGHT_POLICIES[policy](proxy) for proxy in candidates]
+        if not candidates or sum(weights) <= 0:
+            return None
+        return random.choices(candidates, weights=weights)[0]
+
+
+class SnapshotPublisher:
+    def __init__(self, mongo_pool=None, path=PROXY_SNAPSHOT_PATH):
+        """初始化方法
+        :param mongo_pool: 数据库操作对象, 默认值为None, 表示按照STORAGE_BACKEND创建数据库操作对象
+        :param path: 快照文件的路径
+        """
+        if mongo_pool is None:
+            from core.db.storage import create_pool
+            mongo_pool = create_pool()
+        self.path = path
+        # 和API工作进程原来使用的内存索引相同, 负责从数据库全量加载和增量拉取
+        self.proxy_index = ProxyIndex(mongo_pool)
+        # 上一次发布时内存索引的数据版本
+        self._published = None
+        # 上一次发布的快照的数据版本
+        self.version = 0
+
+    def publish(self):
+        """把内存索引写入快照文件, 返回快照的字节数"""
+        with metrics.timer('snapshot_publish_seconds'):
+            index_version = self.proxy_index.version
+            buckets, disabled, generated_at = self.proxy_index.export()
+            # 使用纳秒时间戳作为数据版本, 发布进程重启之后也不会和之前的版本重复
+            self.version = max(self.version + 1, time.time_ns())
+            data = build_snapshot(buckets, disabled, self.version, generated_at)
+            write_snapshot(data, self.path)
+        self._published = index_version
+        metrics.inc('snapshot_published_total')
+        metrics.set_gauge('snapshot_bytes', len(data))
+        metrics.set_gauge('snapshot_proxies', len(self.proxy_index))
+        logger.info(f'proxy snapshot published: version {self.version}, {len(self.proxy_index)} proxies')
+        return len(data)
+
+    def run(self):
+        """全量加载后发布一次, 之后定期拉取变化, 内存索引发生变化时重新发布"""
+        self.proxy_index.load_all()
+        self.publish()
+        while True:
+            time.sleep(PROXY_INDEX_REFRESH_SECONDS)
+            try:
+                self.proxy_index.refresh_once()
+                if self.proxy_index.version != self._published:
+                    self.publish()
+            except Exception as e:
+                logger.exception(e)
+
+    @classmethod
+    def start(cls):
+        """作为启动快照发布进程的入口方法"""
+        metrics.start_reporter('snapshot')
+        cls().run()
+
+
+if __name__ == '__main__':
+    SnapshotPublisher.start()
@@ -4,7 +4,9 @@
 步骤:
     1. 实现根据协议类型和域名, 提供随机的获取高可用代理IP的服务
     2. 实现根据协议类型和域名, 提供获取多个高可用代理IP的服务
-    3. 实现给指定的IP上追加不可用域名的服务
+    3. 实现给指定的IP上追加不可用域名的服务, 支持批量提交
+    4. 实现代理IP的租约服务, 租用期间同一个域名不会再提供这个代理IP
+    5. 实现爬虫反馈代理IP访问结果的服务, 根据反馈调整提供的代理IP
 实现:
     - 在proxy_api.py中, 创建ProxyApi类
     - 实现初始方法
@@ -13,29 +15,101 @@
         - 可用通过 protocol 和 domain 参数对IP进行过滤
         - protocol: 当前请求的协议类型
         - domain: 当前请求域名
+        - policy: 选择策略, 在排名靠前的代理IP中等概率选择(top), 或者在所有代理IP中按照权重选择(score/speed/balanced)
     - 实现根据协议类型和域名, 提供获取多个高可用代理IP的服务
         - 可用通过protocol 和 domain 参数对IP进行过滤
+        - 可以通过nick_type和count参数指定匿名程度和数量
+        - 缓存序列化好的响应内容(ResponseCache), 支持ETag, 客户端带上If-None-Match时内容没有变化则返回304
     - 实现给指定的IP上追加不可用域名的服务
         - 如果在获取IP的时候, 有指定域名参数, 将不在获取该IP, 从而进一步提高代理IP的可用性
+        - POST请求一次提交多个(ip, 域名), 以一次bulk_write写入, 返回每一项的结果; 也可以放入缓冲区异步写入
+    - 实现代理IP的租约服务(见lease_table.py)
+        - /lease/acquire: 按照 protocol、domain、nick_type 租用一个代理IP, ttl指定租约的有效时间,
+          同一个域名优先租出最久没有租出、并且当前没有被租用的代理IP
+        - /lease/release: 按照 lease_id 归还租约; /lease/renew: 按照 lease_id 和 ttl 续期租约
+        - 租约保存在所有工作进程共享的内存中, 不写入数据库
+    - 实现爬虫反馈代理IP访问结果的服务(见proxy_feedback.py)
+        - POST /feedback 批量提交 (ip, 域名, 是否成功, 延迟), 在内存中统计每个代理IP和每个(代理IP, 域名)的成功率和延迟的EWMA
+        - /random、/proxies和租约接口根据统计排除成功率过低的代理IP, 并把慢的代理IP排在后面, 统计定期写入数据库
+    - 使用内存索引(ProxyIndex)提供代理IP, 避免每次请求都查询MongoDB
+        - 可以通过配置文件中的PROXY_INDEX_ENABLED关闭, 关闭后直接查询MongoDB
+        - 开启PROXY_SNAPSHOT_ENABLED时, 所有工作进程共享快照发布进程写入的代理池快照(SnapshotReader), 不再各自维护内存索引
+    - 统计每个代理IP被/random提供的次数, 定期写入数据库, 检测模块据此缩短常用代理IP的检测间隔
+    - 统计每个接口的耗时, 通过/metrics接口输出所有进程的指标(utils/metrics.py)
     - 实现run方法, 用于启动Flask的WEB服务
+        - 默认使用gevent的WSGIServer(生产环境服务模式, 见api_server.py), 可以通过API_SERVER切换为Flask自带的开发服务器
     - 实现start的类方法, 用于通过类名, 启动服务
+        - gevent服务模式下创建监听socket和共享的租约表, 然后fork出API_WORKERS个工作进程, 每个工作进程创建自己的ProxyApi对象
 """
+from gevent import monkey
+monkey.patch_all()  # 打补丁, 让gevent识别耗时操作, gevent服务模式下每个连接由一个协程处理
 
 from flask import Flask
 from flask import request
-from core.db.mongo_pool import MongoPool
-from settings import MAX_PROXIES_RANGE
-from settings import WEB_API_PORT   
+from flask import Response
+from flask import g
+from core.api_server import create_listener, serve_forever, run_workers
+from core.db.storage import create_pool
+from core.lease_table import LeaseTable, LeaseSlots
+from core.proxy_feedback import ProxyFeedback, RankedSource
+from core.proxy_index import ProxyIndex
+from core.pool_snapshot import SnapshotReader
+from core.response_cache import ResponseCache
+from core.weighted_selector import WEIGHT_POLICIES
+from model import dumps_proxies
+from settings import MAX_PROXIES_RANGE, PROXY_INDEX_ENABLED, SERVED_FLUSH_SECONDS, RANDOM_PROXY_POLICY
+from settings import PROXY_SNAPSHOT_ENABLED, LEASE_TTL_SECONDS, LEASE_MAX_TTL_SECONDS
+from settings import FEEDBACK_ENABLED, FEEDBACK_BATCH_MAX
+from settings import WEB_API_PORT, API_SERVER, API_WORKERS, DISABLE_DOMAIN_BATCH_MAX
+from utils.log import logger
+from utils import metrics
+from collections import Counter
 import json
+import threading
+import time
 
 
 class ProxyApi:
-    def __init__(self):
-        """初始化方法"""
+    def __init__(self, mongo_pool=None, lease_slots=None):
+        """初始化方法
+        :param mongo_pool: 数据库操作对象, 默认值为None, 表示按照STORAGE_BACKEND创建数据库操作对象
+        :param lease_slots: 所有工作进程共享的租约表(LeaseSlots), 默认值为None, 表示创建只在本进程中使用的租约表
+        """
         # 初始化Flask的Web服务
         self.app = Flask(__name__)
-        # 初始化MongoDB数据库操作对象
-        self.mongo_pool = MongoPool()
+        # 初始化数据库操作对象, 存储后端由STORAGE_BACKEND选择
+        self.mongo_pool = mongo_pool if mongo_pool is not None else create_pool()
+        # 初始化代理IP的内存索引, 在run方法中加载; 使用共享的代理池快照时, 由SnapshotReader代替内存索引
+        if PROXY_SNAPSHOT_ENABLED:
+            self.proxy_index = SnapshotReader()
+        else:
+            self.proxy_index = ProxyIndex(self.mongo_pool) if PROXY_INDEX_ENABLED else None
+        # 获取代理IP的数据源: 开启内存索引时从内存中获取, 否则从MongoDB中获取
+        self.proxy_source = self.proxy_index if self.proxy_index is not None else self.mongo_pool
+        # 爬虫反馈的统计, 开启时在数据源之上根据反馈重新排序并排除成功率过低的代理IP
+        self.feedback = ProxyFeedback(self.mongo_pool) if FEEDBACK_ENABLED else None
+        if self.feedback is not None:
+            self.proxy_source = RankedSource(self.proxy_source, self.feedback)
+        # 每个代理IP被提供的次数, 定期写入数据库
+        self.served = Counter()
+        # /proxies的响应缓存
+        self.proxies_cache = ResponseCache()
+        # 代理IP的租约表
+        self.lease_table = LeaseTable(self.proxy_source, lease_slots)
+
+        # 统计每个接口的耗时, 按照路由、请求方法和状态码区分
+        @self.app.before_request
+        def start_timer():
+            g.request_start = time.perf_counter()
+
+        @self.app.after_request
+        def record_request(response):
+            start = getattr(g, "request_start", None)
+            if start is not None:
+                route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+                metrics.observe("api_request_seconds", time.perf_counter() - start,
+                                route=route, method=request.method, status=response.status_code)
+            return response
 
         # 根据协议类型和域名, 提供随机的高可用代理IP的服务
         @self.app.route("/random")
@@ -44,14 +118,20 @@ class ProxyApi:
             protocol = request.args.get("protocol")
             # 从请求参数中, 获取域名
             domain = request.args.get("domain")
-            # 根据指定的协议和域名，从MongoDB数据库中, 随机获取一个高可用代理IP
-            # 随机获取代理IP的范围，由配置文件中的MAX_PROXIES_RANGE指定
-            proxy = self.mongo_pool.get_random_proxy(
-                protocol=protocol, domain=domain, count=MAX_PROXIES_RANGE
+            # 从请求参数中, 获取选择策略, 默认值由配置文件中的RANDOM_PROXY_POLICY指定
+            policy = request.args.get("policy", RANDOM_PROXY_POLICY)
+            if policy != "top" and policy not in WEIGHT_POLICIES:
+                return f"不支持的选择策略: {policy}, 可选的策略: top, {', '.join(WEIGHT_POLICIES)}"
+            # 根据指定的协议、域名和选择策略，从内存索引或MongoDB数据库中, 随机获取一个高可用代理IP
+            # top策略随机获取代理IP的范围，由配置文件中的MAX_PROXIES_RANGE指定
+            proxy = self.proxy_source.get_random_proxy(
+                protocol=protocol, domain=domain, count=MAX_PROXIES_RANGE, policy=policy
             )
 
             # 如果获取到了代理IP
             if proxy:
+                # 记录代理IP被提供的次数
+                self.served[proxy.ip] += 1
                 # 如果协议不为空，则返回协议://IP:端口
                 if protocol:
                     return f"{protocol}://{proxy.ip}:{proxy.port}"
@@ -69,21 +149,36 @@ class ProxyApi:
             protocol = request.args.get("protocol")
             # 从请求参数中, 获取域名
             domain = request.args.get("domain")
-            # 根据指定的协议和域名，从MongoDB数据库中, 获取多个高可用代理IP
-            # 获取代理IP的范围，由配置文件中的MAX_PROXIES_RANGE指定
-            proxies = self.mongo_pool.get_proxies(
-                protocol=protocol, domain=domain, count=MAX_PROXIES_RANGE
-            )
+            # 从请求参数中, 获取匿名程度和数量, 数量最多为配置文件中的MAX_PROXIES_RANGE
+            try:
+                nick_type = int(request.args.get("nick_type", 0))
+                count = min(int(request.args.get("count", MAX_PROXIES_RANGE)), MAX_PROXIES_RANGE)
+            except ValueError:
+                return "nick_type和count参数必须是整数"
 
-            # 如果获取到了指定条件的代理IP的列表(proxy对象的形式)
-            if proxies:
-                # 将proxy对象列表转换为字典的列表，方便json序列化
-                proxies = [proxy.__dict__ for proxy in proxies]
-                # 返回json格式的代理IP列表
-                return json.dumps(proxies, ensure_ascii=False, indent=2)
-            else:
-                # 如果获取不到指定条件的代理IP，则返回指定条件的代理IP不存在
-                return "指定条件的代理IP不存在"
+            # 先从响应缓存中获取, 缓存过期或者数据发生变化时再查询
+            key = (protocol, domain, nick_type, count)
+            # 查询之前读取数据版本, 查询期间发生的变化会让这条缓存记录在下次请求时失效
+            version = self.proxy_source.version
+            entry = self.proxies_cache.get(key, version)
+            if entry is None:
+                # 根据指定的协议和域名，从内存索引或MongoDB数据库中, 获取多个高可用代理IP
+                proxies = self.proxy_source.get_proxies(
+                    protocol=protocol, domain=domain, nick_type=nick_type, count=count
+                )
+                # 如果获取到了指定条件的代理IP的列表(proxy对象的形式)
+                if proxies:
+                    # 将proxy对象列表序列化为紧凑格式的json
+                    body = dumps_proxies(proxies)
+                    entry = self.proxies_cache.put(key, version, body)
+                else:
+                    # 如果获取不到指定条件的代理IP，则返回指定条件的代理IP不存在
+                    entry = self.proxies_cache.put(key, version, "指定条件的代理IP不存在".encode(), "text/plain")
+
+            response = Response(entry.body, mimetype=entry.mimetype)
+            response.set_etag(entry.etag)
+            # 客户端的If-None-Match和ETag一致时返回304
+            return response.make_conditional(request)
 
         # 给指定的IP上追加不可用域名的服务
         @self.app.route("/disable_domain")
@@ -101,21 +196,252 @@ class ProxyApi:
                 return "请提供域名"
 
             # 如果指定的IP不存在, 返回提示信息
-            if len(self.mongo_pool.find(conditions={"_id": ip})) == 0:
+            if ip not in self.find_existing_ips([ip]):
                 return "指定的代理IP不存在"
 
-            # 给指定的IP上追加不可用域名
-            self.mongo_pool.disable_domain(ip=ip, domain=domain)
+            # 禁用指定的IP访问指定的域名, 到期后自动解除
+            self.disable_domains([(ip, domain)])
             # 返回追加不可用域名成功的信息
             return f"{ip} 禁用域名 {domain} 成功"
 
-    def run(self):
-        """启动Flask的Web服务"""
-        self.app.run("0.0.0.0", port=WEB_API_PORT)
+        # 批量禁用代理IP访问对应域名的服务
+        @self.app.route("/disable_domain", methods=["POST"])
+        def disable_domain_batch():
+            # 请求体为json: {"items": [{"ip": ..., "domain": ...}, ...], "async": false}, items中的每一项也可以是[ip, domain]
+            data = request.get_json(silent=True)
+            items = data.get("items") if isinstance(data, dict) else data
+            if not isinstance(items, list) or not items:
+                return self._json_response({"error": "请提供items"}, 400)
+            if len(items) > DISABLE_DOMAIN_BATCH_MAX:
+                return self._json_response({"error": f"一次最多提交{DISABLE_DOMAIN_BATCH_MAX}项"}, 400)
+            # 异步模式: 放入缓冲区后立即返回, 由后台批量写入数据库
+            write_behind = request.args.get("async") in ("1", "true") or (
+                isinstance(data, dict) and data.get("async") is True
+            )
+
+            pairs = [self._parse_pair(item) for item in items]
+            existing = self.find_existing_ips({pair[0] for pair in pairs if pair})
+            # 同一个(ip, 域名)只写入一次, 重复的项返回相同的结果
+            valid = list(dict.fromkeys(pair for pair in pairs if pair and pair[0] in existing))
+            statuses = self.disable_domains(valid, write_behind=write_behind)
+
+            results = []
+            for item, pair in zip(items, pairs):
+                if pair is None:
+                    results.append({"item": item, "status": "invalid"})
+                elif pair[0] not in existing:
+                    results.append({"ip": pair[0], "domain": pair[1], "status": "not_found"})
+                else:
+                    results.append({"ip": pair[0], "domain": pair[1], "status": statuses[pair]})
+            return self._json_response({"results": results}, 202 if write_behind else 200)
+
+        # 租用一个代理IP, 租约到期或者归还之前, 同一个域名不会再提供这个代理IP
+        @self.app.route("/lease/acquire", methods=["GET", "POST"])
+        def lease_acquire():
+            protocol = request.values.get("protocol")
+            domain = request.values.get("domain")
+            try:
+                nick_type = int(request.values.get("nick_type", 0))
+                ttl = self._parse_ttl(request.values.get("ttl"))
+            except ValueError:
+                return self._json_response({"error": "nick_type必须是整数, ttl必须是正数"}, 400)
+            try:
+                result = self.lease_table.acquire(domain=domain, protocol=protocol, nick_type=nick_type, ttl=ttl)
+            except TimeoutError:
+                return self._json_response({"error": "租约表繁忙, 请稍后重试"}, 503)
+            if result is None:
+                return self._json_response({"error": "指定条件的代理IP不存在或者都已经被租用"}, 404)
+            proxy, lease_id, expires_at = result
+            # 记录代理IP被提供的次数
+            self.served[proxy.ip] += 1
+            return self._json_response({
+                "lease_id": lease_id,
+                "proxy": f"{proxy.ip}:{proxy.port}",
+                "ip": proxy.ip,
+                "port": proxy.port,
+                "protocol": proxy.protocol,
+                "expires_at": expires_at,
+                "ttl": ttl,
+            })
+
+        # 归还租约, 这个代理IP可以立即再租给其他爬虫
+        @self.app.route("/lease/release", methods=["GET", "POST"])
+        def lease_release():
+            lease_id = request.values.get("lease_id")
+            if not lease_id:
+                return self._json_response({"error": "请提供lease_id"}, 400)
+            try:
+                released = self.lease_table.release(lease_id)
+            except TimeoutError:
+                return self._json_response({"error": "租约表繁忙, 请稍后重试"}, 503)
+            if not released:
+                return self._json_response({"error": "租约不存在或者已经到期"}, 404)
+            return self._json_response({"released": True})
+
+        # 续期租约, 新的到期时间为当前时间加上ttl
+        @self.app.route("/lease/renew", methods=["GET", "POST"])
+        def lease_renew():
+            lease_id = request.values.get("lease_id")
+            if not lease_id:
+                return self._json_response({"error": "请提供lease_id"}, 400)
+            try:
+                ttl = self._parse_ttl(request.values.get("ttl"))
+            except ValueError:
+                return self._json_response({"error": "ttl参数必须是正数"}, 400)
+            try:
+                expires_at = self.lease_table.renew(lease_id, ttl)
+            except TimeoutError:
+                return self._json_response({"error": "租约表繁忙, 请稍后重试"}, 503)
+            if expires_at is None:
+                return self._json_response({"error": "租约不存在或者已经到期"}, 404)
+            return self._json_response({"lease_id": lease_id, "expires_at": expires_at, "ttl": ttl})
+
+        # 爬虫批量反馈通过代理IP访问目标网站的结果
+        @self.app.route("/feedback", methods=["POST"])
+        def feedback():
+            if self.feedback is None:
+                return self._json_response({"error": "没有开启反馈, 请在配置文件中设置FEEDBACK_ENABLED = True"}, 404)
+            # 请求体为json: {"items": [{"ip": ..., "domain": ..., "ok": true, "latency": 0.5}, ...]},
+            # items中的每一项也可以是[ip, domain, ok, latency], domain和latency可以为null
+            data = request.get_json(silent=True)
+            items = data.get("items") if isinstance(data, dict) else data
+            if not isinstance(items, list) or not items:
+                return self._json_response({"error": "请提供items"}, 400)
+            if len(items) > FEEDBACK_BATCH_MAX:
+                return self._json_response({"error": f"一次最多提交{FEEDBACK_BATCH_MAX}项"}, 400)
+            records = [self._parse_feedback(item) for item in items]
+            valid = [record for record in records if record is not None]
+            self.feedback.record(valid)
+            return self._json_response({"accepted": len(valid), "invalid": len(records) - len(valid)})
+
+        # 汇总爬虫、检测、API所有进程的指标, 以文本格式输出
+        @self.app.route("/metrics")
+        def metrics_text():
+            return Response(metrics.render(metrics.collect()), mimetype="text/plain; version=0.0.4")
+
+        # 汇总所有进程的采样分析结果, 以折叠栈格式输出, 需要开启METRICS_PROFILER_ENABLED
+        @self.app.route("/metrics/profile")
+        def metrics_profile():
+            if metrics.profiler is None:
+                return Response("没有开启采样分析器, 请在配置文件中设置METRICS_PROFILER_ENABLED = True\n",
+                                status=404, mimetype="text/plain")
+            return Response(metrics.render_profile(metrics.collect()), mimetype="text/plain")
+
+    @staticmethod
+    def _parse_pair(item):
+        """把请求中的一项解析为(ip, 域名), 格式不正确时返回None"""
+        if isinstance(item, dict):
+            ip, domain = item.get("ip"), item.get("domain")
+        elif isinstance(item, list) and len(item) == 2:
+            ip, domain = item
+        else:
+            return None
+        if not ip or not domain or not isinstance(ip, str) or not isinstance(domain, str):
+            return None
+        return ip, domain
+
+    @staticmethod
+    def _parse_feedback(item):
+        """把请求中的一项反馈解析为(ip, 域名, 是否成功, 延迟), 格式不正确时返回None"""
+        if isinstance(item, dict):
+            ip, domain, ok, latency = item.get("ip"), item.get("domain"), item.get("ok"), item.get("latency")
+        elif isinstance(item, list) and len(item) in (3, 4):
+            ip, domain, ok, latency = (item + [None])[:4]
+        else:
+            return None
+        if not ip or not isinstance(ip, str) or not isinstance(ok, (bool, int)):
+            return None
+        if domain is not None and not isinstance(domain, str):
+            return None
+        if latency is not None and (isinstance(latency, bool) or not isinstance(latency, (int, float))
+                                    or not 0 <= latency < float("inf")):
+            return None
+        return ip, domain, bool(ok), latency
+
+    @staticmethod
+    def _parse_ttl(value):
+        """解析租约的有效时间, 默认值为LEASE_TTL_SECONDS, 最长为LEASE_MAX_TTL_SECONDS"""
+        if value is None:
+            return LEASE_TTL_SECONDS
+        ttl = float(value)
+        if not 0 < ttl < float("inf"):
+            raise ValueError(f"invalid ttl: {value}")
+        return min(ttl, LEASE_MAX_TTL_SECONDS)
+
+    @staticmethod
+    def _json_response(data, status=200):
+        return Response(json.dumps(data, ensure_ascii=False), status=status, mimetype="application/json")
+
+    def find_existing_ips(self, ips):
+        """返回其中存在的代理IP, 开启内存索引时直接在内存中判断, 不查询数据库"""
+        if self.proxy_index is not None:
+            return {ip for ip in ips if ip in self.proxy_index}
+        return self.mongo_pool.find_existing_ips(ips) if ips else set()
+
+    def disable_domains(self, pairs, write_behind=False):
+        """禁用多个代理IP访问对应的域名, 并同步修改内存索引, 使禁用立即生效
+        :param pairs: 不重复的(ip, 域名)列表
+        :param write_behind: 是否放入缓冲区延后写入数据库
+        :return: 返回 (ip, 域名) -> 结果 的字典, 结果为disabled(已写入)、queued(已放入缓冲区)或error(写入失败)
+        """
+        if write_behind:
+            expire_at = None
+            for ip, domain in pairs:
+                expire_at = self.mongo_pool.buffer_disable_domain(ip, domain)
+            statuses = {pair: "queued" for pair in pairs}
+        else:
+            expire_at, failed = self.mongo_pool.disable_domains(pairs)
+            statuses = {pair: "error" if index in failed else "disabled" for index, pair in enumerate(pairs)}
+        if self.proxy_index is not None and pairs:
+            self.proxy_index.disable_domains([pair for pair in pairs if statuses[pair] != "error"], expire_at)
+        return statuses
+
+    def flush_served(self):
+        """把代理IP被提供的次数写入数据库"""
+        served, self.served = self.served, Counter()
+        for ip, count in served.items():
+            self.mongo_pool.buffer_served(ip, count)
+        self.mongo_pool.flush()
+
+    def _flush_served_forever(self):
+        """后台线程: 定期把代理IP被提供的次数写入数据库"""
+        while True:
+            time.sleep(SERVED_FLUSH_SECONDS)
+            try:
+                self.flush_served()
+            except Exception as e:
+                logger.exception(e)
+
+    def run(self, listener=None):
+        """启动Flask的Web服务
+        :param listener: gevent服务模式下使用的监听socket, 默认值为None, 表示创建一个
+        """
+        # 加载内存索引(或映射代理池快照), 并启动后台刷新线程
+        if self.proxy_index is not None:
+            self.proxy_index.start()
+        # 加载反馈的统计, 并启动定期写入数据库的后台线程
+        if self.feedback is not None:
+            self.feedback.start()
+        # 启动定期写入代理IP被提供次数的后台线程
+        threading.Thread(target=self._flush_served_forever, daemon=True).start()
+        # 定期把本进程的指标写入文件, 多个工作进程各自写入, 由/metrics接口汇总
+        metrics.start_reporter("api")
+        if API_SERVER == 'flask':
+            self.app.run("0.0.0.0", port=WEB_API_PORT)
+        else:
+            serve_forever(listener if listener is not None else create_listener("0.0.0.0", WEB_API_PORT), self.app)
 
     @classmethod
     def start(cls):
         """作为启动整个Flask的Web服务的入口的类方法"""
+        # gevent服务模式下使用多个工作进程, 共享同一个监听socket
+        if API_SERVER != 'flask' and API_WORKERS > 1:
+            listener = create_listener("0.0.0.0", WEB_API_PORT)
+            # 租约表在fork之前创建, 所有工作进程看到同一份租约
+            lease_slots = LeaseSlots()
+            # 每个工作进程在fork之后创建自己的ProxyApi对象, 不共享数据库连接
+            run_workers(lambda: cls(lease_slots=lease_slots).run(listener), API_WORKERS)
+            return
         # 初始化ProxyApi类
         proxy_api = cls()
         # 启动Flask的Web服务
@@ -0,0 +1,308 @@
+"""
+爬虫反馈模块
+- 作用: 爬虫每次通过代理IP访问目标网站后, 通过POST /feedback批量反馈(ip, 域名, 是否成功, 延迟),
+  API根据反馈在几秒之内降低慢的代理IP的排名, 不再提供失败率高的代理IP, 不需要等待检测模块的下一次检测
+- 实现:
+  1. 在内存中为每个代理IP(所有域名)和每个(代理IP, 域名)维护成功率和延迟的指数加权移动平均(EWMA),
+     第一次反馈直接作为初始值, 延迟只统计成功的反馈
+  2. 至少收到FEEDBACK_MIN_SAMPLES次反馈的统计才参与排序: 成功率低于FEEDBACK_MIN_SUCCESS_RATE的代理IP被排除,
+     其余的按照 (分数 * 成功率) 降序, 然后延迟升序排列, 没有反馈的代理IP使用数据库中的分数和速度, 排序和原来一致
+     指定域名时, 所有域名的统计和这个域名的统计都参与: 成功率取较小的值, 延迟优先使用这个域名的统计
+  3. 收到新的反馈后, 最多经过FEEDBACK_RANK_SECONDS秒数据版本加1, 重新计算每个域名的排序依据, 同时让响应缓存失效
+  4. 统计超过FEEDBACK_EXPIRE_SECONDS秒没有更新就失效, 被排除的代理IP之后重新参与排序, 再由新的反馈决定
+  5. 数据库中保存每个(域名, ip)的反馈计数: 成功次数、反馈次数、成功反馈的延迟之和与次数, 各个工作进程以累加的方式写入,
+     不会互相覆盖; 成功率和延迟在读取时由计数计算
+  6. 后台线程每隔FEEDBACK_FLUSH_SECONDS秒把自上次写入以来新增的计数累加到数据库, 然后拉取发生变化的计数,
+     统计重新由数据库中的计数计算, 再合并本进程还没有写入的反馈
+- 同步之后的统计只取决于数据库中的计数, 与反馈到达各个工作进程的顺序和各个工作进程写入、拉取的顺序无关,
+  所有工作进程都同步之后统计完全相同, 在此之前最多相差一个同步间隔内收到的反馈; 两次同步之间本进程收到的反馈按照EWMA
+  更新统计, 让失败的代理IP在几秒之内被排除; 启动时从数据库加载还没有失效的计数, 以计数计算的成功率和延迟作为初始值
+"""
+import random
+import threading
+import time
+from core.weighted_selector import WEIGHT_POLICIES
+from settings import FEEDBACK_EWMA_ALPHA, FEEDBACK_MIN_SAMPLES, FEEDBACK_MIN_SUCCESS_RATE, FEEDBACK_RANK_SECONDS
+from settings import FEEDBACK_RANK_MAX_EXTRA, FEEDBACK_EXPIRE_SECONDS, FEEDBACK_FLUSH_SECONDS
+from settings import PROXY_INDEX_OVERLAP_SECONDS
+from settings import RANDOM_PROXY_POLICY, RANDOM_PROXY_MAX_TRIES, RESPONSE_CACHE_MAX_ENTRIES
+from utils.log import logger
+from utils import metrics
+
+# 统计的下标: 成功率的EWMA, 延迟的EWMA(还没有成功的反馈时为None), 反馈次数, 更新时间
+SUCCESS, LATENCY, SAMPLES, UPDATED_AT = range(4)
+# 反馈计数的下标: 成功次数, 反馈次数, 成功反馈的延迟之和, 有延迟的成功反馈次数
+SUCCESSES, COUNT, LATENCY_SUM, LATENCY_COUNT = range(4)
+
+
+class ProxyFeedback:
+    def __init__(self, mongo_pool=None):
+        """初始化方法
+        :param mongo_pool: 数据库操作对象, 用于加载和写入统计, 默认值为None, 表示只保存在内存中
+        """
+        self.mongo_pool = mongo_pool
+        # 域名 -> {ip: [成功率, 延迟, 反馈次数, 更新时间]}, 空字符串表示所有域名
+        self._stats = {}
+        # 自上次写入数据库以来 (域名, ip) -> 新增的反馈计数
+        self._pending = {}
+        # (域名, ip) -> 上一次同步时数据库中的计数
+        self._synced = {}
+        # 上一次从数据库拉取计数的时间
+        self._last_pull = None
+        # 域名 -> {ip: (成功率, 延迟, 是否排除)}, 只在数据版本不变时有效
+        self._rankings = {}
+        self._rankings_version = None
+        self._lock = threading.Lock()
+        # 数据版本, 统计发生变化后最多经过FEEDBACK_RANK_SECONDS秒加1
+        self._version = 0
+        self._version_at = 0
+        self._dirty = False
+
+    @property
+    def version(self):
+        """数据版本, 收到新的反馈后不会立即增大, 避免每次反馈都让响应缓存失效"""
+        if self._dirty and time.time() - self._version_at >= FEEDBACK_RANK_SECONDS:
+            self._dirty = False
+            self._version += 1
+            self._version_at = time.time()
+        return self._version
+
+    @staticmethod
+    def _update(stat, ok, latency):
+        """把一次反馈更新到统计中"""
+        stat[SUCCESS] += FEEDBACK_EWMA_ALPHA * (ok - stat[SUCCESS])
+        if ok and latency is not None:
+            stat[LATENCY] = latency if stat[LATENCY] is None else \
+                stat[LATENCY] + FEEDBACK_EWMA_ALPHA * (latency - stat[LATENCY])
+
+    @staticmethod
+    def _merge(stat, counts):
+        """把本进程还没有写入的一批反馈计数合并到统计中, 等价于依次更新COUNT次取值为这批反馈平均值的反馈"""
+        weight = 1 - (1 - FEEDBACK_EWMA_ALPHA) ** counts[COUNT]
+        stat[SUCCESS] += weight * (counts[SUCCESSES] / counts[COUNT] - stat[SUCCESS])
+        if counts[LATENCY_COUNT]:
+            latency = counts[LATENCY_SUM] / counts[LATENCY_COUNT]
+            weight = 1 - (1 - FEEDBACK_EWMA_ALPHA) ** counts[LATENCY_COUNT]
+            stat[LATENCY] = latency if stat[LATENCY] is None else stat[LATENCY] + weight * (latency - stat[LATENCY])
+        stat[SAMPLES] += counts[COUNT]
+
+    @staticmethod
+    def _from_counts(counts, updated_at):
+        """以数据库中的计数计算成功率和延迟, 作为同步之后的统计"""
+        latency = counts[LATENCY_SUM] / counts[LATENCY_COUNT] if counts[LATENCY_COUNT] else None
+        return [counts[SUCCESSES] / counts[COUNT], latency, counts[COUNT], updated_at]
+
+    def record(self, items, now=None):
+        """记录多条反馈
+        :param items: (ip, 域名, 是否成功, 延迟)的列表, 域名和延迟可以为None
+        """
+        now = time.time() if now is None else now
+        with self._lock:
+            for ip, domain, ok, latency in items:
+                ok = 1.0 if ok else 0.0
+                for key in (('', domain) if domain else ('',)):
+                    stats = self._stats.setdefault(key, {})
+                    stat = stats.get(ip)
+                    if stat is None or now - stat[UPDATED_AT] > FEEDBACK_EXPIRE_SECONDS:
+                        stats[ip] = [ok, latency if ok else None, 1, now]
+                    else:
+                        self._update(stat, ok, latency)
+                        stat[SAMPLES] += 1
+                        stat[UPDATED_AT] = now
+                    counts = self._pending.setdefault((key, ip), [0, 0, 0.0, 0])
+                    counts[SUCCESSES] += ok
+                    counts[COUNT] += 1
+                    if ok and latency is not None:
+                        counts[LATENCY_SUM] += latency
+                        counts[LATENCY_COUNT] += 1
+            self._dirty = True
+        metrics.inc('feedback_items_total', len(items))
+
+    def rankings(self, domain=None):
+        """返回参与排序的统计: ip -> (成功率, 延迟, 是否排除), 同一个数据版本内只计算一次
+        :param domain: 要访问网站的域名, 默认值为None, 表示只使用所有域名的统计
+        """
+        version = self.version
+        if self._rankings_version != version:
+            self._rankings = {}
+            self._rankings_version = version
+        domain = domain or ''
+        rankings = self._rankings.get(domain)
+        if rankings is not None:
+            return rankings
+        now = time.time()
+        rankings = {}
+        for key in (('', domain) if domain else ('',)):
+            for ip, stat in list(self._stats.get(key, {}).items()):
+                if stat[SAMPLES] < FEEDBACK_MIN_SAMPLES or now - stat[UPDATED_AT] > FEEDBACK_EXPIRE_SECONDS:
+                    continue
+                success, latency = stat[SUCCESS], stat[LATENCY]
+                if ip in rankings:
+                    # 所有域名的统计在前, 成功率取较小的值, 延迟优先使用这个域名的统计
+                    success = min(success, rankings[ip][0])
+                    latency = latency if latency is not None else rankings[ip][1]
+                rankings[ip] = (success, latency, success < FEEDBACK_MIN_SUCCESS_RATE)
+        self._rankings[domain] = rankings
+        return rankings
+
+    def rank(self, proxies, domain=None):
+        """排除成功率过低的代理IP, 其余的按照 (分数 * 成功率) 降序, 然后延迟升序重新排列, 没有反馈的代理IP保持原来的依据"""
+        rankings = self.rankings(domain)
+        if not rankings:
+            return proxies
+
+        def sort_key(proxy):
+            success, latency, _ = rankings.get(proxy.ip, (1.0, None, False))
+            return -proxy.score * success, proxy.speed if latency is None else latency
+
+        return sorted((proxy for proxy in proxies if not rankings.get(proxy.ip, (0, 0, False))[2]), key=sort_key)
+
+    def is_excluded(self, ip, domain=None):
+        """判断代理IP是否因为成功率过低而被排除"""
+        ranking = self.rankings(domain).get(ip)
+        return ranking is not None and ranking[2]
+
+    def load(self):
+        """从数据库加载还没有失效的计数, 作为统计的初始值"""
+        if self.mongo_pool is None:
+            return
+        self._last_pull = time.time()
+        count = 0
+        with self._lock:
+            for ip, domain, *counts, updated_at in self.mongo_pool.find_feedback():
+                if counts[COUNT] <= 0:
+                    continue
+                stat = self._from_counts(counts, updated_at)
+                self._stats.setdefault(domain, {})[ip] = stat
+                self._synced[(domain, ip)] = counts
+                count += 1
+            self._dirty = True
+        logger.info(f'proxy feedback loaded: {count} stats')
+
+    def _pull(self):
+        """拉取发生变化的计数, 由数据库中的计数重新计算统计, 再合并本进程还没有写入的反馈"""
+        started = time.time()
+        since = None if self._last_pull is None else self._last_pull - PROXY_INDEX_OVERLAP_SECONDS
+        merged = 0
+        with self._lock:
+            for ip, domain, *counts, updated_at in self.mongo_pool.find_feedback(since):
+                key = (domain, ip)
+                seen = self._synced.get(key)
+                # 和上一次同步时相同的计数已经合并过了; 计数变少说明数据库中的计数到期后重新开始累加
+                if counts == seen or counts[COUNT] <= 0:
+                    continue
+                stat = self._from_counts(counts, updated_at)
+                self._synced[key] = counts
+                # 本进程在写入之后收到的反馈还没有出现在数据库中, 继续保留在统计中
+                pending = self._pending.get(key)
+                if pending:
+                    self._merge(stat, pending)
+                self._stats.setdefault(domain, {})[ip] = stat
+                merged += counts[COUNT] - (seen[COUNT] if seen is not None and seen[COUNT] <= counts[COUNT] else 0)
+            if merged:
+                self._dirty = True
+        self._last_pull = started
+        metrics.inc('feedback_merged_total', merged)
+
+    def flush(self):
+        """把新增的计数累加到数据库, 合并其他工作进程的反馈, 同时删除失效的统计"""
+        now = time.time()
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            expired = 0
+            for domain, stats in list(self._stats.items()):
+                for ip in [ip for ip, stat in stats.items() if now - stat[UPDATED_AT] > FEEDBACK_EXPIRE_SECONDS]:
+                    del stats[ip]
+                    expired += 1
+                if not stats:
+                    del self._stats[domain]
+            self._synced = {key: synced for key, synced in self._synced.items()
+                            if key[1] in self._stats.get(key[0], {})}
+            if expired:
+                self._dirty = True
+        if self.mongo_pool is not None:
+            for (domain, ip), counts in pending.items():
+                self.mongo_pool.buffer_feedback(ip, domain, *counts)
+            if pending:
+                self.mongo_pool.flush()
+            self._pull()
+        metrics.set_gauge('feedback_stats', sum(len(stats) for stats in self._stats.values()))
+
+    def start(self):
+        """加载统计, 然后启动定期写入数据库的后台线程"""
+        self.load()
+        threading.Thread(target=self._flush_forever, daemon=True).start()
+
+    def _flush_forever(self):
+        """后台线程: 定期把统计写入数据库"""
+        while True:
+            time.sleep(FEEDBACK_FLUSH_SECONDS)
+            try:
+                self.flush()
+            except Exception as e:
+                logger.exception(e)
+
+
+class RankedSource:
+    """在获取代理IP的数据源(内存索引、代理池快照或数据库)之上, 根据爬虫反馈重新排序并排除成功率过低的代理IP"""
+    def __init__(self, source, feedback):
+        """初始化方法
+        :param source: 获取代理IP的数据源, 需要提供get_proxies、get_random_proxy方法和version属性
+        :param feedback: 爬虫反馈的统计(ProxyFeedback)
+        """
+        self.source = source
+        self.feedback = feedback
+        # (协议类型, 域名, 匿名程度, 数量) -> 重新排序后的代理IP列表, 只在数据版本不变时有效
+        self._cache = {}
+        self._cache_version = None
+
+    @property
+    def version(self):
+        """数据源或者反馈的统计发生变化时, 数据版本都会变化"""
+        return self.source.version, self.feedback.version
+
+    def get_proxies(self, protocol=None, domain=None, nick_type=0, count=0):
+        """根据协议类型、要访问网站的域名和匿名程度获取代理IP列表, 参数和返回值与MongoPool.get_proxies一致
+        有反馈的代理IP可能被排除或者移到后面, 因此在排名靠前的count个代理IP之外多取有反馈的代理IP数量个作为候选
+        """
+        rankings = self.feedback.rankings(domain)
+        if not rankings:
+            return self.source.get_proxies(protocol=protocol, domain=domain, nick_type=nick_type, count=count)
+        # 重新排序的结果在数据版本不变时复用, /random的top策略和租约接口不需要每次都重新排序
+        version = self.version
+        if self._cache_version != version or len(self._cache) >= RESPONSE_CACHE_MAX_ENTRIES:
+            self._cache = {}
+            self._cache_version = version
+        key = (protocol, domain, nick_type, count)
+        proxies = self._cache.get(key)
+        if proxies is None:
+            extra = min(len(rankings), FEEDBACK_RANK_MAX_EXTRA)
+            proxies = self.source.get_proxies(protocol=protocol, domain=domain, nick_type=nick_type,
+                                              count=count + extra if count else 0)
+            proxies = self.feedback.rank(proxies, domain)
+            proxies = proxies[:count] if count else proxies
+            self._cache[key] = proxies
+        return list(proxies)
+
+    def get_random_proxy(self, protocol=None, domain=None, nick_type=0, count=0, policy=RANDOM_PROXY_POLICY):
+        """随机获取一个代理IP, 参数和返回值与MongoPool.get_random_proxy一致
+        top策略在重新排序后排名靠前的count个代理IP中选择
+        按照权重选择时, 有反馈的代理IP的权重乘以成功率: 数据源按照原来的权重选中后, 以成功率为概率接受(拒绝采样),
+        被排除的代理IP总是拒绝; 多次都被拒绝时, 改为过滤后再按照乘以成功率的权重选择
+        延迟只影响top策略和/proxies的排序, 按照权重选择时仍然使用数据库中的速度
+        """
+        if policy == 'top':
+            proxy_list = self.get_proxies(protocol=protocol, domain=domain, nick_type=nick_type, count=count)
+            return random.choice(proxy_list) if proxy_list else None
+        rankings = self.feedback.rankings(domain)
+        for _ in range(RANDOM_PROXY_MAX_TRIES):
+            proxy = self.source.get_random_proxy(protocol=protocol, domain=domain, nick_type=nick_type,
+                                                 count=count, policy=policy)
+            ranking = rankings.get(proxy.ip) if proxy is not None else None
+            if ranking is None or (not ranking[2] and random.random() < ranking[0]):
+                return proxy
+        candidates = self.get_proxies(protocol=protocol, domain=domain, nick_type=nick_type)
+        weights = [WEIGHT_POLICIES[policy](proxy) * rankings.get(proxy.ip, (1.0,))[0] for proxy in candidates]
+        if not candidates or sum(weights) <= 0:
+            return None
+        return random.choices(candidates, weights=weights)[0]
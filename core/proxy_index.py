@@ -0,0 +1,288 @@
+"""
+代理IP内存索引模块
+- 作用: 在ProxyApi进程内维护一份代理IP的内存索引, 让/random和/proxies接口直接从内存中获取代理IP, 不再每次请求都查询MongoDB
+- 实现:
+  1. 按照 (协议类型, 匿名程度) 对代理IP分桶, 桶内按照分数降序, 然后速度升序排列, 和MongoPool.find的排序规则一致
+  2. 启动时全量加载一次, 之后由后台线程根据updated_at字段增量拉取发生变化的代理IP
+  3. 检测模块删除代理IP时写入删除记录, 增量拉取时和发生变化的代理IP一起拉取, 从索引中清除;
+     同一个代理IP被删除之后又重新插入时, 以时间较晚的为准; 每隔一段时间全量重建一次索引兜底
+  4. 查询时合并满足协议条件的桶, 并过滤掉禁用了指定域名的代理IP
+     禁用记录按照 域名 -> {ip: 到期时间} 保存, 和代理IP一起增量拉取, 判断一个代理IP是否被禁用只需要一次字典查找,
+     与这个域名禁用了多少代理IP无关
+  5. 每个桶为每种权重策略维护一个WeightedSelector, 随机获取代理IP时在桶内所有代理IP中按照权重选择
+- 并发: 后台线程采用写时复制的方式更新分桶, 处理请求的线程每次查询时只读取当前分桶的快照, 因此读取时不需要加锁
+  WeightedSelector在原地增量更新, 按照权重选择时需要获取写锁, 耗时为O(log n)
+"""
+import bisect
+import heapq
+import random
+import threading
+import time
+from core.weighted_selector import WEIGHT_POLICIES, WeightedSelector
+from settings import PROXY_INDEX_REFRESH_SECONDS, PROXY_INDEX_FULL_REFRESH_SECONDS, PROXY_INDEX_OVERLAP_SECONDS
+from settings import RANDOM_PROXY_POLICY, RANDOM_PROXY_MAX_TRIES
+from utils.log import logger
+
+
+def _get_protocols(protocol):
+    """根据请求的协议类型, 返回满足条件的protocol取值
+    - 协议类型为None, 表示需要http和https都支持, protocol的值为2
+    - 协议类型为http, 表示需要支持http, protocol的值为0或2
+    - 协议类型为https, 表示需要支持https, protocol的值为1或2
+    """
+    if protocol is None:
+        return (2,)
+    elif protocol.lower() == 'http':
+        return (0, 2)
+    else:
+        return (1, 2)
+
+
+def _create_selectors(proxies=()):
+    """为一个桶创建每种权重策略的WeightedSelector"""
+    return {policy: WeightedSelector(weight, proxies) for policy, weight in WEIGHT_POLICIES.items()}
+
+
+def _sort_key(proxy):
+    """桶内的排序键: 分数降序, 然后速度升序, 最后用ip保证排序键唯一"""
+    return (-proxy.score, proxy.speed, proxy.ip)
+
+
+class ProxyIndex:
+    def __init__(self, mongo_pool):
+        """初始化方法
+        :param mongo_pool: 数据库操作对象, 用于加载和增量拉取代理IP
+        """
+        self.mongo_pool = mongo_pool
+        # ip -> Proxy对象
+        self._proxies = {}
+        # (protocol, nick_type) -> 按排序键排好序的 (-score, speed, ip, proxy) 列表
+        self._buckets = {}
+        # (protocol, nick_type) -> {权重策略: WeightedSelector}
+        self._selectors = {}
+        # 域名 -> {ip: 到期时间的时间戳}, 永久禁用时到期时间为None
+        self._disabled = {}
+        # 后台线程的写锁, 保证同一时间只有一个线程在更新索引
+        self._lock = threading.Lock()
+        # 数据版本, 索引中的代理IP每次发生变化时加1, 用于让API的响应缓存失效
+        self.version = 0
+        # 上一次增量拉取的时间
+        self._last_refresh = None
+        # 上一次全量加载的时间
+        self._last_full_refresh = None
+
+    def start(self):
+        """全量加载一次索引, 然后启动后台刷新线程"""
+        self.load_all()
+        thread = threading.Thread(target=self._refresh_forever, daemon=True)
+        thread.start()
+
+    def load_all(self):
+        """从数据库全量加载代理IP, 重建整个索引"""
+        started = time.time()
+        proxies = {}
+        buckets = {}
+        for proxy, _ in self.mongo_pool.find_updated_since():
+            proxies[proxy.ip] = proxy
+            buckets.setdefault((proxy.protocol, proxy.nick_type), []).append(_sort_key(proxy) + (proxy,))
+        for bucket in buckets.values():
+            bucket.sort()
+        selectors = {bucket_key: _create_selectors([entry[3] for entry in bucket])
+                     for bucket_key, bucket in buckets.items()}
+        disabled = {}
+        now = time.time()
+        for domain, ip, expire_at in self.mongo_pool.find_disabled_since():
+            if expire_at is None or expire_at > now:
+                disabled.setdefault(domain, {})[ip] = expire_at
+        with self._lock:
+            self._proxies = proxies
+            self._buckets = buckets
+            self._selectors = selectors
+            self._disabled = disabled
+            self.version += 1
+            self._last_refresh = started
+            self._last_full_refresh = started
+        logger.info(f'proxy index loaded: {len(proxies)} proxies')
+
+    def refresh(self):
+        """增量拉取上次刷新之后发生变化的代理IP, 并更新到索引中
+        查询时间向前多取一段重叠时间, 避免多个写入进程之间的时钟和提交顺序差异导致漏掉更新, 重复应用同一个更新没有副作用
+        """
+        started = time.time()
+        since = self._last_refresh - PROXY_INDEX_OVERLAP_SECONDS
+        changed = list(self.mongo_pool.find_updated_since(since))
+        deleted = dict(self.mongo_pool.find_deleted_since(since))
+        # 删除之后又重新插入(或者修改)的代理IP保留, 修改之后又被删除的代理IP清除
+        updated = {proxy.ip: updated_at or 0 for proxy, updated_at in changed}
+        self.apply([proxy for proxy, updated_at in changed if deleted.get(proxy.ip, -1) < (updated_at or 0)])
+        self.remove([ip for ip, deleted_at in deleted.items() if updated.get(ip, -1) <= deleted_at])
+        disabled = list(self.mongo_pool.find_disabled_since(since))
+        for domain, ip, expire_at in disabled:
+            self.disable_domain(ip, domain, expire_at)
+        self._last_refresh = started
+        return len(changed) + len(deleted) + len(disabled)
+
+    def apply(self, proxies):
+        """把发生变化的代理IP更新到索引中
+        只复制受影响的桶, 修改副本之后再整体替换, 正在处理的请求仍然读取旧的快照
+        """
+        if not proxies:
+            return
+        with self._lock:
+            buckets = dict(self._buckets)
+            copied = set()
+            for proxy in proxies:
+                old = self._proxies.get(proxy.ip)
+                # 从旧的桶中移除
+                if old is not None:
+                    self._remove_from_bucket(buckets, copied, old)
+                # 插入到新的桶中
+                bucket_key = (proxy.protocol, proxy.nick_type)
+                bucket = self._copy_bucket(buckets, copied, bucket_key)
+                bisect.insort(bucket, _sort_key(proxy) + (proxy,))
+                for selector in self._selectors.setdefault(bucket_key, _create_selectors()).values():
+                    selector.update(proxy)
+                self._proxies[proxy.ip] = proxy
+            self._buckets = buckets
+            self.version += 1
+
+    def remove(self, ips):
+        """从索引中清除已经被删除的代理IP, 和apply一样只复制受影响的桶"""
+        with self._lock:
+            removed = [self._proxies.pop(ip) for ip in ips if ip in self._proxies]
+            if not removed:
+                return
+            buckets = dict(self._buckets)
+            copied = set()
+            for old in removed:
+                self._remove_from_bucket(buckets, copied, old)
+            self._buckets = buckets
+            self.version += 1
+
+    def _remove_from_bucket(self, buckets, copied, old):
+        """把代理IP从它所在的桶和WeightedSelector中移除"""
+        bucket_key = (old.protocol, old.nick_type)
+        bucket = self._copy_bucket(buckets, copied, bucket_key)
+        index = bisect.bisect_left(bucket, _sort_key(old))
+        if index < len(bucket) and bucket[index][2] == old.ip:
+            del bucket[index]
+        for selector in self._selectors[bucket_key].values():
+            selector.remove(old.ip)
+
+    @staticmethod
+    def _copy_bucket(buckets, copied, bucket_key):
+        """在一次更新中, 每个桶只复制一次"""
+        if bucket_key not in copied:
+            buckets[bucket_key] = list(buckets.get(bucket_key, ()))
+            copied.add(bucket_key)
+        return buckets[bucket_key]
+
+    def disable_domain(self, ip, domain, expire_at=None):
+        """在索引中禁用指定代理IP访问指定域名, 让/disable_domain接口的修改立即生效
+        :param expire_at: 到期时间的时间戳, 默认值为None, 表示永久禁用
+        """
+        self.disable_domains([(ip, domain)], expire_at)
+
+    def disable_domains(self, pairs, expire_at=None):
+        """在索引中批量禁用多个代理IP访问对应的域名
+        :param pairs: (ip, 域名)列表
+        :param expire_at: 到期时间的时间戳, 默认值为None, 表示永久禁用
+        """
+        with self._lock:
+            # 对字典的单个赋值是原子操作, 处理请求的线程读取时不需要加锁
+            for ip, domain in pairs:
+                self._disabled.setdefault(domain, {})[ip] = expire_at
+            self.version += 1
+
+    def _get_disabled(self, domain):
+        """返回指定域名的禁用记录, 没有指定域名或者没有禁用记录时返回None"""
+        return self._disabled.get(domain) if domain else None
+
+    @staticmethod
+    def _is_disabled(disabled, ip, now):
+        """判断代理IP是否被禁用, 到期的禁用记录视为已经解除, 等待下一次全量加载时清除"""
+        if not disabled or ip not in disabled:
+            return False
+        expire_at = disabled[ip]
+        return expire_at is None or expire_at > now
+
+    def refresh_once(self):
+        """距离上次全量加载超过PROXY_INDEX_FULL_REFRESH_SECONDS秒时全量重建索引, 否则增量拉取"""
+        if time.time() - self._last_full_refresh >= PROXY_INDEX_FULL_REFRESH_SECONDS:
+            self.load_all()
+        else:
+            self.refresh()
+
+    def _refresh_forever(self):
+        """后台线程: 定期增量拉取, 并定期全量重建索引"""
+        while True:
+            time.sleep(PROXY_INDEX_REFRESH_SECONDS)
+            try:
+                self.refresh_once()
+            except Exception as e:
+                logger.exception(e)
+
+    def export(self):
+        """返回(分桶, 禁用记录的副本, 上一次拉取的时间), 供代理池快照(core/pool_snapshot.py)发布
+        分桶采用写时复制, 直接返回当前的快照; 禁用记录在原地修改, 因此返回副本
+        """
+        with self._lock:
+            disabled = {domain: dict(ips) for domain, ips in self._disabled.items()}
+            return self._buckets, disabled, self._last_refresh
+
+    def __len__(self):
+        return len(self._proxies)
+
+    def __contains__(self, ip):
+        return ip in self._proxies
+
+    def get_proxies(self, protocol=None, domain=None, nick_type=0, count=0):
+        """根据协议类型、要访问网站的域名和匿名程度, 从内存中获取代理IP列表, 参数和返回值与MongoPool.get_proxies一致"""
+        # 只读取一次当前分桶的快照
+        buckets = self._buckets
+        lists = [buckets.get((p, nick_type), ()) for p in _get_protocols(protocol)]
+        # 多个桶各自有序, 归并之后整体仍然按照分数降序、速度升序排列
+        entries = heapq.merge(*lists) if len(lists) > 1 else lists[0]
+        disabled = self._get_disabled(domain)
+        now = time.time()
+        proxy_list = list()
+        for entry in entries:
+            proxy = entry[3]
+            if disabled and self._is_disabled(disabled, proxy.ip, now):
+                continue
+            proxy_list.append(proxy)
+            if count and len(proxy_list) >= count:
+                break
+        return proxy_list
+
+    def get_random_proxy(self, protocol=None, domain=None, nick_type=0, count=0, policy=RANDOM_PROXY_POLICY):
+        """根据协议类型、要访问网站的域名和匿名程度, 从内存中随机获取一个代理IP, 参数和返回值与MongoPool.get_random_proxy一致
+        :param policy: 选择策略, top表示在排名靠前的count个代理IP中等概率选择, 其他策略见WEIGHT_POLICIES,
+                       在所有满足条件的代理IP中按照权重选择, 此时不使用count参数
+        """
+        if policy == 'top':
+            proxy_list = self.get_proxies(protocol=protocol, domain=domain, nick_type=nick_type, count=count)
+            if proxy_list:
+                return random.choice(proxy_list)
+            else:
+                return None
+        disabled = self._get_disabled(domain)
+        now = time.time()
+        with self._lock:
+            selectors = [self._selectors[(p, nick_type)][policy] for p in _get_protocols(protocol)
+                         if (p, nick_type) in self._selectors]
+            totals = [selector.total() for selector in selectors]
+            # 先按照每个桶的权重之和选择桶, 再在桶内选择, 等价于在所有满足条件的代理IP中按照权重选择
+            # 选中的代理IP禁用了指定域名时重新选择, 多次都选中禁用的代理IP时, 说明禁用的比例很高, 改为逐个过滤
+            for _ in range(RANDOM_PROXY_MAX_TRIES):
+                if not selectors or sum(totals) <= 0:
+                    return None
+                selector = random.choices(selectors, weights=totals)[0]
+                proxy = selector.choice()
+                if proxy is not None and not self._is_disabled(disabled, proxy.ip, now):
+                    return proxy
+        candidates = self.get_proxies(protocol=protocol, domain=domain, nick_type=nick_type)
+        weights = [WEIGHT_POLICIES[policy](proxy) for proxy in candidates]
+        if not candidates or sum(weights) <= 0:
+            return None
+        return random.choices(candidates, weights=weights)[0]
@@ -13,13 +13,30 @@
          - 根据发送请求, 获取页面数据
          - 解析页面, 提取数据, 封装为Proxy对象
          - 返回Proxy对象列表
+     5. 使用共享的下载器(fetcher)请求页面, 在每个爬虫声明的并发和速率限制之内并行下载多个页面
+     6. 使用页面缓存(page_cache)发送条件请求, 页面和上次相比没有变化时跳过解析, 页面中的代理IP全部交给调用方之后才提交缓存记录
+     7. 分组XPATH和组内XPATH只编译一次(compile_xpaths), 解析页面时直接使用编译好的etree.XPath对象
+     8. 统计每个爬虫请求页面和解析页面的耗时, 以及页面结果和提取到的代理IP数量(utils/metrics.py)
 """
+from functools import lru_cache
 from lxml import etree
-import requests
-from utils.http import get_request_headers
+from gevent.pool import Pool
+from core.proxy_spider.fetcher import fetcher
+from core.proxy_spider.page_cache import page_cache
 from model import Proxy 
-import random
-import time
+from settings import SPIDER_HOST_CONCURRENCY, SPIDER_HOST_RATE, SPIDER_RETRIES, SPIDER_PAGE_CACHE_ENABLED
+from utils.log import logger
+from utils import metrics
+
+
+@lru_cache(maxsize=None)
+def compile_xpaths(group_xpath, ip_xpath, port_xpath, area_xpath):
+    """把分组XPATH和组内XPATH编译为etree.XPath对象, 相同的XPATH只编译一次
+    组内XPATH的结果不使用smart_strings, 提取到的字符串不再保留对所在标签的引用
+    :return: (分组XPath对象, (ip, port, area)的XPath对象)
+    """
+    details = tuple(etree.XPath(xpath, smart_strings=False) for xpath in (ip_xpath, port_xpath, area_xpath))
+    return etree.XPath(group_xpath), details
 
 
 class BaseSpider:
@@ -28,6 +45,13 @@ class BaseSpider:
     group_xpath = ''  # 分组XPATH, 获取包含代理IP信息标签列表的XPATH
     detail_xpath = {} # 组内XPATH, 获取代理IP详情的信息XPATH, 格式为: {'ip':'xx', 'port':'xx', 'area':'xx'}
 
+    # 礼貌限制, 具体爬虫可以根据网站的承受能力覆盖
+    concurrency = SPIDER_HOST_CONCURRENCY  # 同时请求这个网站的页面数量
+    rate = SPIDER_HOST_RATE                # 每秒最多请求这个网站的页面数量
+    retries = SPIDER_RETRIES               # 请求失败时的重试次数
+    verify = True                          # 是否校验https证书
+    use_page_cache = SPIDER_PAGE_CACHE_ENABLED  # 页面没有变化时是否跳过解析
+
     def __init__(self, urls=[], group_xpath='', detail_xpath={}):
         """初始化方法, 传入爬虫URL列表, 分组XPATH, 详情(组内)XPATH
         只有在显示传入参数时, 才会使用传入的参数, 否则使用类成员变量的默认值
@@ -41,48 +65,68 @@ class BaseSpider:
 
 
     def get_page_from_url(self, url):
-        """请求url获取页面内容"""
-        response = requests.get(url, headers=get_request_headers())
+        """在这个爬虫的礼貌限制之内请求url获取页面内容
+        请求失败(包括非2xx的响应), 或者使用页面缓存时页面和上次相比没有变化, 则返回None
+        """
+        spider = type(self).__name__
+        headers = page_cache.get_headers(url) if self.use_page_cache else None
+        with metrics.timer('spider_fetch_seconds', spider=spider):
+            response = fetcher.fetch(url, concurrency=self.concurrency, rate=self.rate, retries=self.retries,
+                                     verify=self.verify, headers=headers)
+        if response is None:
+            metrics.inc('spider_pages_total', spider=spider, result='failed')
+            return None
+        # 错误页面不解析, 也不记录到页面缓存中
+        if response.status_code != 304 and not 200 <= response.status_code < 300:
+            logger.warning(f'请求{url}返回状态码{response.status_code}, 跳过解析')
+            metrics.inc('spider_pages_total', spider=spider, result='failed')
+            return None
+        if self.use_page_cache and not page_cache.is_changed(url, response):
+            logger.info(f'页面没有变化, 跳过解析: {url}')
+            metrics.inc('spider_pages_total', spider=spider, result='unchanged')
+            return None
+        metrics.inc('spider_pages_total', spider=spider, result='ok')
         return response.content
 
     def _get_first_from_list(self, lis):
         """从列表中获取第一个元素, 如果列表为空, 则返回空字符串"""
         return lis[0] if len(lis) != 0 else ''
 
+    def extract_from_page(self, page):
+        """从页面中提取代理IP信息, 返回(ip, port, area)元组的生成器"""
+        # 获取编译好的分组XPATH和组内XPATH
+        group, (ip, port, area) = compile_xpaths(self.group_xpath, self.detail_xpath['ip'],
+                                                 self.detail_xpath['port'], self.detail_xpath['area'])
+        first = self._get_first_from_list
+        # 使用lxml的etree模块解析页面, 遍历分组标签
+        for tr in group(etree.HTML(page)):
+            # 提取ip、port和area, 没有提取到内容时使用空字符串
+            yield first(ip(tr)), first(port(tr)), first(area(tr))
+
     def get_proxies_from_page(self, page):
         """从页面中提取ip、port和area并返回封装的Proxy对象"""
-        # 使用lxml的etree模块解析页面
-        html = etree.HTML(page)
-        # 使用分组xpath提取包含代理IP信息标签列表
-        trs = html.xpath(self.group_xpath)
-        # 遍历分组标签列表
-        for tr in trs:
-            # 使用_get_first_from_list方法提取ip、port和area
-            # 可以在没有提取到内容时返回空字符串，避免直接使用索引可能引发的报错
-            # 提取ip
-            ip = self._get_first_from_list(tr.xpath(self.detail_xpath['ip']))
-            # 提取port
-            port = self._get_first_from_list(tr.xpath(self.detail_xpath['port']))
-            # 提取area
-            area = self._get_first_from_list(tr.xpath(self.detail_xpath['area']))
+        for ip, port, area in self.extract_from_page(page):
             # 返回Proxy对象
             yield Proxy(ip, port, area=area)
-        
-        
+
     def get_proxies(self):
         """获取一个网站的所有代理IP的方法
         """
-        # 遍历URL列表, 获取URL
-        for url in self.urls:
-            # 随机休眠1-3秒, 防止因频繁请求被封IP或返回异常数据
-            time.sleep(random.uniform(1, 3))
-            # 根据发送请求, 获取页面数据
-            page = self.get_page_from_url(url)
-            # 解析页面, 提取数据, 封装为Proxy对象
-            # proxies = self.get_proxies_from_page(page)
-            proxies = self.get_proxies_from_page(page)
+        # 在并发限制之内并行请求URL列表中的页面, 按照URL列表的顺序返回页面数据
+        # 请求的速率由下载器限制, 防止因频繁请求被封IP或返回异常数据
+        pages = Pool(self.concurrency).imap(self.get_page_from_url, self.urls)
+        for url, page in zip(self.urls, pages):
+            # 请求失败或者没有变化的页面直接跳过
+            if page is None:
+                continue
+            # 解析页面, 提取数据, 封装为Proxy对象, 统计解析耗时(不包括调用方处理代理IP的时间)和代理IP数量
+            proxies = metrics.iter_timed(self.get_proxies_from_page(page), 'spider_parse_seconds',
+                                         count_name='spider_proxies_total', spider=type(self).__name__)
             # 返回Proxy对象生成器
             yield from proxies
+            # 页面中的代理IP全部交给调用方之后才提交页面缓存记录, 解析出错时下次仍然会解析这个页面
+            if self.use_page_cache:
+                page_cache.commit(url)
 
 
 if __name__ == '__main__':
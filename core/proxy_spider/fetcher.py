@@ -0,0 +1,105 @@
+"""
+爬虫共享的页面下载器
+- 作用: 所有爬虫共用一个带连接池的requests.Session, 复用到同一个网站的长连接
+- 礼貌限制: 对每个网站(host)分别限制
+    - 并发: 同时进行的请求数量不超过concurrency
+    - 速率: 每秒发起的请求数量不超过rate, 相邻两次请求的开始时间至少间隔1/rate秒
+    - 每个网站的限制只有一份: 优先使用SPIDER_HOST_LIMITS中配置的限制, 没有配置时使用第一个请求这个网站的爬虫的参数,
+      之后其他爬虫传入不同的参数时记录警告, 仍然使用已有的限制
+- 在gevent打补丁的进程中, 多个协程可以在限制之内并行下载同一个网站的多个页面
+"""
+import threading
+import time
+from urllib.parse import urlsplit
+import requests
+from requests.adapters import HTTPAdapter
+from settings import TIMEOUT, SPIDER_HOST_CONCURRENCY, SPIDER_HOST_RATE, SPIDER_RETRIES, SPIDER_HOST_LIMITS
+from utils.http import get_request_headers
+from utils.log import logger
+
+
+class HostLimiter:
+    """一个网站的并发和速率限制"""
+    def __init__(self, concurrency, rate):
+        self.concurrency = concurrency
+        self.rate = rate
+        # 已经记录过警告的不一致的参数
+        self.conflicts = set()
+        self.semaphore = threading.BoundedSemaphore(concurrency)
+        self.interval = 1 / rate if rate > 0 else 0
+        # 下一个请求最早可以开始的时间
+        self._next_start = 0
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        self.semaphore.acquire()
+        # 预约一个开始时间, 然后等待到这个时间
+        with self._lock:
+            start = max(time.time(), self._next_start)
+            self._next_start = start + self.interval
+        delay = start - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        return self
+
+    def __exit__(self, *exc):
+        self.semaphore.release()
+
+
+class Fetcher:
+    def __init__(self, pool_maxsize=10, host_limits=SPIDER_HOST_LIMITS):
+        """初始化方法
+        :param pool_maxsize: 每个网站连接池中保留的长连接数量
+        :param host_limits: 按网站配置的限制, host -> (同时进行的请求数量, 每秒最多发起的请求数量)
+        """
+        self.host_limits = host_limits
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=20, pool_maxsize=pool_maxsize)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        # host -> HostLimiter
+        self._limiters = dict()
+        self._lock = threading.Lock()
+
+    def get_limiter(self, host, concurrency=SPIDER_HOST_CONCURRENCY, rate=SPIDER_HOST_RATE):
+        """获取网站的限制, SPIDER_HOST_LIMITS中配置了这个网站时使用配置的限制, 否则第一次请求这个网站时按照传入的参数创建
+        已有的限制和传入的参数不一致时记录警告(每个网站的每组参数只记录一次)
+        """
+        with self._lock:
+            limiter = self._limiters.get(host)
+            if limiter is None:
+                limiter = HostLimiter(*self.host_limits.get(host, (concurrency, rate)))
+                self._limiters[host] = limiter
+            elif host not in self.host_limits and (concurrency, rate) != (limiter.concurrency, limiter.rate) \
+                    and (concurrency, rate) not in limiter.conflicts:
+                limiter.conflicts.add((concurrency, rate))
+                logger.warning(f'{host}的限制已经按照concurrency={limiter.concurrency}, rate={limiter.rate}创建, '
+                               f'忽略concurrency={concurrency}, rate={rate}, 可以在SPIDER_HOST_LIMITS中统一配置')
+            return limiter
+
+    def fetch(self, url, concurrency=SPIDER_HOST_CONCURRENCY, rate=SPIDER_HOST_RATE, retries=SPIDER_RETRIES,
+              timeout=TIMEOUT, verify=True, headers=None):
+        """在网站的并发和速率限制之内请求url
+        :param concurrency: 同一个网站同时进行的请求数量
+        :param rate: 同一个网站每秒最多发起的请求数量
+        :param retries: 请求失败时的重试次数
+        :param timeout: 超时时间(秒)
+        :param verify: 是否校验https证书
+        :param headers: 额外的请求头
+        :return: 返回响应对象, 重试之后仍然失败时返回None
+        """
+        limiter = self.get_limiter(urlsplit(url).netloc, concurrency, rate)
+        for attempt in range(retries + 1):
+            try:
+                with limiter:
+                    response = self.session.get(url, headers={**get_request_headers(), **(headers or {})},
+                                                timeout=timeout, verify=verify)
+                return response
+            except Exception as e:
+                logger.warning(f'请求{url}失败(第{attempt + 1}次), 错误信息为{e}')
+        logger.error(f'请求{url}失败')
+        return None
+
+
+# 所有爬虫共用的下载器
+fetcher = Fetcher()
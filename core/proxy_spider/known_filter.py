@@ -0,0 +1,52 @@
+"""
+已知代理IP过滤器
+- 作用: 免费代理网站每次列出的代理IP大多相同, 在校验之前跳过已经在代理池中, 或者最近校验失败过的代理IP, 减少爬虫模块的校验请求
+- 实现:
+  1. 每轮爬取开始时, 从数据库中加载所有代理IP的ip, 放入集合中; 数据库以ip为主键, 同一个ip只能保存一个端口,
+     因此已知的代理IP也按照ip判断, 已经在代理池中的ip换了端口也不再校验(校验通过也不会写入)
+  2. 开始校验的代理IP的ip加入集合, 同一轮爬取中, 多个爬虫抓取到的同一个ip只校验一次
+  3. 校验失败的代理IP按照ip:port记录失败时间, SPIDER_REJECTED_TTL_SECONDS秒内不再校验这个端口,
+     同时把ip移出集合, 同一个ip的其他端口仍然可以校验
+- 使用集合而不是布隆过滤器: 代理池的规模在十万级以内, 集合的内存占用可以接受, 而且没有误判
+"""
+import time
+from settings import SPIDER_REJECTED_TTL_SECONDS
+
+
+class KnownProxyFilter:
+    def __init__(self, rejected_ttl=SPIDER_REJECTED_TTL_SECONDS):
+        """初始化方法
+        :param rejected_ttl: 校验失败的代理IP在多长时间(秒)内不再校验
+        """
+        self.rejected_ttl = rejected_ttl
+        # 代理池中已经存在的, 以及本轮已经开始校验的代理IP
+        self.known = set()
+        # 校验失败的代理IP -> 失败时间, 跨轮次保留
+        self.rejected = dict()
+
+    @staticmethod
+    def _rejected_key(ip, port):
+        return f'{ip}:{port}'
+
+    def load(self, keys):
+        """每轮爬取开始时调用, 重新加载代理池中已经存在的代理IP, 并清除已经过期的失败记录
+        :param keys: (ip, port)的可迭代对象
+        """
+        self.known = {ip for ip, _ in keys}
+        expired = time.time() - self.rejected_ttl
+        self.rejected = {key: rejected_at for key, rejected_at in self.rejected.items() if rejected_at > expired}
+
+    def should_check(self, proxy):
+        """判断代理IP是否需要校验, 需要校验时把它标记为已知, 同一轮中不会再次校验"""
+        if proxy.ip in self.known:
+            return False
+        rejected_at = self.rejected.get(self._rejected_key(proxy.ip, proxy.port))
+        if rejected_at is not None and time.time() - rejected_at < self.rejected_ttl:
+            return False
+        self.known.add(proxy.ip)
+        return True
+
+    def reject(self, proxy):
+        """记录校验失败的代理IP, 同一个ip的其他端口仍然可以校验"""
+        self.rejected[self._rejected_key(proxy.ip, proxy.port)] = time.time()
+        self.known.discard(proxy.ip)
@@ -0,0 +1,110 @@
+"""
+爬虫页面缓存
+- 作用: 代理IP网站的列表页往往比爬虫的运行周期更新得慢, 页面没有变化时不再重复解析页面和校验其中的代理IP
+- 实现:
+  1. 为每个url保存响应头中的ETag和Last-Modified, 以及页面内容的哈希值, 保存在SPIDER_PAGE_CACHE_FILE中, 重启后仍然有效
+  2. 请求页面时带上If-None-Match和If-Modified-Since请求头, 网站返回304时说明页面没有变化
+  3. 网站不支持条件请求时, 比较页面内容的哈希值, 相同时说明页面没有变化
+  4. 缓存记录超过SPIDER_PAGE_CACHE_SECONDS秒后失效, 页面会被重新解析一次, 让早先校验失败的代理IP有机会再次校验
+  5. 判断页面是否变化时不修改缓存记录, 页面解析完成之后才调用commit提交缓存记录, 解析失败或者进程中途退出时,
+     页面下次仍然会被解析; 提交的记录只保存在内存中, 一轮爬取结束之后调用save统一写入文件
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+from settings import SPIDER_PAGE_CACHE_FILE, SPIDER_PAGE_CACHE_SECONDS
+from utils.log import logger
+
+
+class PageCache:
+    def __init__(self, filename=SPIDER_PAGE_CACHE_FILE, max_age=SPIDER_PAGE_CACHE_SECONDS):
+        """初始化方法
+        :param filename: 保存缓存记录的文件
+        :param max_age: 缓存记录的有效时间(秒)
+        """
+        self.filename = filename
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        # url -> {'etag': ..., 'last_modified': ..., 'hash': ..., 'stored_at': ...}
+        self._entries = self._load()
+        # 页面发生变化但还没有处理完成的缓存记录: url -> {'etag': ..., 'last_modified': ..., 'hash': ...}
+        self._pending = dict()
+        # 是否有提交之后还没有写入文件的缓存记录
+        self._dirty = False
+
+    def _load(self):
+        """从文件中加载缓存记录, 文件不存在或损坏时返回空的缓存"""
+        try:
+            with open(self.filename, encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return dict()
+        except ValueError as e:
+            logger.warning(f'页面缓存文件{self.filename}损坏, 已忽略: {e}')
+            return dict()
+
+    def _save(self):
+        """把缓存记录写入临时文件, 然后替换原文件, 避免写入过程中出错导致文件损坏"""
+        temp_filename = f'{self.filename}.tmp'
+        with open(temp_filename, 'w', encoding='utf-8') as f:
+            json.dump(self._entries, f)
+        os.replace(temp_filename, self.filename)
+
+    def _get_entry(self, url):
+        """返回url的缓存记录, 没有记录或者记录已经失效时返回None"""
+        entry = self._entries.get(url)
+        if entry is None or time.time() - entry['stored_at'] > self.max_age:
+            return None
+        return entry
+
+    def get_headers(self, url):
+        """返回请求url时需要带上的条件请求头"""
+        entry = self._get_entry(url)
+        headers = dict()
+        if entry is not None:
+            if entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+            if entry.get('last_modified'):
+                headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def is_changed(self, url, response):
+        """判断页面相对于上次请求是否发生了变化, 页面发生变化时暂存新的缓存记录, 等待调用commit提交
+        :param response: 使用get_headers返回的请求头请求url得到的响应对象, 调用方需要先跳过请求失败(非2xx)的响应
+        :return: 页面没有变化(返回304或者内容的哈希值相同)时返回False
+        """
+        if response.status_code == 304:
+            return False
+        entry = self._get_entry(url)
+        content_hash = hashlib.sha1(response.content).hexdigest()
+        if entry is not None and entry['hash'] == content_hash:
+            return False
+        with self._lock:
+            self._pending[url] = {
+                'etag': response.headers.get('ETag'),
+                'last_modified': response.headers.get('Last-Modified'),
+                'hash': content_hash,
+            }
+        return True
+
+    def commit(self, url):
+        """页面处理完成之后提交is_changed暂存的缓存记录, 之后请求这个页面时才会被当作没有变化"""
+        with self._lock:
+            entry = self._pending.pop(url, None)
+            if entry is None:
+                return
+            self._entries[url] = {**entry, 'stored_at': time.time()}
+            self._dirty = True
+
+    def save(self):
+        """把提交的缓存记录写入文件, 没有新提交的记录时不写入"""
+        with self._lock:
+            if not self._dirty:
+                return
+            self._save()
+            self._dirty = False
+
+# 所有爬虫共用的页面缓存
+page_cache = PageCache()
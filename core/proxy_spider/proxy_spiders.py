@@ -3,18 +3,16 @@
 就可以实现一个新的爬虫类。其他的方法都自动从BaseSpider类中继承。
 """
 from core.proxy_spider.base_spider import BaseSpider
-from lxml import etree
-from model import Proxy
-from retrying import retry
-import re
 import json
-from settings import TIMEOUT
-from utils.http import get_request_headers
 from utils.log import logger
-import requests
 import urllib3
 urllib3.disable_warnings()
 
+# 快代理页面中保存代理IP列表的JavaScript变量
+KUAIDAILI_LIST_MARKER = b'const fpsList = '
+# 从指定位置开始解析一个json值, 解析完这个值就停止, 不需要先用正则表达式截取
+json_decoder = json.JSONDecoder()
+
 class Ip3366Spider(BaseSpider):
     """爬取ip3366网站的爬虫类"""
     # 列表页的url列表
@@ -46,42 +44,29 @@ class KuaidailiSpider(BaseSpider):
     # 列表页的url列表
     urls = [f"https://www.kuaidaili.com/free/inha/{i}/" for i in range(1, 11)]
 
-    # 快代理的请求偶发SSL错误，所以需要重写get_page_from_url方法
-    # 设置超时时间，和重试次数
-    @retry(stop_max_attempt_number=3, retry_on_result=lambda x: x is None)
-    def get_page_from_url(self, url):
-        """请求url获取页面内容"""
-        try:
-            response = requests.get(url, headers=get_request_headers(), timeout=TIMEOUT, verify=False)
-            return response.content
-        except Exception as e:
-            logger.exception(f"请求{url}失败, 错误信息为{e}")
-            return None
-    
+    # 快代理的请求偶发SSL错误，所以不校验证书，并且失败时重试
+    verify = False
+    retries = 2
+    # 快代理的页面可以承受更高的并发和速率
+    concurrency = 4
+    rate = 2.0
+
     # 快代理的代理IP在页面中的布局结构和前两个爬虫不一样
-    # 所以需要重写get_proxies_from_page方法, 用不一样的提取逻辑解析页面, 获取ip、port和area
-    def get_proxies_from_page(self, page):
-        """从页面中提取ip、port和area并返回封装的Proxy对象"""
-        # 如果页面为空, 则记录日志并结束方法执行
-        if page is None:
-            logger.exception(f"获取页面失败")
+    # 所以需要重写extract_from_page方法, 用不一样的提取逻辑解析页面, 获取ip、port和area
+    def extract_from_page(self, page):
+        """从页面中提取代理IP信息, 返回(ip, port, area)元组的生成器"""
+        # 查找代理IP列表的位置, 不解码整个页面
+        start = page.find(KUAIDAILI_LIST_MARKER)
+        # 如果没有找到, 则记录日志并结束方法执行
+        if start == -1:
+            logger.warning("页面中没有找到代理IP列表")
             return
-        # 解码传入的page参数(bytes类型), 获取页面内容
-        html_str = page.decode()
-        # 使用正则表达式提取包含代理IP信息的字符串
-        ip_list_str = re.search(r'const fpsList = (\[.*?\]);', html_str, re.S).group(1)
-        # 将字符串转换为json对象(包含代理IP信息的字典组成的列表)
-        ip_list_json = json.loads(ip_list_str)
-        # 遍历这个列表
+        # 只解码代理IP列表开始之后的内容, 解析出包含代理IP信息的字典组成的列表
+        html_str = page[start + len(KUAIDAILI_LIST_MARKER):].decode()
+        ip_list_json, _ = json_decoder.raw_decode(html_str)
+        # 遍历这个列表, 提取ip、port和area
         for item in ip_list_json:
-            # 提取ip
-            ip = item['ip']
-            # 提取port
-            port = item['port']
-            # 提取area
-            area = item['location']
-            # 返回Proxy对象
-            yield Proxy(ip, port, area=area)
+            yield item['ip'], item['port'], item['location']
 
 if __name__ == '__main__':
     # spider = Ip3366Spider()
@@ -5,14 +5,17 @@
     - 提供一个运行爬虫的run方法, 作为运行爬虫的入口, 实现核心的处理逻辑
         - 根据配置文件信息, 获取爬虫对象列表.
         - 获取爬虫对象, 遍历爬虫对象的get_proxies方法, 获取代理IP
+        - 跳过代理池中已经存在的, 或者最近校验失败过的代理IP
         - 检测代理IP(代理IP检测模块)
-        - 如果可用,写入数据库(数据库模块)
+        - 如果可用,放入数据库模块的批量写入缓冲区, 由缓冲区批量写入数据库
         - 处理异常, 防止一个爬虫内部出错了, 影响其他的爬虫. 
-    - 使用异步来执行每一个爬虫任务, 以提高抓取代理IP效率
-        - 在init方法中创建协程池对象
-        - 把处理一个代理爬虫的代码抽到一个方法
-        - 使用异步执行这个方法
-        - 调用协程的join方法, 让当前线程等待协程任务的完成. 
+    - 把抓取、校验、存储拆分为由有界队列连接的三个流水线阶段, 每个阶段有各自的协程数量
+        - 抓取阶段: SPIDER_SCRAPE_WORKERS个协程从爬虫队列中取出爬虫, 把需要校验的代理IP放入校验队列
+        - 校验阶段: SPIDER_VALIDATE_WORKERS个协程从校验队列中取出代理IP进行校验, 把校验结果放入存储队列
+        - 存储阶段: SPIDER_STORE_WORKERS个协程从存储队列中取出校验结果, 可用的放入批量写入缓冲区
+        - 队列满时上一个阶段阻塞(背压), 吞吐量取决于校验能力, 而不是爬虫的数量
+        - 上一个阶段的协程全部结束后, 为下一个阶段的每个协程放入一个结束标记(None)
+        - 运行期间定期记录每个阶段的队列深度, 也可以通过queue_depths方法获取, 用于调整各阶段的协程数量
     - 使用schedule模块, 实现每隔一定的时间, 执行一次爬取任务
         - 定义一个start的类方法
         - 创建当前类的对象, 调用run方法
@@ -21,14 +24,21 @@
 from gevent import monkey
 monkey.patch_all()  # 打补丁, 让gevent识别耗时操作
 import importlib
+import gevent
+from gevent.queue import Queue, Empty
 from settings import PROXIES_SPIDERS
 from core.proxy_validate.httpbin_validator import check_proxy
-from core.db.mongo_pool import MongoPool
+from core.proxy_validate.engine import check_proxies
+from core.db.storage import create_pool
+from core.proxy_spider.known_filter import KnownProxyFilter
+from core.proxy_spider.page_cache import page_cache
 from utils.log import logger
-from gevent.pool import Pool
+from utils import metrics
 import schedule
 import time
-from settings import RUN_SPIDERS_INTERVAL_HOURS
+from settings import RUN_SPIDERS_INTERVAL_HOURS, VALIDATE_ENGINE, ASYNC_VALIDATE_CONCURRENCY
+from settings import SPIDER_SCRAPE_WORKERS, SPIDER_VALIDATE_WORKERS, SPIDER_STORE_WORKERS
+from settings import SPIDER_VALIDATE_QUEUE_SIZE, SPIDER_STORE_QUEUE_SIZE, SPIDER_PIPELINE_LOG_SECONDS
 
 
 class RunSpider:
@@ -36,8 +46,13 @@ class RunSpider:
         """初始化方法
         获取数据库操作对象
         """
-        self.mongo_pool = MongoPool()
-        self.gevent_pool = Pool()
+        self.mongo_pool = create_pool()
+        # 已知代理IP过滤器, 跳过不需要校验的代理IP
+        self.known_filter = KnownProxyFilter()
+        # 连接流水线各个阶段的队列, 每轮爬取时重新创建
+        self.spider_queue = Queue()
+        self.validate_queue = Queue(maxsize=SPIDER_VALIDATE_QUEUE_SIZE)
+        self.store_queue = Queue(maxsize=SPIDER_STORE_QUEUE_SIZE)
 
     def get_spider_from_settings(self):
         """根据配置文件信息, 返回爬虫对象列表"""
@@ -52,37 +67,137 @@ class RunSpider:
             spider = spider_cls()
             yield spider
 
+    def queue_depths(self):
+        """返回流水线每个阶段等待处理的数量"""
+        return {
+            'scrape': self.spider_queue.qsize(),
+            'validate': self.validate_queue.qsize(),
+            'store': self.store_queue.qsize(),
+        }
 
-    def __execute_one_spider_task(self, spider):
-        """把处理一个爬虫的代码抽到这个方法中"""
-        # 处理异常, 防止一个爬虫内部出错了, 影响其他的爬虫. 
-        try:
-            # 遍历爬虫对象的get_proxies方法, 获取代理IP对应的Proxy对象
-            for proxy in spider.get_proxies():
-                # 检测代理IP(代理IP检测模块)
-                print(f'正在检测: {proxy}')
-                proxy = check_proxy(proxy)
-                # 如果代理IP可用（speed不为-1）,就存入数据库
+    def __scrape_worker(self):
+        """抓取阶段: 从爬虫队列中取出爬虫, 把需要校验的代理IP放入校验队列, 爬虫队列为空时退出"""
+        while True:
+            try:
+                spider = self.spider_queue.get_nowait()
+            except Empty:
+                return
+            # 处理异常, 防止一个爬虫内部出错了, 影响其他的爬虫.
+            try:
+                # 遍历爬虫对象的get_proxies方法, 获取代理IP对应的Proxy对象, 跳过不需要校验的代理IP
+                for proxy in spider.get_proxies():
+                    if self.known_filter.should_check(proxy):
+                        self.validate_queue.put(proxy)
+                    else:
+                        metrics.inc('spider_skipped_total', spider=type(spider).__name__)
+            # 捕获异常,打印异常信息
+            except Exception as e:
+                logger.exception(e)
+
+    def __validate_worker(self):
+        """校验阶段: 从校验队列中取出代理IP进行校验, 把校验结果放入存储队列, 取到结束标记时退出"""
+        while True:
+            proxy = self.validate_queue.get()
+            if proxy is None:
+                return
+            # 处理异常, 防止一个代理IP校验出错了, 影响其他的代理IP
+            try:
+                self.store_queue.put(check_proxy(proxy))
+            except Exception as e:
+                logger.exception(e)
+
+    def __validate_batch_worker(self):
+        """校验阶段(asyncio引擎): 每次取出校验队列中已有的代理IP(最多ASYNC_VALIDATE_CONCURRENCY个)并发校验
+        不在事件循环中阻塞等待队列, 避免抓取较慢时正在进行的校验请求停顿, 导致速度计算不准确甚至超时
+        """
+        finished = False
+        while not finished:
+            batch = [self.validate_queue.get()]
+            while len(batch) < ASYNC_VALIDATE_CONCURRENCY:
+                try:
+                    batch.append(self.validate_queue.get_nowait())
+                except Empty:
+                    break
+            if None in batch:
+                finished = True
+                batch = [proxy for proxy in batch if proxy is not None]
+            try:
+                for proxy in check_proxies(batch):
+                    self.store_queue.put(proxy)
+            except Exception as e:
+                logger.exception(e)
+
+    def __store_worker(self):
+        """存储阶段: 可用的代理IP放入批量写入缓冲区, 不可用的记录校验失败, 取到结束标记时退出"""
+        while True:
+            proxy = self.store_queue.get()
+            if proxy is None:
+                return
+            try:
+                # 如果代理IP可用（speed不为-1）,就放入批量写入的缓冲区, updated_at在写入数据库时才生成
                 if proxy.speed != -1:
-                    self.mongo_pool.insert_one(proxy)
-        # 捕获异常,打印异常信息
-        except Exception as e:
-            logger.exception(e)
+                    self.mongo_pool.buffer_insert(proxy)
+                    metrics.inc('spider_validated_total', result='valid')
+                # 否则记录校验失败, 一段时间内不再校验
+                else:
+                    self.known_filter.reject(proxy)
+                    metrics.inc('spider_validated_total', result='invalid')
+            except Exception as e:
+                logger.exception(e)
+
+    def __log_queue_depths_forever(self):
+        """定期记录每个阶段的队列深度"""
+        while True:
+            gevent.sleep(SPIDER_PIPELINE_LOG_SECONDS)
+            depths = self.queue_depths()
+            logger.info(f'爬虫流水线队列深度: {depths}')
+            for stage, depth in depths.items():
+                metrics.set_gauge('spider_queue_depth', depth, stage=stage)
 
+    @staticmethod
+    def __finish_stage(workers, next_queue, next_count):
+        """等待一个阶段的协程全部结束, 然后为下一个阶段的每个协程放入一个结束标记"""
+        gevent.joinall(workers)
+        for _ in range(next_count):
+            next_queue.put(None)
 
     def run(self):
         """提供一个运行爬虫的run方法, 作为运行爬虫的入口, 实现核心的处理逻辑
         """
-        # 获取爬虫对象生成器
-        spiders = self.get_spider_from_settings()
-        # 遍历爬虫对象
-        for spider in spiders:
-            # 用异步协程的方式执行每个爬虫的任务
-            self.gevent_pool.apply_async(self.__execute_one_spider_task, args=(spider, ))
-        # 阻塞主线程使其等待所有协程任务执行完毕
-        self.gevent_pool.join()
+        with metrics.timer('spider_run_seconds'):
+            self.__run()
+
+    def __run(self):
+        # 加载代理池中已经存在的代理IP
+        self.known_filter.load(self.mongo_pool.iter_keys())
+        # 创建本轮的队列, 把爬虫对象放入爬虫队列
+        self.spider_queue = Queue()
+        self.validate_queue = Queue(maxsize=SPIDER_VALIDATE_QUEUE_SIZE)
+        self.store_queue = Queue(maxsize=SPIDER_STORE_QUEUE_SIZE)
+        for spider in self.get_spider_from_settings():
+            self.spider_queue.put(spider)
+        # asyncio引擎在一个协程中运行事件循环, 由事件循环自己并发校验
+        if VALIDATE_ENGINE == 'asyncio':
+            validate_count, validate = 1, self.__validate_batch_worker
+        else:
+            validate_count, validate = SPIDER_VALIDATE_WORKERS, self.__validate_worker
+        # 启动每个阶段的协程
+        scrapers = [gevent.spawn(self.__scrape_worker) for _ in range(SPIDER_SCRAPE_WORKERS)]
+        validators = [gevent.spawn(validate) for _ in range(validate_count)]
+        storers = [gevent.spawn(self.__store_worker) for _ in range(SPIDER_STORE_WORKERS)]
+        monitor = gevent.spawn(self.__log_queue_depths_forever)
+        try:
+            # 按照顺序结束每个阶段, 阻塞主线程使其等待所有协程任务执行完毕
+            self.__finish_stage(scrapers, self.validate_queue, validate_count)
+            self.__finish_stage(validators, self.store_queue, SPIDER_STORE_WORKERS)
+            gevent.joinall(storers)
+        finally:
+            monitor.kill()
+            # 把缓冲区中剩余的代理IP写入数据库
+            self.mongo_pool.flush()
+        # 本轮的代理IP全部校验并写入数据库之后, 才把提交的页面缓存记录写入文件, 中途出错时页面下次仍然会被解析
+        page_cache.save()
 
-    
     @classmethod
     def start(cls):
         """作为启动入口的类方法
@@ -90,6 +205,8 @@ class RunSpider:
         """
         # 创建实例
         run_spider = cls()
+        # 定期把本进程的指标写入文件, 由API的/metrics接口汇总
+        metrics.start_reporter('spider')
         # 立马启动，否则需要等待一个周期才启动
         run_spider.run()
         # 指定实例的run方法执行的周期
@@ -1,92 +1,162 @@
 from gevent import monkey
 monkey.patch_all() # 打补丁, 让gevent识别耗时操作
 
-from gevent.pool import Pool
-from core.db.mongo_pool import MongoPool
+import gevent
+from gevent.queue import Queue
+from core.db.storage import create_pool
 from core.proxy_validate.httpbin_validator import check_proxy
-from settings import MAX_SCORE, TEST_PROXY_ASYNC_COUNT, RUN_TEST_INTERVAL_HOURS
+from core.proxy_validate.engine import check_proxies
+from core.check_schedule import get_schedule_fields
+from settings import MAX_SCORE, TEST_PROXY_ASYNC_COUNT, VALIDATE_ENGINE, CHECK_BATCH_SIZE, CHECK_IDLE_SECONDS
+from settings import TEST_QUEUE_SIZE, TEST_CURSOR_BATCH_SIZE
 from utils.log import logger
-from queue import Queue
-import schedule
+from utils import metrics
 import time
 
 
+# 检测过程中可能发生变化的字段, 写回数据库时只写入其中发生变化的字段
+CHECKED_FIELDS = ('protocol', 'nick_type', 'speed', 'score')
+
+
 class ProxyTester:
-    def __init__(self):
-        """初始化方法"""
+    def __init__(self, mongo_pool=None):
+        """初始化方法
+        :param mongo_pool: 数据库操作对象, 默认值为None, 表示按照STORAGE_BACKEND创建数据库操作对象
+        """
         # 数据库操作对象
-        self.mongo_pool = MongoPool()
-        # 协程池
-        self.gevent_pool = Pool()
-        # 用于传递proxy对象的队列
-        self.queue = Queue()
+        self.mongo_pool = mongo_pool if mongo_pool is not None else create_pool()
 
     def run(self):
-        """执行检测代理IP的过程的核心逻辑"""
-        # 从数据库获取所有代理IP的proxy对象
-        proxies = self.mongo_pool.find_all()
-        # 遍历proxy对象
-        for proxy in proxies:
-            # 把要检测的proxy放入队列
-            self.queue.put(proxy)
-        # 根据配置的并发数量，创建协程池中的并发协程
-        for _ in range(TEST_PROXY_ASYNC_COUNT):
-            # 把检测一个proxy的方法加入协程池，并指定回调函数
-            self.gevent_pool.apply_async(
-                self.__check_one_proxy, callback=self.__check_callback
-            )
-        # 阻塞线程，使其等待队列中的任务全部完成
-        self.queue.join()
-
-    def __check_callback(self, temp):
-        """回调函数
-        不断回调自己从而实现循环（不断把检测proxy的方法加入协程池）
+        """全量检测数据库中的所有代理IP
+        以流的方式分批读取数据库游标, 读到第一个代理IP就开始检测, 内存占用不随代理池的大小增长
+        """
+        with metrics.timer('tester_sweep_seconds', kind='full'):
+            self.__check_proxies((proxy, 0) for proxy in self.mongo_pool.find_all(batch_size=TEST_CURSOR_BATCH_SIZE))
+            # 把缓冲区中剩余的检测结果写入数据库
+            self.mongo_pool.flush()
+
+    def run_due(self):
+        """检测一批已经到期(next_check不晚于当前时间)的代理IP
+        :return: 返回本次检测的代理IP的数量
+        """
+        start = time.perf_counter()
+        due = list(self.mongo_pool.find_due(count=CHECK_BATCH_SIZE))
+        self.__check_proxies(due)
+        # 写入这一批的检测结果, 更新它们的下次检测时间, 下次查询到期的代理IP时就不会重复取到它们
+        self.mongo_pool.flush()
+        # 没有到期的代理IP时不统计, 避免空闲时的查询拉低耗时分布
+        if due:
+            metrics.observe('tester_sweep_seconds', time.perf_counter() - start, kind='due')
+            metrics.inc('tester_due_proxies_total', len(due))
+        return len(due)
+
+    def __check_proxies(self, items):
+        """使用配置的引擎检测多个代理IP, 每检测完一个就根据结果更新或删除
+        :param items: (proxy对象, 自上次检测以来被API提供的次数)的可迭代对象
+        """
+        # 记录每个proxy检测前的字段值和被API提供的次数
+        befores = dict()
+
+        def iter_proxies():
+            for proxy, served in items:
+                befores[proxy.ip] = ({field: getattr(proxy, field) for field in CHECKED_FIELDS}, served)
+                yield proxy
+
+        if VALIDATE_ENGINE == 'asyncio':
+            # asyncio引擎自己限制同时检测的数量
+            for proxy in check_proxies(iter_proxies()):
+                before, served = befores.pop(proxy.ip)
+                self.__save_check_result(proxy, before, served)
+        else:
+            self.__check_in_workers(iter_proxies(), befores)
+
+    def __check_in_workers(self, proxies, befores):
+        """使用固定数量的检测协程, 通过有界队列检测多个代理IP
+        - 生产者协程把proxy放入有界队列, 队列满时阻塞, 不再继续读取数据库游标(背压)
+        - TEST_PROXY_ASYNC_COUNT个检测协程从队列中取出proxy检测, 取到结束标记(None)时退出
+        - 生产者结束(包括出错)时为每个检测协程放入一个结束标记, 所有协程都会正常退出
+        """
+        queue = Queue(maxsize=TEST_QUEUE_SIZE)
+
+        def produce():
+            try:
+                for proxy in proxies:
+                    queue.put(proxy)
+                    metrics.set_gauge('tester_queue_depth', queue.qsize())
+            finally:
+                for _ in range(TEST_PROXY_ASYNC_COUNT):
+                    queue.put(None)
+
+        def work():
+            while True:
+                proxy = queue.get()
+                if proxy is None:
+                    return
+                try:
+                    proxy = check_proxy(proxy)
+                    before, served = befores.pop(proxy.ip)
+                    self.__save_check_result(proxy, before, served)
+                # 处理异常, 防止一个proxy检测出错了, 影响其他的proxy
+                except Exception as e:
+                    logger.exception(e)
+
+        producer = gevent.spawn(produce)
+        workers = [gevent.spawn(work) for _ in range(TEST_PROXY_ASYNC_COUNT)]
+        gevent.joinall([producer] + workers)
+        # 生产者出错时抛出异常
+        producer.get()
+
+    def __save_check_result(self, proxy, before, served=0):
+        """根据检测结果修改proxy的分数和下次检测时间, 然后放入缓冲区批量更新或删除
+        :param proxy: 检测后的proxy对象
+        :param before: 检测前的字段值
+        :param served: 自上次检测以来被API提供的次数
         """
-        self.gevent_pool.apply_async(
-            self.__check_one_proxy, callback=self.__check_callback
-        )
-
-    def __check_one_proxy(self):
-        """检测一个Proxy的具体逻辑实现"""
-        # 从队列中获取要检测的proxy
-        proxy = self.queue.get()
-        # 检测proxy
-        proxy = check_proxy(proxy)
         # 如果speed=-1，表示不可用
         if proxy.speed == -1:
             # 分数减一
             proxy.score -= 1
-            # 如果分数变为0，则从数据库中删除
-            if proxy.score == 0:
-                self.mongo_pool.delete_one(proxy)
-                logger.info(f"删除代理：{proxy}")
-            # 如果分数不为0，则将proxy更新到数据库中
-            else:
-                self.mongo_pool.update_one(proxy)
         else:
             # 如果speed!=-1，表示可用，则恢复默认最高分
             proxy.score = MAX_SCORE
-            # 并更新到数据库中
-            self.mongo_pool.update_one(proxy)
-        # 通知队列当前任务已经完成，计数器要减一
-        self.queue.task_done()
-    
+        # 如果分数变为0，则放入缓冲区批量从数据库中删除
+        if proxy.score == 0:
+            self.mongo_pool.buffer_delete(proxy)
+            logger.info(f"删除代理：{proxy}")
+            metrics.inc('tester_results_total', result='deleted')
+        # 否则只把发生变化的字段和调度字段放入缓冲区批量更新到数据库中
+        else:
+            changed = {field: getattr(proxy, field) for field in CHECKED_FIELDS if getattr(proxy, field) != before[field]}
+            # 根据分数和被API提供的次数计算下次检测时间, 并扣除这次已经计入的提供次数
+            fields = {**changed, **get_schedule_fields(proxy.score, served)}
+            inc = {'served': -served} if served else None
+            # 只有分数、速度等字段发生变化时, 才需要让API的内存索引重新拉取
+            self.mongo_pool.buffer_update(proxy, fields, inc=inc, touch=bool(changed))
+            metrics.inc('tester_results_total', result='ok' if proxy.speed != -1 else 'failed')
+
     @classmethod
     def start(cls):
         """作为启动代理检测模块的入口方法
-        使用schedule模块，每隔一定的时间，执行一次检测任务
+        持续检测到期的代理IP, 没有到期的代理IP时等待到最早的下次检测时间
         """
         # 创建实例
         proxy_tester = cls()
-        # 立马启动，否则需要等待一个周期才启动
-        proxy_tester.run()
-        # 根据配置文件的配置，指定实例的run方法执行的周期
-        schedule.every(RUN_TEST_INTERVAL_HOURS).hours.do(proxy_tester.run)
-        # 不断检测schedule的状态，周期抵达时激活执行
+        # 定期把本进程的指标写入文件, 由API的/metrics接口汇总
+        metrics.start_reporter('tester')
         while True:
-            # 每隔1秒检测一次周期状态
-            schedule.run_pending()
-            time.sleep(1)
+            try:
+                # 如果检测了到期的代理IP, 则立即查询下一批
+                if proxy_tester.run_due():
+                    continue
+                # 否则等待到最早的下次检测时间, 但最多等待CHECK_IDLE_SECONDS秒, 以便及时检测新插入的代理IP
+                next_check = proxy_tester.mongo_pool.get_next_check()
+                if next_check is None:
+                    time.sleep(CHECK_IDLE_SECONDS)
+                else:
+                    time.sleep(min(max(next_check - time.time(), 0), CHECK_IDLE_SECONDS))
+            except Exception as e:
+                logger.exception(e)
+                time.sleep(CHECK_IDLE_SECONDS)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,148 @@
+"""
+基于asyncio的代理IP校验模块
+- 作用: 使用aiohttp并发校验大量代理IP, 一个失效的代理IP不再占用一个协程长达两个TIMEOUT
+- 实现:
+  1. 同一个代理IP的http和https两个检查请求并发进行, 其中一个超时或者无法连接时, 说明代理IP已经失效, 立即取消另一个
+  2. 使用信号量限制全局同时进行的请求数量(ASYNC_VALIDATE_CONCURRENCY)
+  3. 使用异步生成器check_many, 每校验完一个代理IP就返回一个, 不需要等待全部校验结束
+  4. 提供同步生成器check_proxies, 供RunSpider和ProxyTester这样的同步代码直接遍历使用
+  5. 超时时间根据每个代理IP历史上的响应时间估计(probe_timeout.py), 和gevent引擎共用同样的方法
+- 判断逻辑和httpbin_validator.check_proxy一致, 因此两种引擎得到的结果是相同的
+"""
+import asyncio
+import json
+import time
+import aiohttp
+from core.proxy_validate.httpbin_validator import get_nick_type, set_check_result, record_request, record_proxy
+from core.proxy_validate.httpbin_validator import record_probe, record_skipped, FAILED_RESULT, UNREACHABLE_ERRORS
+from core.proxy_validate.probe_timeout import probe_timeouts
+from settings import TIMEOUT, VALIDATE_HTTP_URL, VALIDATE_HTTPS_URL, ASYNC_VALIDATE_CONCURRENCY
+from utils.http import get_request_headers
+from model import Proxy
+
+
+async def _check_http_proxy(session, semaphore, proxy, is_http=True):
+    """检查http或https代理IP是否可用, 返回((是否可用, 匿名类型, 速度), 失败的原因), 失败的原因和gevent引擎一致"""
+    start = time.perf_counter()
+    result, error = await _request(session, semaphore, proxy, is_http)
+    record_probe(proxy, result, error)
+    # 耗时包括等待信号量的时间
+    record_request('asyncio', 'http' if is_http else 'https', result, time.perf_counter() - start)
+    return result, error
+
+
+async def _request(session, semaphore, proxy, is_http):
+    """通过代理IP请求检查地址, 返回((是否可用, 匿名类型, 速度), 失败的原因)"""
+    test_url = VALIDATE_HTTP_URL if is_http else VALIDATE_HTTPS_URL
+    # aiohttp只支持http代理, https请求通过代理的CONNECT方法建立隧道
+    proxy_url = f'http://{proxy.ip}:{proxy.port}'
+    # 超时时间根据这个代理IP历史上的响应时间估计
+    timeout = aiohttp.ClientTimeout(total=probe_timeouts.get(proxy, TIMEOUT))
+    # 获取信号量, 限制全局同时进行的请求数量
+    async with semaphore:
+        try:
+            # 记录开始时间
+            start = time.perf_counter()
+            async with session.get(test_url, proxy=proxy_url, headers=get_request_headers(),
+                                   timeout=timeout) as response:
+                # 如果请求失败，则返回表示代理IP不可用的结果
+                if not response.ok:
+                    return FAILED_RESULT, 'failed'
+                # 计算代理IP的速度, 单位为秒，保留两位小数
+                speed = round(time.perf_counter() - start, 2)
+                # 获取响应内容, 并判断代理IP的匿名类型
+                content = json.loads(await response.text())
+                return (True, get_nick_type(content), speed), None
+        except asyncio.TimeoutError:
+            return FAILED_RESULT, 'timeout'
+        except aiohttp.ClientSSLError:
+            # 能够连接代理IP, 只是TLS握手失败
+            return FAILED_RESULT, 'failed'
+        except aiohttp.ClientConnectorError:
+            # 无法连接代理IP
+            return FAILED_RESULT, 'connect'
+        except Exception:
+            # 如果整个检测的过程出现其他异常，则返回表示代理IP不可用的结果
+            return FAILED_RESULT, 'failed'
+
+
+async def check_one(session, semaphore, proxy):
+    """并发检查一个代理IP的http和https, 并设置proxy对象的协议类型、匿名类型和速度
+    先完成的检查超时或者无法连接时, 取消另一个检查, 它的结果视为失败
+    """
+    start = time.perf_counter()
+    tasks = [asyncio.ensure_future(_check_http_proxy(session, semaphore, proxy)),
+             asyncio.ensure_future(_check_http_proxy(session, semaphore, proxy, is_http=False))]
+    results = [FAILED_RESULT, FAILED_RESULT]
+    pending = set(tasks)
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            errors = []
+            for task in done:
+                results[tasks.index(task)], error = task.result()
+                errors.append(error)
+            if pending and any(error in UNREACHABLE_ERRORS for error in errors):
+                for task in pending:
+                    record_skipped('asyncio', 'http' if tasks.index(task) == 0 else 'https')
+                break
+    finally:
+        # 取消还没有完成的检查(包括调用方取消了这个协程), 并等待它们释放信号量和连接
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+    proxy = set_check_result(proxy, *results)
+    record_proxy('asyncio', proxy, time.perf_counter() - start)
+    return proxy
+
+
+async def check_many(proxies, concurrency=ASYNC_VALIDATE_CONCURRENCY):
+    """并发校验多个代理IP, 按照完成的先后顺序返回校验后的proxy对象
+    :param proxies: 要校验的proxy对象的可迭代对象, 会在事件循环中同步遍历, 因此应当是列表或者数据库游标这样可以快速遍历的对象
+    :param concurrency: 全局同时进行的请求数量上限
+    :return: 异步生成器, 每校验完一个代理IP就返回一个
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    # 连接数量由信号量控制, 这里不再限制
+    connector = aiohttp.TCPConnector(limit=0, ttl_dns_cache=300)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        pending = set()
+        try:
+            for proxy in proxies:
+                # 限制同时存在的任务数量, 避免一次性为所有代理IP创建任务
+                if len(pending) >= concurrency:
+                    done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                    for task in done:
+                        yield task.result()
+                pending.add(asyncio.ensure_future(check_one(session, semaphore, proxy)))
+            # 等待剩余的任务完成
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    yield task.result()
+        finally:
+            # 调用方提前结束遍历时, 取消还没有完成的任务
+            for task in pending:
+                task.cancel()
+
+
+def check_proxies(proxies, concurrency=ASYNC_VALIDATE_CONCURRENCY):
+    """check_many的同步版本, 在独立的事件循环中运行, 供同步代码遍历使用
+    :return: 生成器, 每校验完一个代理IP就返回一个
+    """
+    loop = asyncio.new_event_loop()
+    results = check_many(proxies, concurrency=concurrency)
+    try:
+        while True:
+            try:
+                yield loop.run_until_complete(results.__anext__())
+            except StopAsyncIteration:
+                break
+    finally:
+        loop.run_until_complete(results.aclose())
+        loop.close()
+
+
+if __name__ == '__main__':
+    for proxy in check_proxies([Proxy(ip='5.58.97.89', port='61710')]):
+        print(proxy)
@@ -0,0 +1,21 @@
+"""
+根据配置文件中的VALIDATE_ENGINE选择校验代理IP的引擎
+- gevent: 使用httpbin_validator.check_proxy逐个校验, 并发由调用方的协程池控制
+- asyncio: 使用async_validator.check_proxies在事件循环中并发校验, 需要安装aiohttp
+"""
+from core.proxy_validate.httpbin_validator import check_proxy
+from settings import VALIDATE_ENGINE
+
+
+def check_proxies(proxies):
+    """使用配置的引擎校验多个代理IP
+    :param proxies: 要校验的proxy对象的可迭代对象
+    :return: 校验后的proxy对象的生成器, 使用asyncio引擎时按照完成的先后顺序返回
+    """
+    if VALIDATE_ENGINE == 'asyncio':
+        # 只有使用asyncio引擎时才需要安装aiohttp
+        from core.proxy_validate.async_validator import check_proxies as check_proxies_async
+        yield from check_proxies_async(proxies)
+    else:
+        for proxy in proxies:
+            yield check_proxy(proxy)
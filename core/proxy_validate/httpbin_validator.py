@@ -1,11 +1,18 @@
 import requests
 import json
 import time
-from settings import TIMEOUT
+from core.proxy_validate.probe_timeout import probe_timeouts
+from settings import TIMEOUT, VALIDATE_HTTP_URL, VALIDATE_HTTPS_URL
 from utils.http import get_request_headers
 from utils.log import logger
+from utils import metrics
 from model import Proxy
 
+# 检查失败的结果: (是否可用, 匿名类型, 速度)
+FAILED_RESULT = (False, -1, -1)
+# 检查请求失败的原因: 超时、无法连接代理IP, 出现这两种情况时另一个协议的检查也不会成功
+UNREACHABLE_ERRORS = ('timeout', 'connect')
+
 def check_proxy(proxy):
     """检查代理IP是否可用"""
     # 根据要检查的proxy对象，设置requests模块的proxies参数
@@ -14,11 +21,54 @@ def check_proxy(proxy):
         "https": f'https://{proxy.ip}:{proxy.port}'
     }
 
-    # 检查http代理IP
-    is_http, http_nick_type, http_speed = _check_http_proxy(proxies)
-    # 检查https代理IP
-    is_https, https_nick_type, https_speed = _check_http_proxy(proxies, is_http=False)
+    start = time.perf_counter()
+    # 检查http代理IP, 超时时间根据这个代理IP历史上的响应时间估计
+    http_result, error = _check_http_proxy(proxies, timeout=probe_timeouts.get(proxy, TIMEOUT))
+    record_probe(proxy, http_result, error)
+    record_request('gevent', 'http', http_result, time.perf_counter() - start)
+    if error in UNREACHABLE_ERRORS:
+        # http检查时超时或者无法连接, 说明代理IP已经失效, https检查也不会成功, 不再检查
+        https_result = FAILED_RESULT
+        record_skipped('gevent', 'https')
+    else:
+        # 检查https代理IP
+        https_start = time.perf_counter()
+        https_result, error = _check_http_proxy(proxies, is_http=False, timeout=probe_timeouts.get(proxy, TIMEOUT))
+        record_probe(proxy, https_result, error)
+        record_request('gevent', 'https', https_result, time.perf_counter() - https_start)
+
+    # 根据检查结果设置proxy对象的协议类型、匿名类型和速度, 并返回检测后的proxy对象
+    proxy = set_check_result(proxy, http_result, https_result)
+    record_proxy('gevent', proxy, time.perf_counter() - start)
+    return proxy
+
+def record_request(engine, protocol, result, elapsed):
+    """统计一次检查请求的耗时, 按照协议(http, https)和结果(ok, failed)区分"""
+    metrics.observe('validate_request_seconds', elapsed, engine=engine, protocol=protocol,
+                    outcome='ok' if result[0] else 'failed')
+
+def record_skipped(engine, protocol):
+    """统计因为另一个协议的检查已经确定代理IP失效, 而没有进行(或者被取消)的检查请求"""
+    metrics.inc('validate_request_skipped_total', engine=engine, protocol=protocol)
 
+def record_probe(proxy, result, error):
+    """把一次检查请求的结果记录到代理IP的响应时间统计中, 用于估计下一次的超时时间"""
+    probe_timeouts.record(proxy, latency=result[2] if result[0] else None, timed_out=error == 'timeout')
+
+# 检测后的协议类型对应的结果名称
+CHECK_OUTCOMES = {0: 'http', 1: 'https', 2: 'both', -1: 'dead'}
+
+def record_proxy(engine, proxy, elapsed):
+    """统计检测一个代理IP的耗时, 按照检测后的协议类型区分结果"""
+    metrics.observe('check_proxy_seconds', elapsed, engine=engine, outcome=CHECK_OUTCOMES.get(proxy.protocol, 'dead'))
+
+def set_check_result(proxy, http_result, https_result):
+    """根据http和https的检查结果, 设置proxy对象的协议类型、匿名类型和速度
+    :param http_result: http的检查结果, (是否可用, 匿名类型, 速度)
+    :param https_result: https的检查结果, (是否可用, 匿名类型, 速度)
+    """
+    is_http, http_nick_type, http_speed = http_result
+    is_https, https_nick_type, https_speed = https_result
     # 如果http和https都支持，则设置协议类型为2
     if is_http and is_https:
         proxy.protocol = 2
@@ -44,21 +94,44 @@ def check_proxy(proxy):
     # 返回检测后的proxy对象
     return proxy
 
-def _check_http_proxy(proxies, is_http=True):
-    """检查http或https代理IP是否可用"""
+def get_nick_type(content):
+    """根据httpbin返回的响应内容, 判断代理IP的匿名类型"""
+    # 获取响应头
+    res_headers = content['headers']
+    # 获取httpbin检测到的来源IP
+    origin = content['origin']
+    # 获取httpbin检测到的代理连接
+    proxy_connection = res_headers.get('Proxy-Connection')
+
+    # 判断代理IP的匿名类型
+    # 如果origin中包含逗号, 则表示origin中包含两个IP, 说明httpbin检测到了代理IP的存在
+    # 那么表明代理IP为透明代理, nick_type的值为2
+    if ',' in origin:
+        return 2
+    # 否则：如果Proxy-Connection字段存在, 则表示代理IP为普通匿名代理, nick_type的值为1
+    elif proxy_connection:
+        return 1
+    # 否则：表示代理IP为高匿名代理, nick_type的值为0
+    else:
+        return 0
+
+def _check_http_proxy(proxies, is_http=True, timeout=TIMEOUT):
+    """检查http或https代理IP是否可用
+    :param timeout: 超时时间(秒), 默认值为TIMEOUT
+    :return: 返回((是否可用, 匿名类型, 速度), 失败的原因), 失败的原因为None(成功)、timeout(超时)、
+             connect(无法连接代理IP)或failed(其他原因)
+    """
     # 初始化匿名类型和速度为-1   
     nick_type = -1
     speed = -1
 
     # 如果is_http为True, 则检查代理IP是否支持http
     if is_http:
-        test_url = "http://www.httpbin.org/get"
+        test_url = VALIDATE_HTTP_URL
     # 否则检查代理IP是否支持https
     else:
-        test_url = "https://www.httpbin.org/get"
+        test_url = VALIDATE_HTTPS_URL
     
-    # 设置超时时间(从配置文件导入配置)
-    timeout = TIMEOUT
     # 获取随机请求头
     req_headers = get_request_headers()
     try:
@@ -73,35 +146,26 @@ def _check_http_proxy(proxies, is_http=True):
             # 计算结束时间和开始时间的差值，即为代理IP的速度, 单位为秒，保留两位小数
             speed = round(end - start, 2)
 
-            # 获取响应内容
-            content = json.loads(response.text)
-            # 获取响应头
-            res_headers = content['headers']
-            # 获取httpbin检测到的来源IP
-            origin = content['origin']
-            # 获取httpbin检测到的代理连接
-            proxy_connection = res_headers.get('Proxy-Connection')
-
-            # 判断代理IP的匿名类型
-            # 如果origin中包含逗号, 则表示origin中包含两个IP, 说明httpbin检测到了代理IP的存在
-            # 那么表明代理IP为透明代理, nick_type的值为2
-            if ',' in origin:
-                nick_type = 2
-            # 否则：如果Proxy-Connection字段存在, 则表示代理IP为普通匿名代理, nick_type的值为1
-            elif proxy_connection:
-                nick_type = 1
-            # 否则：表示代理IP为高匿名代理, nick_type的值为0
-            else:
-                nick_type = 0
+            # 获取响应内容, 并判断代理IP的匿名类型
+            nick_type = get_nick_type(json.loads(response.text))
             
             # 返回表示代理IP可用的布尔值True、匿名类型和速度
-            return True, nick_type, speed
+            return (True, nick_type, speed), None
         # 如果请求失败，则返回表示代理IP不可用的布尔值False、匿名类型(-1)和速度(-1)
         else:
-            return False, nick_type, speed
+            return (False, nick_type, speed), 'failed'
+    except requests.exceptions.Timeout:
+        # 连接或者读取响应超时
+        return (False, nick_type, speed), 'timeout'
+    except requests.exceptions.SSLError:
+        # 能够连接代理IP, 只是TLS握手失败
+        return (False, nick_type, speed), 'failed'
+    except requests.exceptions.ConnectionError:
+        # 无法连接代理IP(拒绝连接、连接被重置等)
+        return (False, nick_type, speed), 'connect'
     except Exception as e:
         # 如果整个检测的过程出现异常，则返回表示代理IP不可用的布尔值False、匿名类型(-1)和速度(-1)
-        return False, nick_type, speed
+        return (False, nick_type, speed), 'failed'
 
 if __name__ == '__main__':
     proxy = Proxy(ip='5.58.97.89', port='61710')
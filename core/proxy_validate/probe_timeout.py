@@ -0,0 +1,95 @@
+"""
+自适应的校验超时时间
+- 作用: 校验请求不再统一等待TIMEOUT秒, 而是根据每个代理IP历史上的响应时间估计它的超时时间,
+  平时0.4秒就能响应的代理IP, 等待1秒多还没有响应就可以判断为失败, 失效的代理IP不再占用一个协程长达TIMEOUT秒
+- 实现(和TCP估计重传超时时间的方法相同, RFC 6298):
+  1. 每个代理IP保存响应时间的平滑平均值srtt和平均偏差rttvar, 每次校验成功后更新:
+     rttvar = 3/4 * rttvar + 1/4 * |srtt - 响应时间|, srtt = 7/8 * srtt + 1/8 * 响应时间
+  2. 超时时间为 srtt + VALIDATE_TIMEOUT_RTTVAR_FACTOR * rttvar, 限制在VALIDATE_TIMEOUT_MIN和TIMEOUT之间
+  3. 本进程还没有校验过的代理IP, 以数据库中的速度(上一次校验成功的响应时间)作为srtt, 一半作为rttvar
+  4. 从来没有校验成功过的代理IP(速度为-1), 使用较短的VALIDATE_TIMEOUT_UNSEEN
+  5. 有响应时间记录的代理IP超时后, 下一次的超时时间加倍, 直到TIMEOUT, 校验成功后恢复, 避免偶尔变慢的代理IP连续被判断为失败
+- 每个校验进程(检测模块、爬虫模块)各自保存, 最多保存VALIDATE_LATENCY_MAX_ENTRIES个代理IP, 超出时删除最久没有更新的
+"""
+from collections import OrderedDict
+from settings import TIMEOUT, VALIDATE_ADAPTIVE_TIMEOUT, VALIDATE_TIMEOUT_UNSEEN, VALIDATE_TIMEOUT_MIN
+from settings import VALIDATE_TIMEOUT_RTTVAR_FACTOR, VALIDATE_LATENCY_MAX_ENTRIES
+from utils import metrics
+
+# 超时后超时时间加倍的最大次数
+MAX_BACKOFF = 5
+
+
+class ProbeTimeouts:
+    def __init__(self, enabled=VALIDATE_ADAPTIVE_TIMEOUT, unseen_timeout=VALIDATE_TIMEOUT_UNSEEN,
+                 min_timeout=VALIDATE_TIMEOUT_MIN, max_entries=VALIDATE_LATENCY_MAX_ENTRIES):
+        """初始化方法
+        :param enabled: 是否根据响应时间估计超时时间, False表示总是使用最长的超时时间
+        :param unseen_timeout: 从来没有校验成功过的代理IP的超时时间(秒)
+        :param min_timeout: 超时时间的最小值(秒)
+        :param max_entries: 最多保存的代理IP数量
+        """
+        self.enabled = enabled
+        self.unseen_timeout = unseen_timeout
+        self.min_timeout = min_timeout
+        self.max_entries = max_entries
+        # ip -> [srtt, rttvar, 连续超时的次数]
+        self._stats = OrderedDict()
+
+    def _get_stat(self, proxy):
+        """返回代理IP的统计, 本进程中没有记录时以数据库中的速度作为初始值, 没有速度时返回None"""
+        stat = self._stats.get(proxy.ip)
+        if stat is None and proxy.speed is not None and proxy.speed > 0:
+            stat = [proxy.speed, proxy.speed / 2, 0]
+        return stat
+
+    def get(self, proxy, max_timeout=TIMEOUT):
+        """返回校验这个代理IP时使用的超时时间(秒)
+        :param max_timeout: 超时时间的最大值, 默认值为TIMEOUT
+        """
+        if not self.enabled:
+            return max_timeout
+        stat = self._get_stat(proxy)
+        if stat is None:
+            return min(self.unseen_timeout, max_timeout)
+        srtt, rttvar, backoff = stat
+        timeout = (srtt + VALIDATE_TIMEOUT_RTTVAR_FACTOR * rttvar) * 2 ** backoff
+        return min(max(timeout, self.min_timeout), max_timeout)
+
+    def record(self, proxy, latency=None, timed_out=False):
+        """记录一次校验请求的结果
+        :param latency: 校验成功时的响应时间(秒), 默认值为None, 表示校验失败
+        :param timed_out: 是否因为超时而失败
+        """
+        if latency is not None:
+            stat = self._stats.get(proxy.ip) or self._get_stat(proxy)
+            if stat is None:
+                stat = [latency, latency / 2, 0]
+            else:
+                stat[1] = 0.75 * stat[1] + 0.25 * abs(stat[0] - latency)
+                stat[0] = 0.875 * stat[0] + 0.125 * latency
+                stat[2] = 0
+        elif timed_out:
+            # 没有响应时间记录的代理IP超时, 说明它很可能已经失效, 下一次仍然使用较短的超时时间
+            stat = self._stats.get(proxy.ip) or self._get_stat(proxy)
+            if stat is None:
+                return
+            stat[2] = min(stat[2] + 1, MAX_BACKOFF)
+            metrics.inc('validate_timeout_backoff_total')
+        else:
+            return
+        self._stats[proxy.ip] = stat
+        self._stats.move_to_end(proxy.ip)
+        while len(self._stats) > self.max_entries:
+            self._stats.popitem(last=False)
+
+    def clear(self):
+        """清空所有代理IP的统计"""
+        self._stats.clear()
+
+    def __len__(self):
+        return len(self._stats)
+
+
+# 校验模块共用的超时时间估计
+probe_timeouts = ProbeTimeouts()
@@ -0,0 +1,66 @@
+"""
+API的响应缓存
+- 作用: 大量爬虫节点每隔几秒轮询一次/proxies, 而代理IP只有在爬虫模块或检测模块写入后才会变化,
+  缓存序列化好的响应内容, 相同条件的请求不再重复查询和序列化
+- 实现:
+  1. 以请求条件为键, 保存紧凑格式的json字节串和它的强ETag(内容的哈希值)
+  2. 缓存记录在RESPONSE_CACHE_SECONDS秒后失效
+  3. 每条记录同时保存生成时数据源(内存索引或MongoPool)的数据版本, 本进程写入或者内存索引拉取到变化后版本增大, 记录随之失效
+  4. 记录数量超过RESPONSE_CACHE_MAX_ENTRIES时, 删除最早生成的记录
+- ETag由内容计算, 多个工作进程对相同内容生成相同的ETag, 客户端带上If-None-Match时可以得到304响应
+"""
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from settings import RESPONSE_CACHE_SECONDS, RESPONSE_CACHE_MAX_ENTRIES
+
+
+class CachedResponse:
+    def __init__(self, body, mimetype, version, expires_at):
+        self.body = body
+        self.mimetype = mimetype
+        # 强ETag, 不含引号
+        self.etag = hashlib.sha1(body).hexdigest()[:20]
+        self.version = version
+        self.expires_at = expires_at
+
+
+class ResponseCache:
+    def __init__(self, ttl=RESPONSE_CACHE_SECONDS, max_entries=RESPONSE_CACHE_MAX_ENTRIES):
+        """初始化方法
+        :param ttl: 缓存记录的有效时间(秒)
+        :param max_entries: 最多保存的记录数量
+        """
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, version):
+        """返回有效的缓存记录, 记录不存在、已经过期或者数据版本发生变化时返回None"""
+        entry = self._entries.get(key)
+        if entry is None or entry.version != version or entry.expires_at <= time.time():
+            return None
+        return entry
+
+    def put(self, key, version, body, mimetype='application/json'):
+        """保存响应内容, 返回新的缓存记录
+        :param version: 生成响应内容之前读取的数据版本
+        :param body: 响应内容(bytes)
+        """
+        entry = CachedResponse(body, mimetype, version, time.time() + self.ttl)
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = entry
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return entry
+
+    def clear(self):
+        """清空所有缓存记录"""
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
@@ -0,0 +1,152 @@
+"""
+按权重随机选择代理IP
+- 作用: /random接口不再只在分数最高的MAX_PROXIES_RANGE个代理IP中等概率选择, 而是在所有满足条件的代理IP中按照权重选择,
+  分数越高、速度越快的代理IP被选中的概率越大, 其他代理IP也能分到一部分请求
+- 权重策略(WEIGHT_POLICIES), 可以通过/random接口的policy参数指定:
+    - score: 权重和分数成正比
+    - speed: 权重和速度(响应时间)成反比
+    - balanced: 权重和分数的平方成正比, 和速度成反比
+  另外还有top策略, 即原来的在排名靠前的代理IP中等概率选择, 由调用方单独处理
+- 实现: 使用树状数组(Fenwick树)保存权重的前缀和
+    - 修改一个代理IP的权重、添加或删除一个代理IP的时间复杂度为O(log n)
+    - 按照权重随机选择一个代理IP的时间复杂度为O(log n)
+    - 删除的代理IP的位置权重置为0, 留给之后添加的代理IP复用
+"""
+import random
+from settings import MAX_SCORE
+
+# 计算权重时速度的下限(秒), 避免速度很小时权重过大
+MIN_WEIGHT_SPEED = 0.1
+
+
+def _speed(proxy):
+    return max(proxy.speed, MIN_WEIGHT_SPEED)
+
+
+WEIGHT_POLICIES = {
+    'score': lambda proxy: max(proxy.score, 0) / MAX_SCORE,
+    'speed': lambda proxy: 1 / _speed(proxy),
+    'balanced': lambda proxy: (max(proxy.score, 0) / MAX_SCORE) ** 2 / _speed(proxy),
+}
+
+
+class FenwickTree:
+    """保存权重前缀和的树状数组, 下标从0开始"""
+    def __init__(self, weights=()):
+        self._weights = list(weights)
+        size = len(self._weights)
+        # _tree[i]保存下标在(i - lowbit(i), i]范围内的权重之和, _tree[0]不使用
+        self._tree = [0.0] + self._weights
+        # 线性时间建树
+        for i in range(1, size + 1):
+            parent = i + (i & -i)
+            if parent <= size:
+                self._tree[parent] += self._tree[i]
+
+    def __len__(self):
+        return len(self._weights)
+
+    def get(self, index):
+        return self._weights[index]
+
+    def prefix_sum(self, count):
+        """前count个权重之和"""
+        total = 0.0
+        while count > 0:
+            total += self._tree[count]
+            count -= count & -count
+        return total
+
+    def total(self):
+        return self.prefix_sum(len(self._weights))
+
+    def update(self, index, weight):
+        """修改下标为index的权重"""
+        delta = weight - self._weights[index]
+        self._weights[index] = weight
+        i = index + 1
+        size = len(self._weights)
+        while i <= size:
+            self._tree[i] += delta
+            i += i & -i
+
+    def append(self, weight):
+        """在末尾添加一个权重, 返回它的下标"""
+        self._weights.append(weight)
+        i = len(self._weights)
+        # 新节点保存的是(i - lowbit(i), i]范围内的权重之和
+        self._tree.append(weight + self.prefix_sum(i - 1) - self.prefix_sum(i - (i & -i)))
+        return i - 1
+
+    def find(self, value):
+        """返回前缀和第一次大于value的下标, 即按照权重随机选择时value落在的位置"""
+        size = len(self._weights)
+        position = 0
+        step = 1 << size.bit_length()
+        while step:
+            next_position = position + step
+            if next_position <= size and self._tree[next_position] <= value:
+                position = next_position
+                value -= self._tree[next_position]
+            step >>= 1
+        # 浮点数误差可能导致value不小于总和, 此时返回最后一个下标
+        return min(position, size - 1)
+
+
+class WeightedSelector:
+    """按照权重随机选择代理IP, 支持增量更新"""
+    def __init__(self, weight, proxies=()):
+        """初始化方法
+        :param weight: 根据proxy对象计算权重的函数
+        :param proxies: 初始的proxy对象
+        """
+        self.weight = weight
+        self._slots = list(proxies)
+        # ip -> 在树状数组中的下标
+        self._positions = {proxy.ip: index for index, proxy in enumerate(self._slots)}
+        # 已经删除的代理IP空出来的下标
+        self._free = []
+        self._tree = FenwickTree(self.weight(proxy) for proxy in self._slots)
+
+    def __len__(self):
+        return len(self._positions)
+
+    def update(self, proxy):
+        """添加一个代理IP, 或者更新一个已经存在的代理IP的权重"""
+        index = self._positions.get(proxy.ip)
+        if index is None:
+            if self._free:
+                index = self._free.pop()
+            else:
+                index = self._tree.append(0.0)
+                self._slots.append(None)
+            self._positions[proxy.ip] = index
+        self._slots[index] = proxy
+        self._tree.update(index, self.weight(proxy))
+
+    def remove(self, ip):
+        """删除一个代理IP"""
+        index = self._positions.pop(ip, None)
+        if index is None:
+            return
+        self._slots[index] = None
+        self._tree.update(index, 0.0)
+        self._free.append(index)
+
+    def total(self):
+        """所有代理IP的权重之和"""
+        return self._tree.total()
+
+    def choice(self, value=None):
+        """按照权重随机选择一个代理IP, 没有权重大于0的代理IP时返回None
+        :param value: [0, 1)之间的随机数, 默认值为None, 表示使用random.random()生成
+        """
+        total = self.total()
+        if total <= 0:
+            return None
+        value = random.random() if value is None else value
+        index = self._tree.find(value * total)
+        # 浮点数误差可能落到权重为0的位置上
+        if self._tree.get(index) <= 0:
+            return None
+        return self._slots[index]
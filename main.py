@@ -1,11 +1,14 @@
 """
 启动整个代理池项目的入口模块
 - 使用多进程的方式启动爬虫模块、检测模块、API服务模块三个进程
+- 开启PROXY_SNAPSHOT_ENABLED时, 还会启动代理池快照的发布进程, 供API的工作进程共享
 """
 from multiprocessing import Process
 from core.proxy_spider.run_spiders import RunSpider
 from core.proxy_test import ProxyTester
 from core.proxy_api import ProxyApi
+from core.pool_snapshot import SnapshotPublisher
+from settings import PROXY_SNAPSHOT_ENABLED
 
 def run():
     """作为启动整个代理池项目的入口的函数"""
@@ -15,6 +18,9 @@ def run():
     process_list.append(Process(target=RunSpider.start))
     # 创建检测进程
     process_list.append(Process(target=ProxyTester.start))
+    # 创建代理池快照的发布进程
+    if PROXY_SNAPSHOT_ENABLED:
+        process_list.append(Process(target=SnapshotPublisher.start))
     # 创建API服务进程
     process_list.append(Process(target=ProxyApi.start))
 
@@ -1,7 +1,53 @@
-"""定义代理对象的数据模型"""
+"""定义代理对象的数据模型
+- Proxy使用__slots__保存字段, 不再为每个对象创建__dict__
+- IPv4地址压缩为一个整数, 端口保存为整数, 读取ip和port属性时仍然返回字符串; 无法压缩的值(如IPv6地址)原样保存
+- 提供数据库文档和紧凑json的编解码, 以及从数据库游标批量创建Proxy对象的方法, 调用方不再直接读写对象的字段字典
+"""
+import json
+import socket
+import sys
 from settings import MAX_SCORE
 
+# Proxy对象的字段, 数据库文档中除此之外的字段(如_id、updated_at)只在数据库中使用
+PROXY_FIELDS = ('ip', 'port', 'protocol', 'nick_type', 'speed', 'area', 'score', 'disable_domains')
+
+# 没有不可用域名时共享的空元组, 避免每个对象各自创建一个空列表
+_NO_DOMAINS = ()
+
+
+def _pack_ip(ip):
+    """IPv4地址压缩为整数, 其他值原样返回"""
+    try:
+        return int.from_bytes(socket.inet_pton(socket.AF_INET, ip), 'big')
+    except (OSError, TypeError):
+        return ip
+
+
+_inet_ntoa = socket.inet_ntoa
+_INF = float('inf')
+
+
+def _unpack_ip(value):
+    return _inet_ntoa(value.to_bytes(4, 'big')) if type(value) is int else value
+
+
+def _pack_port(port):
+    """端口转换为整数, 不是合法端口时原样返回"""
+    try:
+        value = int(port)
+    except (TypeError, ValueError):
+        return port
+    return value if 0 <= value <= 65535 and str(value) == str(port).strip() else port
+
+
+def _intern(area):
+    """地区名称的取值很少, 驻留后所有对象共享同一个字符串"""
+    return sys.intern(area) if type(area) is str else area
+
+
 class Proxy:
+    __slots__ = ('_ip', '_port', 'protocol', 'nick_type', 'speed', '_area', 'score', '_disable_domains')
+
     def __init__(self, ip, port, protocol=-1, nick_type=-1, speed=-1, area=None, score=MAX_SCORE, disable_domains=None):
         """初始化代理对象。
         :param ip: 代理的IP地址。
@@ -13,14 +59,143 @@ class Proxy:
         :param score: 代理IP的评分,用于衡量代理的可用性。默认分值可以通过配置文件进行配置。在进行代理可用性检查时，每遇到一次请求失败就减1分，减到0的时候从池中删除。如果检查代理可用，就恢复默认分值。默认为MAX_SCORE。
         :param disable_domains: 不可用域名列表。有些代理IP在某些域名下不可用,但是在其他域名下可用。默认为空列表。
         """
-        self.ip = ip
-        self.port = port
+        self._ip = _pack_ip(ip)
+        self._port = _pack_port(port)
         self.protocol = protocol
         self.nick_type = nick_type
         self.speed = speed
-        self.area = area
+        self._area = _intern(area)
         self.score = score
-        self.disable_domains = disable_domains or []
-    
+        self._disable_domains = tuple(disable_domains) if disable_domains else _NO_DOMAINS
+
+    @property
+    def ip(self):
+        return _unpack_ip(self._ip)
+
+    @ip.setter
+    def ip(self, value):
+        self._ip = _pack_ip(value)
+
+    @property
+    def port(self):
+        return str(self._port) if type(self._port) is int else self._port
+
+    @port.setter
+    def port(self, value):
+        self._port = _pack_port(value)
+
+    @property
+    def area(self):
+        return self._area
+
+    @area.setter
+    def area(self, value):
+        self._area = _intern(value)
+
+    @property
+    def disable_domains(self):
+        return list(self._disable_domains)
+
+    @disable_domains.setter
+    def disable_domains(self, value):
+        self._disable_domains = tuple(value) if value else _NO_DOMAINS
+
+    def to_dict(self):
+        """转换为字段字典, 每次返回新的字典, 调用方可以任意修改"""
+        document = self.to_document()
+        document['disable_domains'] = list(self._disable_domains)
+        return document
+
+    def to_document(self):
+        """转换为数据库文档, ip和port以字符串保存, 和旧数据保持一致
+        不可用域名保存在单独的集合中, 因此文档中不再写入disable_domains
+        """
+        ip, port = self._ip, self._port
+        return {
+            'ip': _inet_ntoa(ip.to_bytes(4, 'big')) if type(ip) is int else ip,
+            'port': str(port) if type(port) is int else port,
+            'protocol': self.protocol, 'nick_type': self.nick_type, 'speed': self.speed, 'area': self._area,
+            'score': self.score,
+        }
+
+    @classmethod
+    def from_document(cls, document):
+        """由数据库文档创建Proxy对象, 忽略_id、updated_at等只在数据库中使用的字段"""
+        return next(cls.from_documents((document,)))
+
+    @classmethod
+    def from_documents(cls, documents):
+        """由数据库游标(或文档列表)批量创建Proxy对象的生成器, 和from_document的结果一致
+        不经过__init__的参数处理, 并把用到的函数绑定为局部变量, 减少每个文档的属性查找
+        """
+        new, pack_ip, pack_port, intern = cls.__new__, _pack_ip, _pack_port, _intern
+        for document in documents:
+            get = document.get
+            proxy = new(cls)
+            proxy._ip = pack_ip(document['ip'])
+            proxy._port = pack_port(get('port'))
+            proxy.protocol = get('protocol', -1)
+            proxy.nick_type = get('nick_type', -1)
+            proxy.speed = get('speed', -1)
+            proxy._area = intern(get('area'))
+            proxy.score = get('score', MAX_SCORE)
+            domains = get('disable_domains')
+            proxy._disable_domains = tuple(domains) if domains else _NO_DOMAINS
+            yield proxy
+
+    def to_packed(self):
+        """返回压缩后的字段(ip, port, protocol, nick_type, speed, area, score), 供代理池快照(core/pool_snapshot.py)使用
+        ip为IPv4地址时是整数, 否则是字符串; port为合法端口时是整数, 否则是原来的值
+        """
+        return self._ip, self._port, self.protocol, self.nick_type, self.speed, self._area, self.score
+
+    @classmethod
+    def from_packed(cls, ip, port, protocol, nick_type, speed, area, score):
+        """由to_packed返回的字段创建Proxy对象, 不再重复压缩ip和port"""
+        proxy = cls.__new__(cls)
+        proxy._ip = ip
+        proxy._port = port
+        proxy.protocol = protocol
+        proxy.nick_type = nick_type
+        proxy.speed = speed
+        proxy._area = area
+        proxy.score = score
+        proxy._disable_domains = _NO_DOMAINS
+        return proxy
+
+    def copy(self):
+        """复制一个Proxy对象"""
+        proxy = Proxy.__new__(Proxy)
+        for name in Proxy.__slots__:
+            setattr(proxy, name, getattr(self, name))
+        return proxy
+
     def __str__(self):
-        return str(self.__dict__)
+        return str(self.to_dict())
+
+
+_dumps = json.JSONEncoder(ensure_ascii=False, separators=(',', ':')).encode
+_encode_string = json.encoder.encode_basestring
+
+
+def _encode_proxy(proxy):
+    """把一个代理IP编码为紧凑格式的json字符串, 结果和_dumps(proxy.to_dict())一致
+    字段都是常见类型(压缩后的ip和port、整数、有限的浮点数)时直接拼接, 否则交给json模块编码
+    """
+    ip, port, speed, area = proxy._ip, proxy._port, proxy.speed, proxy._area
+    if (type(ip) is not int or type(port) is not int or proxy._disable_domains
+            or type(proxy.protocol) is not int or type(proxy.nick_type) is not int or type(proxy.score) is not int
+            or not (type(speed) is int or type(speed) is float and -_INF < speed < _INF)
+            or not (area is None or type(area) is str)):
+        return _dumps(proxy.to_dict())
+    area = 'null' if area is None else _encode_string(area)
+    return (f'{{"ip":"{_inet_ntoa(ip.to_bytes(4, "big"))}","port":"{port}","protocol":{proxy.protocol},'
+            f'"nick_type":{proxy.nick_type},"speed":{speed!r},"area":{area},"score":{proxy.score},'
+            f'"disable_domains":[]}}')
+
+
+def dumps_proxies(proxies):
+    """把代理IP列表编码为紧凑格式的json字节串, 结果和json.dumps([proxy.to_dict() ...], ensure_ascii=False,
+    separators=(',', ':'))一致
+    """
+    return ('[' + ','.join(map(_encode_proxy, proxies)) + ']').encode()
@@ -12,10 +12,45 @@ LOG_FILENAME = 'log.log'    # 默认日志文件名称
 # 请求的超时时间，单位是秒
 TIMEOUT = 10
 
+# 校验代理IP时请求的地址, 返回请求的来源IP(origin)和请求头(headers)
+VALIDATE_HTTP_URL = 'http://www.httpbin.org/get'
+VALIDATE_HTTPS_URL = 'https://www.httpbin.org/get'
+# 校验代理IP使用的引擎: gevent(逐个使用requests校验) 或 asyncio(使用aiohttp并发校验, 需要安装aiohttp)
+VALIDATE_ENGINE = 'gevent'
+# 使用asyncio引擎校验时, 全局同时进行的请求数量上限
+ASYNC_VALIDATE_CONCURRENCY = 500
+# 校验代理IP时, 是否根据每个代理IP历史上的响应时间估计超时时间(最长为TIMEOUT), 关闭后总是等待TIMEOUT秒
+VALIDATE_ADAPTIVE_TIMEOUT = True
+# 从来没有校验成功过的代理IP的超时时间(秒), 新抓取的和已经失效的代理IP都使用这个较短的超时时间
+VALIDATE_TIMEOUT_UNSEEN = 4
+# 自适应超时时间的最小值(秒)
+VALIDATE_TIMEOUT_MIN = 1
+# 自适应超时时间 = 平均响应时间 + VALIDATE_TIMEOUT_RTTVAR_FACTOR * 响应时间的平均偏差
+VALIDATE_TIMEOUT_RTTVAR_FACTOR = 4
+# 每个校验进程最多保存多少个代理IP的响应时间统计
+VALIDATE_LATENCY_MAX_ENTRIES = 100000
+
+# 存储后端: mongo(MongoDB) 或 sqlite(本地的SQLite数据库文件, 不需要运行外部服务)
+STORAGE_BACKEND = 'mongo'
+# SQLite数据库文件的路径
+SQLITE_PATH = 'proxies_pool.db'
+# SQLite数据库被其他进程锁定时, 最多等待的时间(秒)
+SQLITE_BUSY_TIMEOUT_SECONDS = 5
+
 # MongoDB
 MONGO_URL = 'mongodb://localhost:27017'
 DATABASE = 'proxies_pool'
 COLLECTION = 'proxies'
+# 按域名保存被禁用的代理IP的集合, 每个文档表示一个代理IP在一个域名下不可用
+DISABLED_DOMAINS_COLLECTION = 'disabled_domains'
+# 代理IP在某个域名下被禁用后, 经过多少小时自动解除禁用, 设置为0时永久禁用
+DISABLE_DOMAIN_EXPIRE_HOURS = 24
+# 保存爬虫反馈的计数(成功次数、反馈次数、延迟之和)的集合, 每个文档表示一个代理IP在一个域名下(或者全部域名)的计数
+FEEDBACK_COLLECTION = 'proxy_feedback'
+# 保存被删除的代理IP(删除记录)的集合, API的内存索引增量拉取时据此清除已经删除的代理IP
+DELETED_PROXIES_COLLECTION = 'deleted_proxies'
+# 删除记录保存的时间(秒), 需要大于PROXY_INDEX_FULL_REFRESH_SECONDS, 之后的全量重建不再需要删除记录
+DELETED_PROXY_EXPIRE_SECONDS = 3600
 
 # Spiders
 PROXIES_SPIDERS = [
@@ -27,15 +62,147 @@ PROXIES_SPIDERS = [
 # 运行爬虫模块的间隔时间(小时)
 RUN_SPIDERS_INTERVAL_HOURS = 2
 
-# 运行检测模块的间隔时间(小时)
-RUN_TEST_INTERVAL_HOURS = 2
+# 检测模块按照每个代理IP各自的下次检测时间(next_check)持续检测, 检测间隔的计算方法:
+# CHECK_INTERVAL_SECONDS / (1 + 连续失败次数) / (1 + API提供次数 / CHECK_SERVED_HALF), 并限制在最小值和最大值之间
+# 满分且没有被API提供过的代理IP的检测间隔(秒)
+CHECK_INTERVAL_SECONDS = 1800
+# 检测间隔的最小值和最大值(秒)
+CHECK_INTERVAL_MIN_SECONDS = 60
+CHECK_INTERVAL_MAX_SECONDS = 7200
+# 自上次检测以来, API每提供这么多次, 检测间隔缩短一半
+CHECK_SERVED_HALF = 100
+# 每次从数据库中取出的到期代理IP的数量
+CHECK_BATCH_SIZE = 200
+# 没有到期的代理IP时, 最多等待的时间(秒)
+CHECK_IDLE_SECONDS = 10
 
 # 检测模块检测proxy的并发协程数量
 TEST_PROXY_ASYNC_COUNT = 5
+# 检测模块中等待检测的proxy队列的容量, 队列满时暂停从数据库读取, 内存占用不随代理池的大小增长
+TEST_QUEUE_SIZE = 100
+# 检测模块全量检测时, 数据库游标每批读取的代理IP数量
+TEST_CURSOR_BATCH_SIZE = 500
 
 # 随机返回一个代理IP时，随机的范围
 # 越小可用性越高（代理IP范围是根据分数降序和速度升序排序的），越大随机性越高
 MAX_PROXIES_RANGE = 50
 
+# /random接口默认的选择策略, 可以通过policy参数指定
+# top: 在排名靠前的MAX_PROXIES_RANGE个代理IP中等概率选择
+# score/speed/balanced: 在所有满足条件的代理IP中按照权重选择, 权重分别和分数成正比、和速度成反比、综合两者
+RANDOM_PROXY_POLICY = 'balanced'
+# 按照权重选择时, 选中禁用了指定域名的代理IP后最多重新选择的次数
+RANDOM_PROXY_MAX_TRIES = 10
+
 # Web API 模块端口
 WEB_API_PORT = 16888
+# Web API 的服务模式: gevent(生产环境, 多进程的gevent WSGIServer) 或 flask(Flask自带的开发服务器)
+API_SERVER = 'gevent'
+# gevent服务模式的工作进程数量, 每个进程有各自的内存索引
+API_WORKERS = 4
+# 长连接空闲超过这个时间(秒)后关闭, 0表示每个连接只处理一个请求
+API_KEEPALIVE_SECONDS = 5
+# 监听socket等待accept的连接队列长度
+API_BACKLOG = 2048
+
+# Web API 是否使用内存索引提供代理IP, 不使用时每次请求都查询MongoDB
+PROXY_INDEX_ENABLED = True
+# Web API 的工作进程是否共享一份代理池快照: 由快照发布进程写入文件, 工作进程以mmap只读映射, 不再各自维护内存索引
+PROXY_SNAPSHOT_ENABLED = False
+# 代理池快照文件的路径
+PROXY_SNAPSHOT_PATH = 'proxies.snapshot'
+# 工作进程检查快照文件是否被替换的间隔时间(秒)
+PROXY_SNAPSHOT_POLL_SECONDS = 1
+# 内存索引增量拉取变化的代理IP的间隔时间(秒), 快照发布进程使用相同的间隔
+PROXY_INDEX_REFRESH_SECONDS = 5
+# 内存索引全量重建的间隔时间(秒), 删除的代理IP通过删除记录增量清除, 全量重建用于兜底(例如直接在数据库中删除的代理IP)
+PROXY_INDEX_FULL_REFRESH_SECONDS = 300
+# 增量拉取时向前多取的重叠时间(秒), 避免多个写入进程之间的时钟差异导致漏掉更新
+PROXY_INDEX_OVERLAP_SECONDS = 2
+# Web API /proxies接口的响应缓存的有效时间(秒), 本进程写入或内存索引拉取到变化时提前失效
+RESPONSE_CACHE_SECONDS = 5
+# 响应缓存最多保存的记录数量(不同的查询条件)
+RESPONSE_CACHE_MAX_ENTRIES = 1024
+# POST /disable_domain 一次最多提交的(ip, 域名)数量
+DISABLE_DOMAIN_BATCH_MAX = 10000
+# 租约接口: 默认的租约有效时间(秒), 以及可以指定的最长有效时间(秒)
+LEASE_TTL_SECONDS = 60
+LEASE_MAX_TTL_SECONDS = 600
+# 租约接口: 每个(域名, 协议类型, 匿名程度)在排名靠前的多少个代理IP中轮换
+LEASE_CANDIDATES = 200
+# 租约接口: 轮换的候选代理IP最多使用多少秒后重新获取, 数据源发生变化时立即重新获取
+LEASE_ROTATION_REFRESH_SECONDS = 5
+# 租约表的槽位数量(保存在共享内存中, 每个槽位24字节), 需要大于同时有效的租约数量
+LEASE_TABLE_SLOTS = 65536
+# 租约表查找一个(域名, ip)时最多探测的槽位数量
+LEASE_MAX_PROBES = 64
+# 反馈接口: 是否根据爬虫反馈的成功率和延迟调整/proxies、/random和租约接口返回的代理IP, 关闭后POST /feedback返回404
+FEEDBACK_ENABLED = True
+# POST /feedback 一次最多提交的反馈数量
+FEEDBACK_BATCH_MAX = 10000
+# 成功率和延迟的指数加权移动平均(EWMA)的平滑系数, 越大越看重最近的反馈, 只用于两次同步之间本进程收到的反馈
+FEEDBACK_EWMA_ALPHA = 0.3
+# 一个代理IP(或者代理IP在一个域名下)至少收到多少次反馈后, 才根据反馈调整排序和排除
+FEEDBACK_MIN_SAMPLES = 3
+# 成功率低于这个值的代理IP不再提供(指定域名时只在这个域名下不再提供)
+FEEDBACK_MIN_SUCCESS_RATE = 0.5
+# 收到新的反馈后, 最多经过多少秒重新计算排序, 同时让响应缓存失效
+FEEDBACK_RANK_SECONDS = 1
+# 根据反馈重新排序时, 在排名靠前的count个代理IP之外最多再多取多少个代理IP作为候选
+FEEDBACK_RANK_MAX_EXTRA = 1000
+# 反馈的统计超过多少秒没有更新就失效, 被排除的代理IP之后重新参与排序
+FEEDBACK_EXPIRE_SECONDS = 1800
+# 把反馈的统计写入数据库的间隔时间(秒), API启动时从数据库加载还没有失效的统计
+FEEDBACK_FLUSH_SECONDS = 10
+# Web API 把代理IP被提供的次数写入数据库的间隔时间(秒), 检测模块据此缩短常用代理IP的检测间隔
+SERVED_FLUSH_SECONDS = 10
+
+# 批量写入数据库时, 缓冲区中的操作达到这个数量就立即写入
+BULK_WRITE_BATCH_SIZE = 500
+# 批量写入数据库时, 缓冲区中的操作最多等待的时间(秒)
+BULK_WRITE_FLUSH_SECONDS = 5
+
+# 爬虫模块: 校验不通过的代理IP在这段时间(秒)内再次被抓取到时, 不再重复校验
+SPIDER_REJECTED_TTL_SECONDS = 6 * 3600
+
+# 爬虫模块: 抓取页面时对同一个网站的默认限制, 具体爬虫可以通过类属性覆盖
+# 同一个网站同时进行的请求数量
+SPIDER_HOST_CONCURRENCY = 2
+# 同一个网站每秒最多发起的请求数量
+SPIDER_HOST_RATE = 1.0
+# 抓取页面失败时的重试次数
+SPIDER_RETRIES = 0
+# 按网站(host, 包括端口)配置的限制: host -> (同时进行的请求数量, 每秒最多发起的请求数量), 优先于爬虫的类属性,
+# 多个爬虫抓取同一个网站时在这里统一配置, 例如 {'www.kuaidaili.com': (4, 2.0)}
+SPIDER_HOST_LIMITS = {}
+
+# 爬虫模块: 抓取、校验、存储三个流水线阶段各自的协程数量
+# 同时抓取的爬虫数量
+SPIDER_SCRAPE_WORKERS = 4
+# 同时校验的代理IP数量(使用asyncio引擎时由ASYNC_VALIDATE_CONCURRENCY控制)
+SPIDER_VALIDATE_WORKERS = 50
+# 把校验结果放入批量写入缓冲区的协程数量
+SPIDER_STORE_WORKERS = 1
+# 连接流水线阶段的队列的容量, 队列满时上一个阶段暂停(背压)
+SPIDER_VALIDATE_QUEUE_SIZE = 1000
+SPIDER_STORE_QUEUE_SIZE = 1000
+# 记录流水线队列深度的间隔时间(秒)
+SPIDER_PIPELINE_LOG_SECONDS = 10
+
+# 爬虫模块: 是否使用页面缓存, 页面和上次抓取时相比没有变化时跳过解析和校验
+SPIDER_PAGE_CACHE_ENABLED = True
+# 保存页面缓存记录(ETag、Last-Modified、内容哈希值)的文件
+SPIDER_PAGE_CACHE_FILE = 'page_cache.json'
+# 页面缓存记录的有效时间(秒), 失效后页面会被重新解析一次
+SPIDER_PAGE_CACHE_SECONDS = 24 * 3600
+
+# 指标统计: 是否开启
+METRICS_ENABLED = True
+# 每个进程把指标写入这个目录下的文件, 由API的/metrics接口汇总
+METRICS_DIR = 'metrics'
+# 每个进程写入指标文件的间隔时间(秒)
+METRICS_DUMP_SECONDS = 10
+# 是否开启采样分析器, 开启后可以通过API的/metrics/profile接口获取每个进程的调用栈采样结果
+METRICS_PROFILER_ENABLED = False
+# 采样分析器的采样间隔(秒)
+METRICS_PROFILER_INTERVAL = 0.01
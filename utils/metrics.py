@@ -0,0 +1,340 @@
+"""
+提供指标统计功能
+- 作用: 统计爬虫、检测、API三个进程中热点路径的次数和耗时, 由API的/metrics接口以文本格式(Prometheus exposition format)输出
+- 指标类型:
+    - counter: 只增不减的计数, 使用inc()
+    - gauge: 当前值, 例如队列深度, 使用set_gauge()
+    - histogram: 耗时分布, 使用observe()、timer()上下文管理器或timed()装饰器
+- 每个指标可以带标签, 例如 metrics.inc('spider_pages_total', spider='KuaidailiSpider', result='ok')
+- 多进程汇总:
+    1. 每个进程调用start_reporter(角色)后, 后台线程每隔METRICS_DUMP_SECONDS秒把本进程的指标写入METRICS_DIR/角色-pid.json
+    2. /metrics接口读取目录中所有没有过期的文件, 把同一个角色的多个进程(如多个API工作进程)的指标相加, 并加上process标签
+    3. 进程已经不存在, 或者超过3个写入周期没有更新的文件, 视为进程已经退出, 读取时删除
+- 采样分析器: METRICS_PROFILER_ENABLED为True时, 每个进程在一个真实的系统线程中每隔METRICS_PROFILER_INTERVAL秒
+  采样一次主线程(gevent的所有协程都运行在主线程中)的调用栈, 统计结果和指标一起写入文件, 由/metrics/profile接口
+  以折叠栈格式(每行"函数;函数;函数 次数", 可以直接生成火焰图)输出
+"""
+import functools
+import glob
+import inspect
+import json
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from settings import METRICS_ENABLED, METRICS_DIR, METRICS_DUMP_SECONDS
+from settings import METRICS_PROFILER_ENABLED, METRICS_PROFILER_INTERVAL
+from utils.log import logger
+
+# 所有指标名称的前缀
+PREFIX = 'proxypool_'
+# histogram的桶上限(秒)
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+# 采样分析器最多保留的不同调用栈数量, 超过后只累加已有的调用栈
+PROFILE_MAX_STACKS = 5000
+
+
+def _labels_key(labels):
+    """标签字典转换为可以作为字典键的有序元组"""
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+class Registry:
+    """一个进程内的所有指标"""
+    def __init__(self):
+        self._counters = Counter()
+        self._gauges = {}
+        # (名称, 标签) -> [每个桶的数量(最后一个是+Inf), 总和, 次数]
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def inc(self, name, value=1, **labels):
+        with self._lock:
+            self._counters[(name, _labels_key(labels))] += value
+
+    def set_gauge(self, name, value, **labels):
+        with self._lock:
+            self._gauges[(name, _labels_key(labels))] = value
+
+    def observe(self, name, seconds, **labels):
+        key = (name, _labels_key(labels))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [[0] * (len(BUCKETS) + 1), 0.0, 0]
+            index = 0
+            while index < len(BUCKETS) and seconds > BUCKETS[index]:
+                index += 1
+            histogram[0][index] += 1
+            histogram[1] += seconds
+            histogram[2] += 1
+
+    def snapshot(self):
+        """返回可以序列化为json的指标快照"""
+        with self._lock:
+            return {
+                'counters': [[name, labels, value] for (name, labels), value in self._counters.items()],
+                'gauges': [[name, labels, value] for (name, labels), value in self._gauges.items()],
+                'histograms': [[name, labels, list(counts), total, count]
+                               for (name, labels), (counts, total, count) in self._histograms.items()],
+            }
+
+
+def _original(module, name):
+    """返回gevent打补丁之前的函数, 没有安装gevent时返回当前的函数"""
+    try:
+        from gevent import monkey
+        return monkey.get_original(module, name)
+    except ImportError:
+        return getattr(__import__(module), name)
+
+
+class SamplingProfiler:
+    """在真实的系统线程中定期采样主线程的调用栈"""
+    def __init__(self, interval=METRICS_PROFILER_INTERVAL):
+        self.interval = interval
+        self.stacks = Counter()
+        # 采样线程是真实的系统线程, 不能使用gevent的锁
+        self._lock = _original('_thread', 'allocate_lock')()
+        # gevent打补丁之后threading.get_ident返回的是协程的id, 需要使用原始的函数获取主线程的id
+        self._main_id = _original('_thread', 'get_ident')()
+
+    def start(self):
+        # gevent打补丁之后threading创建的是协程, 协程只有在主线程让出时才会运行, 无法采样, 因此使用原始的线程和sleep
+        _original('_thread', 'start_new_thread')(self._sample_forever, (_original('time', 'sleep'),))
+
+    def _sample_forever(self, sleep):
+        while True:
+            sleep(self.interval)
+            frame = sys._current_frames().get(self._main_id)
+            if frame is None:
+                continue
+            names = []
+            while frame is not None:
+                code = frame.f_code
+                names.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})')
+                frame = frame.f_back
+            stack = ';'.join(reversed(names))
+            with self._lock:
+                if stack in self.stacks or len(self.stacks) < PROFILE_MAX_STACKS:
+                    self.stacks[stack] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self.stacks)
+
+
+registry = Registry()
+profiler = SamplingProfiler() if METRICS_PROFILER_ENABLED else None
+# 本进程的角色(spider、tester、api), 调用start_reporter后设置
+_role = None
+
+
+def inc(name, value=1, **labels):
+    """计数增加value"""
+    if METRICS_ENABLED:
+        registry.inc(name, value, **labels)
+
+
+def set_gauge(name, value, **labels):
+    """设置当前值"""
+    if METRICS_ENABLED:
+        registry.set_gauge(name, value, **labels)
+
+
+def observe(name, seconds, **labels):
+    """记录一次耗时"""
+    if METRICS_ENABLED:
+        registry.observe(name, seconds, **labels)
+
+
+@contextmanager
+def timer(name, **labels):
+    """记录with语句块的耗时, 语句块抛出异常时也会记录"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start, **labels)
+
+
+def iter_timed(iterable, name, count_name=None, **labels):
+    """遍历iterable并原样返回每个元素, 只统计取下一个元素的耗时之和, 不包括调用方处理每个元素的时间
+    :param count_name: 不为None时, 同时用这个计数指标统计元素的数量
+    """
+    iterator = iter(iterable)
+    elapsed = 0.0
+    count = 0
+    try:
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                elapsed += time.perf_counter() - start
+            count += 1
+            yield item
+    finally:
+        close = getattr(iterator, 'close', None)
+        if close is not None:
+            close()
+        observe(name, elapsed, **labels)
+        if count_name is not None:
+            inc(count_name, count, **labels)
+
+
+def timed(name, **labels):
+    """记录函数耗时的装饰器, 生成器函数使用iter_timed统计生成器自身执行的时间"""
+    def decorator(func):
+        if inspect.isgeneratorfunction(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                return iter_timed(func(*args, **kwargs), name, **labels)
+        else:
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with timer(name, **labels):
+                    return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def _filename(role, pid):
+    return os.path.join(METRICS_DIR, f'{role}-{pid}.json')
+
+
+def dump():
+    """把本进程的指标(和采样分析器的结果)写入文件, 先写临时文件再替换, 读取方不会读到写了一半的文件"""
+    if _role is None:
+        return
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    data = {'role': _role, 'pid': os.getpid(), 'time': time.time(), **registry.snapshot()}
+    if profiler is not None:
+        data['profile'] = profiler.snapshot()
+    filename = _filename(_role, os.getpid())
+    with open(filename + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.replace(filename + '.tmp', filename)
+
+
+def _dump_forever():
+    while True:
+        time.sleep(METRICS_DUMP_SECONDS)
+        try:
+            dump()
+        except Exception as e:
+            logger.exception(e)
+
+
+def start_reporter(role):
+    """设置本进程的角色, 启动定期写入指标文件的后台线程, 开启采样分析器时同时启动采样线程
+    fork出的子进程(如API工作进程)需要在fork之后调用
+    """
+    global _role
+    if not METRICS_ENABLED:
+        return
+    _role = role
+    dump()
+    threading.Thread(target=_dump_forever, daemon=True).start()
+    if profiler is not None:
+        profiler.start()
+
+
+def _is_alive(pid):
+    """判断进程是否存在, 所有进程都运行在同一台机器上"""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except (PermissionError, TypeError):
+        return True
+    return True
+
+
+def collect():
+    """读取所有进程的指标文件, 本进程使用内存中的最新数据, 删除已经过期的文件
+    :return: 返回每个进程的指标数据列表
+    """
+    now = time.time()
+    results = []
+    for filename in glob.glob(os.path.join(METRICS_DIR, '*.json')):
+        try:
+            if now - os.path.getmtime(filename) > 3 * METRICS_DUMP_SECONDS:
+                os.remove(filename)
+                continue
+            with open(filename, encoding='utf-8') as f:
+                data = json.load(f)
+            if data.get('pid') == os.getpid():
+                continue
+            if not _is_alive(data.get('pid')):
+                os.remove(filename)
+                continue
+        except (OSError, ValueError):
+            continue
+        results.append(data)
+    if _role is not None:
+        data = {'role': _role, 'pid': os.getpid(), **registry.snapshot()}
+        if profiler is not None:
+            data['profile'] = profiler.snapshot()
+        results.append(data)
+    return results
+
+
+def _format_labels(labels):
+    """标签输出为{key="value",...}, 转义值中的反斜杠、双引号和换行"""
+    if not labels:
+        return ''
+    escaped = (value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in labels)
+    return '{' + ','.join(f'{key}="{value}"' for (key, _), value in zip(labels, escaped)) + '}'
+
+
+def render(processes):
+    """把多个进程的指标按照角色相加, 输出文本格式
+    :param processes: collect()的返回值
+    """
+    counters, gauges, histograms = Counter(), Counter(), {}
+    for data in processes:
+        process = (('process', data['role']),)
+        for name, labels, value in data.get('counters', []):
+            counters[(name, process + tuple(map(tuple, labels)))] += value
+        for name, labels, value in data.get('gauges', []):
+            gauges[(name, process + tuple(map(tuple, labels)))] += value
+        for name, labels, counts, total, count in data.get('histograms', []):
+            key = (name, process + tuple(map(tuple, labels)))
+            merged = histograms.setdefault(key, [[0] * len(counts), 0.0, 0])
+            merged[0] = [a + b for a, b in zip(merged[0], counts)]
+            merged[1] += total
+            merged[2] += count
+
+    lines = []
+    for kind, values in (('counter', counters), ('gauge', gauges)):
+        for name in sorted({name for name, _ in values}):
+            lines.append(f'# TYPE {PREFIX}{name} {kind}')
+            for (metric, labels), value in sorted(values.items()):
+                if metric == name:
+                    lines.append(f'{PREFIX}{name}{_format_labels(labels)} {value}')
+    for name in sorted({name for name, _ in histograms}):
+        lines.append(f'# TYPE {PREFIX}{name} histogram')
+        for (metric, labels), (counts, total, count) in sorted(histograms.items()):
+            if metric != name:
+                continue
+            cumulative = 0
+            for bound, bucket in zip(BUCKETS + ('+Inf',), counts):
+                cumulative += bucket
+                lines.append(f'{PREFIX}{name}_bucket{_format_labels(labels + (("le", str(bound)),))} {cumulative}')
+            lines.append(f'{PREFIX}{name}_sum{_format_labels(labels)} {round(total, 6)}')
+            lines.append(f'{PREFIX}{name}_count{_format_labels(labels)} {count}')
+    return '\n'.join(lines) + '\n'
+
+
+def render_profile(processes):
+    """把多个进程的采样结果合并为折叠栈格式, 每个调用栈以进程角色开头"""
+    stacks = Counter()
+    for data in processes:
+        for stack, count in data.get('profile', {}).items():
+            stacks[f'{data["role"]};{stack}'] += count
+    return ''.join(f'{stack} {count}\n' for stack, count in stacks.most_common())